@@ -3,7 +3,7 @@ from pathlib import Path
 import streamlit as st
 
 import src.logic as lg
-from src import utils
+from src.graph_store import default_store
 
 
 st.set_page_config(
@@ -69,16 +69,16 @@ transit_isochrone = "plots/transit_isochrone_from_my_apartment.png"
 caption = "How far public transit can take me from my apartment in 15, 30, 45, and 60 minutes."
 st.image(transit_isochrone, caption=caption)
 
-# For now, this uses too much memory to host on Streamlit Cloud
-# st.markdown("##### Generate Your Own Transit Map")
-# transit_address = lg.transit_address_input()
-# if transit_address:
-#     lg.make_transit_isochrone(transit_address)
-#     if st.session_state["transit_map_ready"]:
-#         street_address = transit_address.split(",")[0]
-#         caption = f"Everywhere someone can take public transit in 15, 30, and 45 minutes from {street_address}."
-#         filepath = "plots/user_generated_transit_isochrone.png"
-#         st.image(filepath, caption=caption)
+# Every session shares one copy of the graph arrays (see src/graph_store.py),
+# and maps are drawn in the background (see src/jobs.py)
+st.markdown("##### Generate Your Own Transit Map")
+transit_address = lg.transit_address_input()
+if transit_address:
+    lg.make_transit_isochrone(transit_address)
+    if st.session_state["transit_map_ready"]:
+        street_address = transit_address.split(",")[0]
+        caption = f"Everywhere someone can take public transit in 15, 30, and 45 minutes from {street_address}."
+        st.image(lg.finished_maps("transit_job")["transit"], caption=caption)
 
 
 lg.write_text("More Buses Take You More Places")
@@ -86,13 +86,13 @@ lg.thirty_minute_maps()
 lg.write_text("More Buses Take You More Places (II)", header=False)
 lg.forty_five_and_one_hour_maps()
 
-# st.markdown("##### Generate Your Own Frequency Maps")
-# frequency_address = lg.frequency_address_input()
-# if frequency_address:
-#     lg.make_frequency_isochrones(frequency_address)
-#     if st.session_state["frequency_maps_ready"]:
-#         st.markdown("###### Thirty Minute Trips")
-#         lg.user_generated_thirty_minute_maps() 
+st.markdown("##### Generate Your Own Frequency Maps")
+frequency_address = lg.frequency_address_input()
+if frequency_address:
+    lg.make_frequency_isochrones(frequency_address)
+    if st.session_state["frequency_maps_ready"]:
+        st.markdown("###### Thirty Minute Trips")
+        lg.user_generated_thirty_minute_maps() 
 
 
 lg.write_text("Better Bus Service")
@@ -106,4 +106,4 @@ st.markdown("---")
 lg.write_text("Citations & Helpful References", header_level=5)
 
 
-utils.print_app_memory_usage()
\ No newline at end of file
+default_store().print_footprint()
\ No newline at end of file
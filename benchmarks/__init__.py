@@ -0,0 +1,4 @@
+"""
+Offline benchmarks for building the transit graph and drawing isochrones, on
+synthetic cities of any size. See `benchmarks/run.py`.
+"""
@@ -0,0 +1,80 @@
+"""
+Compares two benchmark results and flags what got slower.
+
+    python -m benchmarks.compare benchmarks/results/before.json benchmarks/results/after.json
+
+Exits with status 1 if any benchmark's median time grew by more than
+`--threshold` times, so it can gate a CI job.
+"""
+import sys
+import json
+import argparse
+
+
+# Ratio of new to old median time that counts as a regression
+THRESHOLD = 1.25
+
+# Benchmarks faster than this, in seconds, are too noisy to flag
+MIN_SECONDS = 0.01
+
+
+def load_results(filepath):
+    with open(filepath, "r") as json_file:
+        return json.load(json_file)
+
+
+def compare(baseline, current, threshold=THRESHOLD, min_seconds=MIN_SECONDS):
+    """
+    One row per benchmark in either result: its name, old and new median
+    seconds (None where it's missing), the ratio of new to old, and whether
+    that counts as a regression.
+    """
+    rows = []
+    names = sorted(set(baseline["results"]) | set(current["results"]))
+    for name in names:
+        old = baseline["results"].get(name, {}).get("median")
+        new = current["results"].get(name, {}).get("median")
+        ratio = None
+        if old is not None and new is not None and old > 0:
+            ratio = new / old
+        regressed = (ratio is not None and ratio > threshold
+                     and new >= min_seconds)
+        rows.append((name, old, new, ratio, regressed))
+    return rows
+
+
+def print_comparison(rows):
+    seconds = lambda value: "-" if value is None else f"{value:.3f}"
+    width = max([len(row[0]) for row in rows] + [len("benchmark")])
+    print(f"{'benchmark':<{width}}  {'before':>9}  {'after':>9}  {'ratio':>6}")
+    for name, old, new, ratio, regressed in rows:
+        ratio = "-" if ratio is None else f"{ratio:.2f}"
+        flag = "  slower" if regressed else ""
+        print(f"{name:<{width}}  {seconds(old):>9}  {seconds(new):>9}  {ratio:>6}{flag}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+        help="ratio of new to old median time that counts as a regression")
+    args = parser.parse_args(argv)
+
+    baseline, current = load_results(args.baseline), load_results(args.current)
+    for setting in ["scale", "seed"]:
+        if baseline["meta"].get(setting) != current["meta"].get(setting):
+            print(f"The two runs used different settings for {setting}, so times aren't comparable.")
+
+    rows = compare(baseline, current, args.threshold)
+    print_comparison(rows)
+    regressions = [row[0] for row in rows if row[4]]
+    if regressions:
+        print(f"{len(regressions)} benchmarks got more than {args.threshold} times slower.")
+        return 1
+    print(f"✓\tNothing got more than {args.threshold} times slower")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+"""
+Times every stage of the transit graph build, each way of searching for an
+isochrone, and each way of drawing one, on a synthetic city.
+
+    python -m benchmarks.run --scale small
+    python -m benchmarks.run --scale chicago --repeat 5 --output benchmarks/results/chicago.json
+
+Nothing is downloaded. The city's walking graph and GTFS feed are generated
+(see `benchmarks/synthetic.py`) into a temporary directory, which stands in
+for `data/` while the benchmarks run, so the real data is never touched.
+
+Results are written as JSON: the settings and machine they were taken on,
+every time measured for every benchmark with its median, and the spans (see
+`src/tracing.py`) inside the last map drawn by each renderer. Compare two
+runs with `python -m benchmarks.compare`.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+from pathlib import Path
+from functools import cache
+from contextlib import contextmanager
+from datetime import datetime
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import scipy
+
+import src.gtfs as gtfs
+import src.graphs as graphs
+import src.utils as utils
+import src.tracing as tracing
+import create_transit_graph
+from src.cache import IsochroneCache
+from src.graph_store import GraphStore
+from src.batch import batch_travel_times
+from src.isochrones import WalkingIsochrone, TransitIsochrone
+from src.filepaths import REPO_ROOT_DIR
+from benchmarks.synthetic import SCALES, make_city, write_feed
+
+
+RESULTS_DIR = REPO_ROOT_DIR / "benchmarks" / "results"
+
+CITY = "Synthetic City"
+
+# A regular weekday in the synthetic feed's calendar
+SERVICE_DATE = "20220816"
+
+# Searches and maps are timed from this many origins, and the median kept
+NUM_ORIGINS = 5
+
+TRIP_TIMES = [15, 30, 45, 60]
+
+
+@contextmanager
+def sandbox(directory):
+    """
+    Points every module-level path the build reads or writes at `directory`,
+    and puts them back afterwards.
+    """
+    directory = Path(directory)
+    patches = [
+        (gtfs, "GTFS_PATH", directory / "gtfs_raw"),
+        (gtfs, "GTFS_ZIP_PATH", directory / "gtfs_raw.zip"),
+        (graphs, "DATA_DIR", directory),
+    ]
+    originals = [(module, name, getattr(module, name)) for module, name, _ in patches]
+    for module, name, value in patches:
+        setattr(module, name, value)
+    try:
+        yield directory
+    finally:
+        for module, name, value in originals:
+            setattr(module, name, value)
+        graphs._node_indexes.clear()
+
+
+class Benchmarks:
+    def __init__(self, repeat=1):
+        self.repeat = repeat
+        self.results = {}
+
+        # The spans inside the last call of some benchmarks, by name
+        self.traces = {}
+
+
+    def record(self, name, seconds):
+        seconds = list(seconds)
+        self.results[name] = {"seconds": seconds, "median": float(np.median(seconds))}
+        print(f"✓\t{name}: {np.median(seconds):.3f}s")
+
+
+    def measure(self, name, func, *args, **kwargs):
+        """Calls `func` `repeat` times and records how long each call took"""
+        seconds = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            seconds.append(time.perf_counter() - start)
+        self.record(name, seconds)
+        return result
+
+
+    def measure_each(self, name, func, items):
+        """Calls `func` once per item, `repeat` times over, and records each call"""
+        seconds = []
+        for _ in range(self.repeat):
+            for item in items:
+                start = time.perf_counter()
+                func(item)
+                seconds.append(time.perf_counter() - start)
+        self.record(name, seconds)
+
+
+def benchmark_build(benchmarks, walking_graph, feed, data_dir):
+    """Every stage of `create_transit_graph.py`, from a fresh directory"""
+    write_feed(feed, gtfs.GTFS_PATH)
+    utils.compressed_pickle(walking_graph, graphs.graph_path(CITY))
+    dt = pd.to_datetime(SERVICE_DATE)
+
+    pipeline = create_transit_graph.transit_graph_pipeline(CITY,
+        cache(lambda: graphs.download_citywide_graph(CITY)),
+        lambda: gtfs.load_clean_and_save_tables(dt, data_dir),
+        {"service_date": SERVICE_DATE, "service_hours": gtfs.SERVICE_HOURS},
+        SERVICE_DATE, data_dir)
+    pipeline.run(force=True)
+    for name, seconds in pipeline.timings.items():
+        benchmarks.record(f"build/{name}", [seconds])
+
+    # Nothing has changed, so every stage should be skipped
+    rebuild = create_transit_graph.transit_graph_pipeline(CITY,
+        cache(lambda: graphs.download_citywide_graph(CITY)),
+        lambda: gtfs.load_clean_and_save_tables(dt, data_dir),
+        {"service_date": SERVICE_DATE, "service_hours": gtfs.SERVICE_HOURS},
+        SERVICE_DATE, data_dir)
+    benchmarks.measure("build/unchanged", rebuild.run)
+
+
+def benchmark_queries(benchmarks, walking_graph, origins, data_dir):
+    """Each engine and each kind of search, from the same origins"""
+    load = lambda engine, **kwargs: TransitIsochrone(data_dir, CITY, engine=engine, **kwargs)
+
+    def load_networkx():
+        # A store of its own, so the graphs are read from disk rather than 
+        # shared, and both touched, since they load the first time they're used
+        isochrone = load("networkx", store=GraphStore())
+        isochrone.citywide_graph, isochrone.transit_graph
+        return isochrone
+
+    def load_csr():
+        isochrone = load("csr", store=GraphStore())
+        isochrone.csr_graph.matrix()
+        return isochrone
+
+    networkx_isochrone = benchmarks.measure("load/networkx", load_networkx)
+    csr_isochrone = benchmarks.measure("load/csr", load_csr)
+    stop_table_isochrone = load("csr", use_stop_table=True)
+    nodes = [csr_isochrone.get_nearest_node(origin) for origin in origins]
+    max_trip_time = max(TRIP_TIMES)
+
+    walking = WalkingIsochrone(walking_graph)
+    benchmarks.measure_each("query/walking_networkx",
+        lambda node: walking.travel_times_from_node(node, max_trip_time), nodes)
+    walking = WalkingIsochrone(walking_graph, engine="csr")
+    benchmarks.measure_each("query/walking_csr",
+        lambda node: walking.csr_search(node, max_trip_time), nodes)
+
+    benchmarks.measure_each("query/transit_networkx",
+        lambda node: networkx_isochrone.travel_times_from_node(node, max_trip_time), nodes)
+    benchmarks.measure_each("query/transit_csr",
+        lambda node: csr_isochrone.csr_search(node, max_trip_time), nodes)
+    benchmarks.measure_each("query/transit_stop_table",
+        lambda node: stop_table_isochrone.csr_search(node, max_trip_time), nodes)
+    benchmarks.measure_each("query/transit_departure_hours",
+        lambda node: csr_isochrone.csr_search(node, max_trip_time,
+                                              departure_hours=(7, 10)), nodes)
+    benchmarks.measure_each("query/transit_departure_time",
+        lambda node: csr_isochrone.csr_search(node, max_trip_time,
+                                              departure_time="08:00"), nodes)
+
+    benchmarks.measure_each("query/frequency_sweep",
+        lambda node: csr_isochrone.sweep_from_node(node, max_trip_time), nodes)
+
+    benchmarks.measure_each("query/transit_metrics",
+        lambda origin: csr_isochrone.metrics(origin, TRIP_TIMES), origins)
+
+    # The second search from each origin is answered from the cache
+    cached_isochrone = load("csr", cache=IsochroneCache(cache_dir=None))
+    for node in nodes:
+        cached_isochrone.csr_search(node, max_trip_time)
+    benchmarks.measure_each("query/transit_cached",
+        lambda node: cached_isochrone.csr_search(node, max_trip_time), nodes)
+
+    benchmarks.measure("query/batch", lambda: list(batch_travel_times(CITY,
+        origins, TRIP_TIMES, [0.5, 1.0, 2.0], data_dir=data_dir)))
+
+
+def benchmark_rendering(benchmarks, origins, data_dir):
+    """Drawing a full map, search included, with each renderer"""
+    plots_dir = data_dir / "plots"
+    plots_dir.mkdir(exist_ok=True)
+    for engine, renderer in [("networkx", "osmnx"), ("csr", "osmnx"), ("csr", "fast")]:
+        isochrone = TransitIsochrone(data_dir, CITY, engine=engine, renderer=renderer)
+
+        def draw(origin):
+            isochrone.make_isochrone(origin, trip_times=TRIP_TIMES,
+                filepath=plots_dir / f"{engine}_{renderer}.png")
+            plt.close("all")
+
+        name = f"render/{engine}_{renderer}"
+        benchmarks.measure_each(name, draw, origins)
+        benchmarks.traces[name] = tracing.last_trace()["spans"]
+
+
+def choose_origins(walking_graph, seed=0, num_origins=NUM_ORIGINS):
+    """(lat, lng) of nodes picked at random, the same ones for the same seed"""
+    nodes = sorted(walking_graph.nodes)
+    picks = np.random.RandomState(seed).choice(len(nodes), num_origins, replace=False)
+    return [(walking_graph.nodes[nodes[i]]["y"], walking_graph.nodes[nodes[i]]["x"])
+            for i in sorted(picks)]
+
+
+def run_benchmarks(scale="small", seed=0, repeat=1, skip_rendering=False):
+    benchmarks = Benchmarks(repeat)
+    walking_graph, feed = benchmarks.measure("generate/city", make_city, scale, seed)
+    origins = choose_origins(walking_graph, seed)
+
+    with tempfile.TemporaryDirectory() as temp_dir, sandbox(temp_dir) as data_dir:
+        benchmark_build(benchmarks, walking_graph, feed, data_dir)
+        benchmark_queries(benchmarks, walking_graph, origins, data_dir)
+        if not skip_rendering:
+            benchmark_rendering(benchmarks, origins, data_dir)
+
+    meta = {
+        "scale":        scale,
+        "seed":         seed,
+        "repeat":       repeat,
+        "num_nodes":    walking_graph.number_of_nodes(),
+        "num_stop_times":   len(feed["stop_times"]),
+        "timestamp":    datetime.now().isoformat(timespec="seconds"),
+        "python":       platform.python_version(),
+        "numpy":        np.__version__,
+        "scipy":        scipy.__version__,
+        "pandas":       pd.__version__,
+        "platform":     platform.platform(),
+        "cpu_count":    os.cpu_count(),
+    }
+    return {"meta": meta, "results": benchmarks.results, "traces": benchmarks.traces}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1,
+        help="times to repeat each search and map")
+    parser.add_argument("--skip-rendering", action="store_true")
+    parser.add_argument("--output", type=Path,
+        help="where to write the results, by default benchmarks/results/<scale>-<time>.json")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scale, args.seed, args.repeat, args.skip_rendering)
+    output = args.output
+    if output is None:
+        output = RESULTS_DIR / f"{args.scale}-{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with utils.atomic_write(output, "w") as json_file:
+        json.dump(results, json_file, indent=2)
+    print(f"✓\tSaved benchmark results to {output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""
+A made-up city, for measuring the pipeline without downloading anything.
+
+The walking graph is a jittered grid of streets with a few blocks missing,
+shaped like what `ox.graph_from_place` returns: a MultiDiGraph with node
+coordinates, edge lengths in meters and walking times. The GTFS feed runs bus
+routes along the grid's rows and columns, plus a few faster trains, with more
+trips at rush hour, service past midnight, separate weekday and weekend
+schedules and a holiday.
+
+Everything is drawn from a seeded random state, so the same scale and seed
+always make the same city.
+"""
+import numpy as np
+import pandas as pd
+import networkx as nx
+
+import src.graphs as graphs
+
+
+# Grid size, in nodes along each side, and number of routes. "chicago" is
+# about the size of Chicago's walking graph and the CTA's weekday schedule,
+# and "large" is about three times that.
+SCALES = {
+    "tiny":     {"grid_size": 30,   "num_routes": 6},
+    "small":    {"grid_size": 120,  "num_routes": 20},
+    "medium":   {"grid_size": 300,  "num_routes": 60},
+    "chicago":  {"grid_size": 550,  "num_routes": 130},
+    "large":    {"grid_size": 950,  "num_routes": 390},
+}
+
+# South west corner of the grid, and the distance between nodes in degrees
+ORIGIN = (41.80, -87.75)
+SPACING = (0.0007, 0.0009)
+
+# Nodes between stops, for buses and for trains
+BUS_STOP_SPACING = 4
+TRAIN_STOP_SPACING = 12
+
+# Minutes between trips at each hour of the service day, from 4am to 2am
+HEADWAYS = {hour: 30 for hour in range(4, 26)}
+HEADWAYS.update({hour: 8 for hour in [7, 8, 16, 17, 18]})
+HEADWAYS.update({hour: 12 for hour in range(9, 16)})
+HEADWAYS.update({hour: 15 for hour in range(19, 22)})
+
+# Share of blocks that are missing, like parks, rail yards and cul-de-sacs
+MISSING_EDGES = 0.03
+
+# Dates the calendar covers
+START_DATE, END_DATE = "20220801", "20220831"
+HOLIDAY = "20220815"
+
+
+def make_city(scale="small", seed=0):
+    """The walking graph and the raw GTFS tables for one synthetic city"""
+    settings = SCALES[scale]
+    walking_graph = make_walking_graph(settings["grid_size"], seed)
+    feed = make_feed(settings["grid_size"], settings["num_routes"], seed)
+    return walking_graph, feed
+
+
+def node_id(row, column, grid_size):
+    return 1_000_000 + row * grid_size + column
+
+
+def make_walking_graph(grid_size, seed=0):
+    rng = np.random.RandomState(seed)
+    rows, columns = np.divmod(np.arange(grid_size * grid_size), grid_size)
+    node_ids = node_id(rows, columns, grid_size)
+    lats = ORIGIN[0] + rows * SPACING[0] + rng.uniform(-0.1, 0.1, rows.shape) * SPACING[0]
+    lngs = ORIGIN[1] + columns * SPACING[1] + rng.uniform(-0.1, 0.1, rows.shape) * SPACING[1]
+
+    # Streets along rows and along columns, each walkable both ways
+    east = columns < grid_size - 1
+    north = rows < grid_size - 1
+    origins = np.concatenate([np.flatnonzero(east), np.flatnonzero(north)])
+    destinations = np.concatenate([np.flatnonzero(east) + 1,
+                                   np.flatnonzero(north) + grid_size])
+    keep = rng.rand(origins.shape[0]) >= MISSING_EDGES
+    origins, destinations = origins[keep], destinations[keep]
+    lengths = haversine(lats[origins], lngs[origins], lats[destinations], lngs[destinations])
+
+    graph = nx.MultiDiGraph(crs="epsg:4326")
+    graph.add_nodes_from((node, {"x": x, "y": y}) for node, x, y in
+        zip(node_ids.tolist(), lngs.tolist(), lats.tolist()))
+    for orig, dest in [(origins, destinations), (destinations, origins)]:
+        graph.add_edges_from((u, v, {"length": length}) for u, v, length in
+            zip(node_ids[orig].tolist(), node_ids[dest].tolist(), lengths.tolist()))
+    return graphs.add_walking_times_to_graph(graph)
+
+
+def make_feed(grid_size, num_routes, seed=0):
+    """
+    Raw GTFS tables, as they'd be read from the feed's text files, keyed by
+    table name. Times are strings and run past 24:00:00.
+    """
+    rng = np.random.RandomState(seed + 1)
+    routes, trips, stop_times, stops = [], [], [], {}
+    for route_number in range(num_routes):
+        route_id = str(route_number)
+        is_train = route_number % 10 == 9
+        spacing = TRAIN_STOP_SPACING if is_train else BUS_STOP_SPACING
+        line = rng.randint(grid_size)
+        cells = np.arange(0, grid_size, spacing)
+        if route_number % 2:
+            route_rows, route_columns = cells, np.full(cells.shape, line)
+        else:
+            route_rows, route_columns = np.full(cells.shape, line), cells
+        route_stops = node_id(route_rows, route_columns, grid_size)
+        for stop, row, column in zip(route_stops.tolist(), route_rows, route_columns):
+            stops[stop] = (row, column)
+
+        # Seconds between stops, slower for buses than trains
+        speed = 60 if is_train else 20
+        hop_seconds = rng.randint(speed // 2, speed * 2, cells.shape[0] - 1) * spacing
+        offsets = np.concatenate([[0], np.cumsum(hop_seconds)])
+        routes.append((route_id, f"Route {route_number}", 1 if is_train else 3))
+
+        for service_id, headway_scale in [("weekday", 1), ("weekend", 2)]:
+            for direction in [0, 1]:
+                # One row per trip and one column per stop, in the order visited
+                direction_stops = route_stops if direction == 0 else route_stops[::-1]
+                direction_offsets = offsets if direction == 0 else offsets[-1] - offsets[::-1]
+                starts = trip_start_times(rng, headway_scale)
+                trip_ids = [f"{route_id}_{service_id}_{direction}_{trip_number}"
+                            for trip_number in range(starts.shape[0])]
+                trips.extend((route_id, service_id, trip_id, direction) for trip_id in trip_ids)
+                stop_times.append(pd.DataFrame({
+                    "trip_id":          np.repeat(trip_ids, cells.shape[0]),
+                    "seconds":          (starts[:, None] + direction_offsets).ravel(),
+                    "stop_id":          np.tile(direction_stops, starts.shape[0]),
+                    "stop_sequence":    np.tile(np.arange(1, cells.shape[0] + 1), starts.shape[0]),
+                }))
+
+    stop_times = pd.concat(stop_times, ignore_index=True)
+    clock = gtfs_clock_times(stop_times.pop("seconds").values)
+    stop_times.insert(1, "arrival_time", clock)
+    stop_times.insert(2, "departure_time", clock)
+
+    stop_ids = np.array(sorted(stops))
+    stop_rows, stop_columns = np.array([stops[stop] for stop in stop_ids.tolist()]).T
+    return {
+        "routes":   pd.DataFrame(routes, columns=["route_id", "route_short_name", "route_type"]),
+        "trips":    pd.DataFrame(trips, columns=["route_id", "service_id", "trip_id", "direction_id"]),
+        "stop_times":   stop_times,
+        "stops":    pd.DataFrame({
+            "stop_id":      stop_ids,
+            "stop_name":    [f"Stop {stop}" for stop in stop_ids.tolist()],
+            "stop_lat":     ORIGIN[0] + stop_rows * SPACING[0] + rng.uniform(-1e-5, 1e-5, stop_ids.shape),
+            "stop_lon":     ORIGIN[1] + stop_columns * SPACING[1] + rng.uniform(-1e-5, 1e-5, stop_ids.shape),
+        }),
+        "calendar": pd.DataFrame({
+            "service_id":   ["weekday", "weekend"],
+            "monday":       [1, 0], "tuesday":  [1, 0], "wednesday":    [1, 0],
+            "thursday":     [1, 0], "friday":   [1, 0], "saturday":     [0, 1],
+            "sunday":       [0, 1],
+            "start_date":   [START_DATE, START_DATE],
+            "end_date":     [END_DATE, END_DATE],
+        }),
+        "calendar_dates":   pd.DataFrame({
+            "service_id":       ["weekday", "weekend"],
+            "date":             [HOLIDAY, HOLIDAY],
+            "exception_type":   [2, 1],
+        }),
+    }
+
+
+def trip_start_times(rng, headway_scale=1):
+    """Seconds since midnight at which trips leave the first stop"""
+    starts = []
+    for hour, headway in HEADWAYS.items():
+        headway *= 60 * headway_scale
+        first = hour * 3600 + rng.randint(headway)
+        starts.append(np.arange(first, (hour + 1) * 3600, headway))
+    return np.concatenate(starts)
+
+
+def gtfs_clock_times(seconds):
+    """"H:MM:SS" strings, with hours past 24 for trips after midnight"""
+    hours, rest = np.divmod(seconds, 3600)
+    minutes, seconds = np.divmod(rest, 60)
+    return (pd.Series(hours).astype(str) + ":"
+            + pd.Series(minutes).astype(str).str.zfill(2) + ":"
+            + pd.Series(seconds).astype(str).str.zfill(2)).values
+
+
+def write_feed(feed, directory):
+    directory.mkdir(parents=True, exist_ok=True)
+    for table_name, df in feed.items():
+        df.to_csv(directory / f"{table_name}.txt", index=False)
+
+
+def haversine(lats, lngs, other_lats, other_lngs):
+    """Distances in meters"""
+    lats, lngs = np.radians(lats), np.radians(lngs)
+    other_lats, other_lngs = np.radians(other_lats), np.radians(other_lngs)
+    a = (np.sin((other_lats - lats) / 2) ** 2
+         + np.cos(lats) * np.cos(other_lats) * np.sin((other_lngs - lngs) / 2) ** 2)
+    return 2 * 6_371_009 * np.arcsin(np.sqrt(a))
@@ -3,6 +3,7 @@ import matplotlib.pyplot as plt
 import src.graphs as graphs
 from src.isochrones import WalkingIsochrone, TransitIsochrone, timer_func
 from src.filepaths import DATA_DIR
+from src.cache import default_cache
 
 
 @timer_func
@@ -11,7 +12,7 @@ def walking_isochrone_from_my_apartment():
     my_lat_lon = (41.898010150000005, -87.67613740698785)
     city = "Chicago, Illinois"
     graph = graphs.load_citywide_graph(city)
-    walking_isochrone = WalkingIsochrone(graph)
+    walking_isochrone = WalkingIsochrone(graph, engine="csr", cache=default_cache())
     filepath = "plots/walking_isochrone_from_my_apartment.png"
     walking_isochrone.make_isochrone(my_lat_lon, filepath=filepath)
 
@@ -20,7 +21,8 @@ def walking_isochrone_from_my_apartment():
 def transit_isochrone_from_my_apartment():
     city = "Chicago, Illinois"
     my_lat_lon = (41.898010150000005, -87.67613740698785)
-    transit_isochrone = TransitIsochrone(DATA_DIR, city)
+    transit_isochrone = TransitIsochrone(DATA_DIR, city, engine="csr", 
+        cache=default_cache())
 
     trip_times = [15, 30, 45, 60]
     freq_multipliers = [1]
@@ -35,7 +37,8 @@ def transit_isochrone_from_my_apartment():
 def frequency_isochrones_from_my_apartment(trip_time=30):
     city = "Chicago, Illinois"
     my_lat_lon = (41.898010150000005, -87.67613740698785)
-    transit_isochrone = TransitIsochrone(DATA_DIR, city)
+    transit_isochrone = TransitIsochrone(DATA_DIR, city, engine="csr", 
+        cache=default_cache())
 
     freq_multipliers = [0.5, 1, 2, 3]
     bgcolor="#262730"
@@ -55,11 +58,35 @@ def frequency_isochrones_from_my_apartment(trip_time=30):
         plt.savefig(filepath, dpi=300, facecolor=bgcolor)
 
 
+@timer_func
+def reach_versus_frequency_from_my_apartment(trip_times=(30, 45, 60)):
+    city = "Chicago, Illinois"
+    my_lat_lon = (41.898010150000005, -87.67613740698785)
+    transit_isochrone = TransitIsochrone(DATA_DIR, city, engine="csr", 
+        cache=default_cache())
+    num_nodes = transit_isochrone.csr_graph.num_nodes
+
+    fig, ax = plt.subplots(figsize=(6, 4))
+    for trip_time in trip_times:
+        sweep = transit_isochrone.frequency_sweep(my_lat_lon, trip_time)
+        multipliers, num_reached = sweep.reach_curve()
+        ax.plot(multipliers, 100 * num_reached / num_nodes, 
+            label=f"{trip_time} minute trips")
+
+    ax.set_xscale("log")
+    ax.set_xlabel("Bus and train frequency, relative to today")
+    ax.set_ylabel("Share of the city's intersections reached (%)")
+    ax.legend()
+    filepath = "plots/reach_versus_frequency_from_my_apartment.png"
+    fig.savefig(filepath, dpi=300, bbox_inches="tight")
+
+
 @timer_func
 def thirty_minute_frequency_maps():
     city = "Chicago, Illinois"
     my_lat_lon = (41.898010150000005, -87.67613740698785)
-    transit_isochrone = TransitIsochrone(DATA_DIR, city)
+    transit_isochrone = TransitIsochrone(DATA_DIR, city, engine="csr", 
+        cache=default_cache())
 
     trip_times = [30]
     freq_multipliers = [2]
@@ -98,6 +125,7 @@ if __name__ == "__main__":
     frequency_isochrones_from_my_apartment(trip_time=30)
     frequency_isochrones_from_my_apartment(trip_time=45)
     frequency_isochrones_from_my_apartment(trip_time=60)
+    reach_versus_frequency_from_my_apartment()
     thirty_minute_frequency_maps()
 
 
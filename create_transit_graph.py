@@ -1,27 +1,219 @@
+import sys
+from functools import cache
+
 import src.gtfs as gtfs
 import src.graphs as graphs
+import src.utils as utils
+import src.tracing as tracing
+from src.pipeline import Pipeline
+from src.filepaths import DATA_DIR
+
+
+GTFS_TABLES = ["routes", "trips", "stop_times", "stops"]
+
 
+def construct_transit_graph_for_requested_date(city, force=False, 
+                                               service_hours=gtfs.SERVICE_HOURS):
+    calendar, _ = gtfs.load_calendar()
+    dt = gtfs.choose_date(calendar)
+    service_date = dt.strftime("%Y%m%d")
 
-def construct_transit_graph_for_requested_date(city):
     # Data
-    routes, trips, stop_times, stops = gtfs.load_clean_and_save_tables()
-    citywide_graph = graphs.download_citywide_graph(city)
+    prepare_tables = lambda: gtfs.load_clean_and_save_tables(dt, 
+        service_hours=service_hours)
+    citywide_graph = cache(lambda: graphs.download_citywide_graph(city))
+    pipeline = transit_graph_pipeline(city, citywide_graph, prepare_tables,
+        {"service_date": service_date, "service_hours": list(service_hours)},
+        service_date)
+    pipeline.run(force)
+
+
+def construct_transit_graphs_for_every_service_pattern(city, force=False,
+                                                       service_hours=gtfs.SERVICE_HOURS,
+                                                       data_dir=DATA_DIR):
+    """
+    One transit graph for each distinct pattern of service on the feed's
+    calendar: regular weekdays, Saturdays, Sundays, and any holidays with a
+    schedule of their own. The raw feed is read once, for every service that
+    runs on any date, and each pattern's trips are filtered from that. Each
+    graph is saved to its own directory under `service_patterns` in 
+    `data_dir`, which can be handed to `TransitIsochrone` as its 
+    `app_data_directory`.
+    """
+    patterns = gtfs.get_service_patterns()
+    print(f"Found {len(patterns)} patterns of service.")
+    service_ids = sorted({s_id for pattern in patterns for s_id in pattern["service_ids"]})
+
+    # Only read if some pattern's tables are out of date
+    load_feed = cache(lambda: gtfs.load_and_clean_tables(service_ids, service_hours))
+    citywide_graph = cache(lambda: graphs.download_citywide_graph(city))
+
+    # Every pattern runs over the same walking graph, so what's built from it 
+    # alone is built once
+    walking_graph_pipeline(city, citywide_graph).run(force)
+
+    for pattern in patterns:
+        print(f"Building the transit graph for {pattern['name']}, which runs on {len(pattern['dates'])} dates.")
+        pattern_dir = gtfs.service_pattern_dir(pattern, data_dir)
+
+        def prepare_tables(pattern=pattern, pattern_dir=pattern_dir):
+            routes, trips, stop_times, stops = load_feed()
+            pattern_trips, pattern_stop_times = gtfs.filter_by_service_ids(trips,
+                stop_times, pattern["service_ids"])
+            gtfs.save_prepared_gtfs_tables(routes, pattern_trips,
+                pattern_stop_times, stops, pattern_dir)
+
+        pipeline = transit_graph_pipeline(city, citywide_graph, prepare_tables,
+            {"service_ids": pattern["service_ids"], "service_hours": list(service_hours)},
+            pattern["dates"][0], pattern_dir, walking_stages=False)
+        pipeline.run(force)
+
+    gtfs.save_service_patterns(patterns, data_dir)
+
+
+def walking_graph_pipeline(city, citywide_graph):
+    """
+    The stages that only depend on the walking graph, on their own, for 
+    builds of several transit graphs over it. Their manifest is kept next to 
+    the walking graph.
+    """
+    pipeline = Pipeline(graphs.graph_path(city).parent / "pipeline.json")
+    add_walking_stages(pipeline, city, citywide_graph)
+    return pipeline
+
+
+def add_walking_stages(pipeline, city, citywide_graph):
+    """
+    The walking graph, and the spatial index and edge geometry built from it 
+    alone, which are kept next to it and shared by every transit graph
+    """
+    walking_dir = graphs.graph_path(city).parent
+    pipeline.add("citywide_graph", citywide_graph,
+        outputs=[graphs.graph_path(city)],
+        params={"city": city})
+    pipeline.add("walking_arrays",
+        lambda: graphs.save_walking_artifacts(city, citywide_graph(), walking_dir),
+        inputs=[graphs.graph_path(city)],
+        outputs=[graphs.node_index_path(city, walking_dir), 
+                 graphs.edge_geometry_path(city, walking_dir)])
+
+
+def transit_graph_pipeline(city, citywide_graph, prepare_tables, table_params,
+                           service_date, data_dir=DATA_DIR, walking_stages=True):
+    """
+    Every stage of the build, from the raw feed to the stop table and
+    timetable, wired together by the files each one reads and writes. A
+    stage only runs if something it reads has changed since the last build
+    into `data_dir`. `prepare_tables` writes the cleaned GTFS tables, which
+    depend on the raw feed and `table_params`, and `citywide_graph` returns
+    the walking graph, downloading it if need be. Without `walking_stages`, 
+    the walking graph and what's built from it are left to 
+    `walking_graph_pipeline`.
+    """
+    pipeline = Pipeline(data_dir / "pipeline.json")
+    tables = {name: gtfs.prepared_gtfs_table_path(name, data_dir) for name in GTFS_TABLES}
+    table = cache(lambda name: gtfs.load_prepared_gtfs_table(name, data_dir))
+    data = lambda filename: gtfs.isochrone_data_path(filename, data_dir)
+    load = lambda filename: gtfs.load_isochrone_data(filename, data_dir)
+    transit_graph_path = data_dir / "transit_graph.pkl"
+
+    # Data
+    pipeline.add("gtfs_tables", prepare_tables,
+        inputs=[gtfs.raw_gtfs_path()],
+        outputs=tables.values(),
+        params=table_params,
+        version=2)
+    if walking_stages:
+        add_walking_stages(pipeline, city, citywide_graph)
 
     # Bus Frequency
-    gtfs.average_arrival_rates_per_stop(stop_times)
+    pipeline.add("arrival_rates",
+        lambda: gtfs.average_arrival_rates_per_stop(table("stop_times"), data_dir),
+        inputs=[tables["stop_times"]],
+        outputs=[data("average_arrival_rates_per_stop.pkl"),
+                 data("hourly_arrivals_per_stop.pkl")])
 
     # Match Bus Stops to OSMNX graph
-    gtfs.find_graph_node_IDs_for_transit_stops(stops, citywide_graph)
+    pipeline.add("stop_nodes",
+        lambda: gtfs.find_graph_node_IDs_for_transit_stops(table("stops"),
+            citywide_graph(), data_dir),
+        inputs=[tables["stops"], graphs.graph_path(city)],
+        outputs=[data("stop_id_to_graph_id.pkl"), data("graph_id_to_stop_id.pkl")])
 
     # Travel Time Between Transit Stops (this takes some time)
-    gtfs.average_travel_times_per_route(routes, trips, stop_times)
+    pipeline.add("route_travel_times",
+        lambda: gtfs.average_travel_times_per_route(table("routes"),
+            table("trips"), table("stop_times"), data_dir=data_dir),
+        inputs=[tables["routes"], tables["trips"], tables["stop_times"]],
+        outputs=[data("travel_times_per_route.pkl")])
 
     # Transit Graph
-    gtfs.build_and_save_transit_graph()
+    pipeline.add("transit_graph",
+        lambda: gtfs.build_and_save_transit_graph(data_dir),
+        inputs=[data("stop_id_to_graph_id.pkl"),
+                data("average_arrival_rates_per_stop.pkl"),
+                data("travel_times_per_route.pkl")],
+        outputs=[transit_graph_path])
+
+    # Graph arrays for the CSR engine
+    def save_graph_arrays():
+        gtfs.save_isochrone_data(service_date, "service_date.pkl", data_dir)
+        graphs.save_graph_artifact(city, citywide_graph(),
+            utils.read_pickle(transit_graph_path), load("stop_id_to_graph_id.pkl"),
+            service_date=service_date, data_dir=data_dir,
+            hourly_arrivals=load("hourly_arrivals_per_stop.pkl"))
+
+    pipeline.add("graph_arrays", save_graph_arrays,
+        inputs=[graphs.graph_path(city), transit_graph_path,
+                data("stop_id_to_graph_id.pkl"), data("hourly_arrivals_per_stop.pkl")],
+        outputs=[graphs.graph_artifact_path(city, data_dir), data("service_date.pkl")],
+        params={"service_date": service_date})
+
+    # Stop to Stop Travel Times (this also takes some time)
+    pipeline.add("stop_table",
+        lambda: graphs.save_stop_table(city,
+            graphs.load_graph_artifact(city, data_dir), data_dir),
+        inputs=[graphs.graph_artifact_path(city, data_dir)],
+        outputs=[graphs.stop_table_path(city, data_dir)])
+
+    # Connections for departure time isochrones
+    pipeline.add("timetable",
+        lambda: graphs.save_timetable(city,
+            graphs.load_graph_artifact(city, data_dir), table("stop_times"),
+            load("stop_id_to_graph_id.pkl"), data_dir),
+        inputs=[graphs.graph_artifact_path(city, data_dir), tables["stop_times"],
+                data("stop_id_to_graph_id.pkl")],
+        outputs=[graphs.timetable_path(city, data_dir)],
+        version=2)
+    return pipeline
+
+
+def service_hours_from_argv(argv):
+    """
+    `--service-hours START END` keeps arrivals from START up to END, in hours 
+    since midnight of the service day. END can be past 24.
+    """
+    if "--service-hours" not in argv:
+        return gtfs.SERVICE_HOURS
+    position = argv.index("--service-hours")
+    try:
+        start, end = int(argv[position + 1]), int(argv[position + 2])
+    except (IndexError, ValueError):
+        raise ValueError("--service-hours takes two whole hours, such as --service-hours 4 28.")
+    if not 0 <= start < end:
+        raise ValueError("The service hours must start at or after midnight and end after they start.")
+    return (start, end)
 
 
 if __name__ == "__main__":
     city = "Chicago, Illinois"
-    construct_transit_graph_for_requested_date(city)
+    force = "--force" in sys.argv
+    service_hours = service_hours_from_argv(sys.argv)
+    with tracing.span("create_transit_graph"):
+        if "--all" in sys.argv:
+            construct_transit_graphs_for_every_service_pattern(city, force, service_hours)
+        else:
+            construct_transit_graph_for_requested_date(city, force, service_hours)
+    print(tracing.format_trace(tracing.last_trace()))
+
 
-    
\ No newline at end of file
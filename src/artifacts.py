@@ -0,0 +1,230 @@
+"""
+A small binary file format for the pipeline's outputs.
+
+Each file holds a set of named NumPy arrays and a little JSON metadata. The
+layout is:
+
+    MAGIC | header length (uint64, little-endian) | JSON header | arrays
+
+The header lists every array's dtype, shape and byte offset, along with the
+schema version the file was written with. Arrays are stored as raw bytes, each
+aligned to 64 bytes, so they can be memory-mapped straight from disk without
+being copied or unpickled.
+
+Only plain numeric, boolean, datetime and fixed-width string dtypes can be
+stored. Nothing in a file is ever executed or unpickled, so it is safe to load
+one from a cache you don't control.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from src.utils import atomic_write
+
+
+MAGIC = b"FIFARRAY"
+SCHEMA_VERSION = 1
+ALIGNMENT = 64
+
+# bool, signed & unsigned ints, floats, complex, datetimes, timedeltas, and
+# fixed-width bytes & unicode strings
+ALLOWED_DTYPE_KINDS = "biufcMmSU"
+
+
+def save_artifact(filepath, arrays, metadata=None):
+    """
+    Write a dictionary of arrays to `filepath`. The file is written to a
+    temporary path of its own first and then moved into place, so a crash 
+    never leaves a half-written artifact behind and concurrent writers of the
+    same artifact don't get in each other's way.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    entries = []
+    offset = 0
+    for name, array in arrays.items():
+        check_dtype(array.dtype)
+        entries.append({
+            "name":     name,
+            "dtype":    array.dtype.str,
+            "shape":    list(array.shape),
+            "offset":   offset,
+            "nbytes":   array.nbytes,
+        })
+        offset = aligned(offset + array.nbytes)
+
+    header = {
+        "schema_version":   SCHEMA_VERSION,
+        "metadata":         metadata or {},
+        "arrays":           entries,
+    }
+    header = json.dumps(header).encode("utf-8")
+    data_start = aligned(len(MAGIC) + 8 + len(header))
+
+    with atomic_write(filepath, "wb") as artifact_file:
+        artifact_file.write(MAGIC)
+        artifact_file.write(len(header).to_bytes(8, "little"))
+        artifact_file.write(header)
+        for entry, array in zip(entries, arrays.values()):
+            artifact_file.seek(data_start + entry["offset"])
+            array.tofile(artifact_file)
+        artifact_file.truncate(data_start + offset)
+
+
+def load_artifact(filepath, mmap=False):
+    """
+    Returns the dictionary of arrays and the metadata stored in `filepath`.
+    With `mmap=True` the arrays are read-only views onto the file, which are
+    shared between every process that maps the same file.
+    """
+    file_size = os.path.getsize(filepath)
+    with open(filepath, "rb") as artifact_file:
+        if artifact_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filepath} is not an artifact file.")
+        header_length = int.from_bytes(artifact_file.read(8), "little")
+        if header_length > file_size:
+            raise ValueError(f"{filepath} has a corrupt header.")
+        header = json.loads(artifact_file.read(header_length).decode("utf-8"))
+
+    if header.get("schema_version") != SCHEMA_VERSION:
+        msg = f"""
+        {filepath} was written with schema version {header.get("schema_version")},
+        but this code reads version {SCHEMA_VERSION}. Rebuild the artifact.
+        """
+        raise ValueError(msg)
+
+    data_start = aligned(len(MAGIC) + 8 + header_length)
+    if mmap:
+        buffer = np.memmap(filepath, dtype=np.uint8, mode="r")
+    else:
+        buffer = np.fromfile(filepath, dtype=np.uint8)
+
+    arrays = {}
+    for entry in header["arrays"]:
+        dtype = np.dtype(entry["dtype"])
+        check_dtype(dtype)
+        shape = tuple(int(dim) for dim in entry["shape"])
+        count = int(np.prod(shape, dtype=np.int64))
+        start = data_start + int(entry["offset"])
+        end = start + count * dtype.itemsize
+        if start < data_start or end > file_size or end - start != entry["nbytes"]:
+            raise ValueError(f"Array {entry['name']} in {filepath} is out of bounds.")
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=start)
+        array = array.reshape(shape)
+        array.flags.writeable = False
+        arrays[entry["name"]] = array
+    return arrays, header["metadata"]
+
+
+def check_dtype(dtype):
+    if dtype.kind not in ALLOWED_DTYPE_KINDS or dtype.fields is not None:
+        raise ValueError(f"Arrays of dtype {dtype} can't be stored in an artifact.")
+
+
+def aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def arrays_checksum(arrays):
+    """A short, stable fingerprint of a dictionary of arrays"""
+    digest = hashlib.sha256()
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        digest.update(name.encode("utf-8"))
+        digest.update(array.dtype.str.encode("utf-8"))
+        digest.update(str(array.shape).encode("utf-8"))
+        digest.update(array.tobytes())
+    return digest.hexdigest()[:16]
+
+
+############################### Tables ###############################
+
+# Text columns can hold values other than text, so each value's type is kept
+# alongside it, in the order of TEXT_KINDS
+TEXT_KINDS = (str, int, float, bool)
+INDEX_NAME = "__index__"
+
+
+def save_table(df, filepath):
+    """
+    Store a DataFrame column by column. Text columns become fixed-width
+    unicode arrays, with a mask of which values are missing and, if they
+    aren't all text, which were ints, floats or bools, so they come back as
+    they went in. Missing values come back as NaN, and values of any other
+    type as their text. An index other than the default is kept too.
+    Column names become text.
+    """
+    arrays = {}
+    for column in df.columns:
+        arrays.update(table_column_arrays(str(column), df[column].values))
+
+    index = None
+    if not df.index.equals(pd.RangeIndex(len(df))):
+        if isinstance(df.index, pd.MultiIndex):
+            raise ValueError("Tables with a MultiIndex can't be stored in an artifact.")
+        arrays.update(table_column_arrays(INDEX_NAME, df.index.values))
+        index = {"name": df.index.name}
+    metadata = {"columns": [str(c) for c in df.columns], "index": index}
+    save_artifact(filepath, arrays, metadata=metadata)
+
+
+def load_table(filepath):
+    arrays, metadata = load_artifact(filepath)
+    columns = {column: table_column(arrays, column) for column in metadata["columns"]}
+    index = None
+    if metadata.get("index") is not None:
+        index = pd.Index(table_column(arrays, INDEX_NAME), name=metadata["index"]["name"])
+    return pd.DataFrame(columns, columns=metadata["columns"], index=index)
+
+
+def table_column_arrays(name, values):
+    """The arrays one column is stored as, under `name` and names after it"""
+    if values.dtype.kind != "O":
+        return {name: values}
+
+    missing = pd.isna(values)
+    kinds = np.zeros(values.shape[0], dtype=np.uint8)
+    text = np.empty(values.shape[0], dtype=object)
+    for ii, value in enumerate(values):
+        if missing[ii]:
+            text[ii] = ""
+            continue
+        # bool before int, which it's a subclass of, and NumPy scalars as
+        # the Python types they stand for
+        if isinstance(value, (bool, np.bool_)):
+            kinds[ii] = TEXT_KINDS.index(bool)
+        elif isinstance(value, (int, np.integer)):
+            kinds[ii] = TEXT_KINDS.index(int)
+        elif isinstance(value, (float, np.floating)):
+            kinds[ii] = TEXT_KINDS.index(float)
+            value = repr(float(value))
+        text[ii] = str(value)
+
+    arrays = {name: text.astype(str)}
+    if missing.any():
+        arrays[f"{name}.__missing__"] = missing
+    if kinds.any():
+        arrays[f"{name}.__kinds__"] = kinds
+    return arrays
+
+
+def table_column(arrays, name):
+    values = arrays[name]
+    if values.dtype.kind != "U":
+        return values.copy()
+
+    values = values.astype(object)
+    kinds = arrays.get(f"{name}.__kinds__")
+    if kinds is not None:
+        for kind in np.unique(kinds[kinds > 0]):
+            rows = kinds == kind
+            if TEXT_KINDS[kind] is bool:
+                values[rows] = values[rows] == "True"
+            else:
+                values[rows] = [TEXT_KINDS[kind](value) for value in values[rows]]
+    missing = arrays.get(f"{name}.__missing__")
+    if missing is not None:
+        values[missing] = np.nan
+    return values
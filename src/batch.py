@@ -0,0 +1,103 @@
+"""
+Isochrone searches for many origins at once, spread over a pool of processes.
+
+Every worker memory-maps the same graph artifact written by
+`graphs.save_graph_artifact`, so the city is read from disk once and its
+pages are shared by the operating system rather than copied or unpickled into
+each process. The parent snaps origins to nodes and hands out one search per
+origin and frequency multiplier. Results come back, as bitsets of the nodes
+reached plus their travel times, in the order the searches finish.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.csr_graph import CSRGraph
+from src.cache import compress, expand
+import src.graphs as graphs
+from src.filepaths import DATA_DIR
+
+
+# The graph each worker process searches, mapped once when the worker starts
+_worker_graph = None
+
+
+def init_worker(filepath):
+    global _worker_graph
+    _worker_graph = CSRGraph.load(filepath, mmap=True)
+
+
+def search_in_worker(task_id, source_node, cutoff, freq_multiplier):
+    travel_times = _worker_graph.search(source_node, cutoff, freq_multiplier)
+    return task_id, compress(travel_times)
+
+
+def batch_travel_times(city, origins, trip_times, freq_multipliers=None,
+                       processes=None, cache=None, data_dir=DATA_DIR):
+    """
+    Yields `(origin, freq_multiplier, travel_times)` for every pair of
+    `origins`, given as (lat, lng), and `freq_multipliers`, as soon as each
+    search finishes. `travel_times` is an array over the nodes of the city's
+    `CSRGraph`, infinite wherever a node can't be reached within the longest
+    of `trip_times`. The isochrone for any one trip time is
+    `travel_times <= trip_time`.
+
+    A `freq_multiplier` of None searches the walking graph alone. Searches
+    already in `cache` are yielded first without touching the pool. With
+    `processes=1` everything runs in this process. The graph is read from 
+    `data_dir`, where `create_transit_graph.py` saved it.
+    """
+    if freq_multipliers is None:
+        freq_multipliers = [1.0]
+    cutoff = max(trip_times)
+
+    filepath = graphs.graph_artifact_path(city, data_dir)
+    if not filepath.exists():
+        raise FileNotFoundError(f"{filepath} is missing. Run create_transit_graph.py first.")
+    csr_graph = CSRGraph.load(filepath, mmap=True)
+    service_date = csr_graph.metadata.get("service_date")
+
+    node_index = graphs.load_node_index(city, csr_graph=csr_graph, 
+        data_dir=graphs.walking_artifacts_dir(city, data_dir))
+    lats = [origin[0] for origin in origins]
+    lngs = [origin[1] for origin in origins]
+    source_nodes = node_index.nearest_nodes(lats, lngs).tolist()
+
+    # Grouped by frequency, so each worker builds as few routing matrices as it can
+    tasks = {}
+    for freq in freq_multipliers:
+        for origin, source_node in zip(origins, source_nodes):
+            task_id = len(tasks)
+            key = None
+            if cache is not None:
+                key = cache.key(csr_graph.version, source_node, cutoff, freq,
+                                service_date)
+                travel_times = cache.get(key)
+                if travel_times is not None:
+                    yield origin, freq, travel_times
+                    continue
+            tasks[task_id] = (origin, source_node, freq, key)
+
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(1, min(processes, len(tasks)))
+
+    if processes == 1:
+        for origin, source_node, freq, key in tasks.values():
+            travel_times = csr_graph.search(source_node, cutoff, freq)
+            if cache is not None:
+                cache.put(key, travel_times)
+            yield origin, freq, travel_times
+        return
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                             initargs=(str(filepath),)) as executor:
+        futures = [executor.submit(search_in_worker, task_id, source_node,
+                                   cutoff, freq)
+                   for task_id, (_, source_node, freq, _) in tasks.items()]
+        for future in as_completed(futures):
+            task_id, entry = future.result()
+            origin, _, freq, key = tasks[task_id]
+            if cache is not None:
+                cache.add_to_memory(key, entry)
+                cache.write_to_disk(key, entry)
+            yield origin, freq, expand(*entry)
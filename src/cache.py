@@ -0,0 +1,240 @@
+import os
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+import numpy as np
+
+from src.artifacts import save_artifact, load_artifact
+from src.filepaths import DATA_DIR
+
+
+CACHE_DIR = DATA_DIR / "isochrone_cache"
+
+
+class IsochroneCache:
+    """
+    Remembers the results of isochrone searches, so that popular addresses and
+    the article's maps are drawn without searching the graph again.
+
+    Each result is keyed by the graph's version, the starting node, the trip
+    time, the frequency multiplier and the date of service, plus the time of
+    departure for searches of the timetable and the hours of the day for 
+    searches that use their wait times. It is stored as a bitset of the
+    nodes that were reached plus the travel times to just those nodes, which
+    is a small fraction of the size of the full distance array.
+    Times are kept at full precision so that a cached isochrone is identical
+    to a fresh one, right up to the edge of each trip time.
+
+    Results are held in memory, least recently used first out once they pass
+    `max_bytes`, and written to `cache_dir` so they outlive the process. Set
+    `cache_dir=None` to keep everything in memory.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=256 * 2**20,
+                 max_disk_bytes=2 * 2**30):
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # Bytes in `cache_dir`, counted the first time something is written
+        # and again each time it's pruned. Other processes writing to the
+        # same directory are only noticed then.
+        self.disk_bytes = None
+        self.prune_lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+
+    @staticmethod
+    def key(graph_version, origin_node, trip_time, freq_multiplier=None,
+            service_date=None, departure_time=None, hours=None):
+        if freq_multiplier is not None:
+            freq_multiplier = float(freq_multiplier)
+        parts = (graph_version, int(origin_node), float(trip_time),
+                 freq_multiplier, service_date)
+        if departure_time is not None:
+            parts += (int(departure_time),)
+        if hours is not None:
+            parts += (("hours", int(hours[0]), int(hours[1])),)
+        return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+    def get(self, key):
+        """
+        Returns an array of travel times to every node, infinite where a node
+        wasn't reached, or None if the search hasn't been cached.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is None:
+            entry = self.read_from_disk(key)
+            if entry is not None:
+                self.add_to_memory(key, entry)
+
+        travel_times = None
+        if entry is not None:
+            try:
+                travel_times = expand(*entry)
+            except ValueError:
+                # Truncated, or written for a graph with a different number
+                # of nodes
+                self.evict(key)
+
+        with self.lock:
+            if travel_times is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return travel_times
+
+
+    def put(self, key, travel_times):
+        entry = compress(travel_times)
+        self.add_to_memory(key, entry)
+        self.write_to_disk(key, entry)
+
+
+    def add_to_memory(self, key, entry):
+        num_nodes, reached, times = entry
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = entry
+            self.num_bytes += reached.nbytes + times.nbytes
+            while self.num_bytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, old_reached, old_times) = self.entries.popitem(last=False)
+                self.num_bytes -= old_reached.nbytes + old_times.nbytes
+
+
+    def evict(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                _, reached, times = entry
+                self.num_bytes -= reached.nbytes + times.nbytes
+        if self.cache_dir is not None:
+            self.filepath(key).unlink(missing_ok=True)
+
+
+    def filepath(self, key):
+        return self.cache_dir / f"{key}.arrays"
+
+
+    def read_from_disk(self, key):
+        if self.cache_dir is None or not self.filepath(key).exists():
+            return None
+        try:
+            arrays, metadata = load_artifact(self.filepath(key))
+        except (ValueError, OSError):
+            # Written by another version of the format, or half gone
+            return None
+        return metadata["num_nodes"], arrays["reached"], arrays["travel_times"]
+
+
+    def write_to_disk(self, key, entry):
+        if self.cache_dir is None:
+            return
+        num_nodes, reached, times = entry
+        filepath = self.filepath(key)
+        old_size = file_size(filepath)
+        save_artifact(filepath,
+            {"reached": reached, "travel_times": times},
+            metadata={"num_nodes": num_nodes})
+
+        with self.lock:
+            if self.disk_bytes is None:
+                over_budget = True
+            else:
+                self.disk_bytes += file_size(filepath) - old_size
+                over_budget = self.disk_bytes > self.max_disk_bytes
+        if over_budget:
+            self.prune_disk()
+
+
+    def prune_disk(self, target=0.9):
+        """
+        Remove the oldest files once the cache directory passes its budget,
+        down to `target` of it so the next few writes don't prune again. Only
+        one thread prunes at a time, and the others carry on.
+        """
+        if not self.prune_lock.acquire(blocking=False):
+            return
+        try:
+            files = []
+            for dir_entry in os.scandir(self.cache_dir):
+                if not dir_entry.name.endswith(".arrays"):
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except FileNotFoundError:
+                    # Removed by another process since it was listed
+                    continue
+                files.append((stat.st_mtime, stat.st_size, dir_entry.path))
+
+            total = sum(size for _, size, _ in files)
+            if total > self.max_disk_bytes:
+                for _, size, filepath in sorted(files):
+                    if total <= target * self.max_disk_bytes:
+                        break
+                    Path(filepath).unlink(missing_ok=True)
+                    total -= size
+
+            with self.lock:
+                self.disk_bytes = total
+        finally:
+            self.prune_lock.release()
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+        if self.cache_dir is not None:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".arrays"):
+                    (self.cache_dir / name).unlink(missing_ok=True)
+            with self.lock:
+                self.disk_bytes = 0
+
+
+def file_size(filepath):
+    try:
+        return os.path.getsize(filepath)
+    except FileNotFoundError:
+        return 0
+
+
+def compress(travel_times):
+    reached = np.isfinite(travel_times)
+    return (travel_times.shape[0],
+            np.packbits(reached),
+            travel_times[reached])
+
+
+def expand(num_nodes, reached, times):
+    reached = np.unpackbits(reached, count=num_nodes).astype(bool)
+    travel_times = np.full(num_nodes, np.inf)
+    travel_times[reached] = times
+    return travel_times
+
+
+# One cache per process, shared by every isochrone that asks for it
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = IsochroneCache()
+    return _default_cache
@@ -0,0 +1,213 @@
+"""
+A timetable router, for isochrones that leave at a particular time of day.
+
+The transit graph averages the schedule away: every ride takes the route's
+average time and every wait is half the stop's average headway. A
+`Timetable` keeps the schedule itself, as every hop of every trip from one
+stop to the next, sorted by departure time. These are the connections of the
+Connection Scan Algorithm (Dibbelt et al.), which finds the earliest arrival
+at every stop with a single pass over them in order: a connection can be
+taken if its trip has already been boarded, or if its stop has been reached
+by the time it leaves.
+
+Only connections leaving between the departure and the end of the trip time
+are scanned, which for an hour-long isochrone is a small slice of the day.
+
+Transfers are the walks between stops of at most `MAX_TRANSFER_TIME`, the
+same limit the `StopTable` uses. They're shortest walks, so any chain of
+transfers that adds up to less than the limit is already a single transfer,
+and a stop reached by walking doesn't need to pass that on. A chain that
+adds up to more, or a longer walk between two rides, isn't found, though the
+transit graph, which lets a search walk any distance, may find it. Walks at
+either end of a trip can be as long as the trip allows.
+"""
+import numpy as np
+import pandas as pd
+from scipy.sparse.csgraph import dijkstra
+
+from src.artifacts import save_artifact, load_artifact
+from src.csr_graph import csr_arrays
+from src.stop_table import transfer_edges, MAX_TRANSFER_TIME
+from src.gtfs import seconds_since_midnight
+
+
+class Timetable:
+    """
+    Connections between the graph nodes transit stops sit on, as int32
+    arrays sorted by departure time in seconds since midnight, plus the
+    walking transfers between nearby stops in CSR form. Stops are referred to
+    by their position in `stop_nodes`, which are themselves positions in the
+    `CSRGraph` the timetable was built against.
+    """
+    def __init__(self, stop_nodes, departure_stops, arrival_stops,
+                 departure_times, arrival_times, trips, transfer_indptr,
+                 transfer_indices, transfer_times, metadata=None):
+        self.stop_nodes = np.asarray(stop_nodes, dtype=np.int32)
+        self.departure_stops = np.asarray(departure_stops, dtype=np.int32)
+        self.arrival_stops = np.asarray(arrival_stops, dtype=np.int32)
+        self.departure_times = np.asarray(departure_times, dtype=np.int32)
+        self.arrival_times = np.asarray(arrival_times, dtype=np.int32)
+        self.trips = np.asarray(trips, dtype=np.int32)
+        self.transfer_indptr = np.asarray(transfer_indptr, dtype=np.int32)
+        self.transfer_indices = np.asarray(transfer_indices, dtype=np.int32)
+        self.transfer_times = np.asarray(transfer_times, dtype=np.float32)
+        self.metadata = dict(metadata or {})
+        self._transfers = None
+
+
+    @classmethod
+    def from_stop_times(cls, stop_times, stop_id_to_graph_id, csr_graph,
+                        max_transfer_time=MAX_TRANSFER_TIME):
+        """
+        From the cleaned `stop_times` table, with its arrival and departure
+        times in seconds since midnight. Stops that aren't on the graph are 
+        skipped over, so a trip rides straight from the stop before to the 
+        stop after.
+        """
+        stop_times = stop_times.sort_values(by=["trip_id", "stop_sequence"])
+        stop_times = stop_times.drop_duplicates(subset=["trip_id", "stop_id"], keep="first")
+        graph_ids = stop_times["stop_id"].map(stop_id_to_graph_id)
+        graph_ids = graph_ids.fillna(-1).values.astype(np.int64)
+        on_graph = csr_graph.contains(graph_ids)
+        stop_times = stop_times[on_graph]
+
+        nodes = csr_graph.index_of(graph_ids[on_graph])
+        trips, _ = pd.factorize(stop_times["trip_id"])
+        departures = seconds_since_midnight(stop_times["departure_time"])
+        arrivals = seconds_since_midnight(stop_times["arrival_time"])
+
+        # One connection from each stop to the next along the same trip
+        hop = trips[1:] == trips[:-1]
+        departure_nodes, arrival_nodes = nodes[:-1][hop], nodes[1:][hop]
+        departure_times, arrival_times = departures[:-1][hop], arrivals[1:][hop]
+        trips = trips[:-1][hop]
+        keep = (arrival_times >= departure_times) & (departure_nodes != arrival_nodes)
+
+        stop_nodes = np.union1d(departure_nodes[keep], arrival_nodes[keep])
+        order = np.lexsort((arrival_times[keep], departure_times[keep]))
+        transfers = transfer_edges(csr_graph, stop_nodes, max_transfer_time)
+        transfer_indptr, transfer_indices, transfer_times = csr_arrays(
+            transfers[0], transfers[1], transfers[2] * 60, stop_nodes.shape[0])
+
+        metadata = {
+            "graph_version":        csr_graph.version,
+            "service_date":         csr_graph.metadata.get("service_date"),
+            "max_transfer_time":    max_transfer_time,
+        }
+        return cls(stop_nodes,
+                   np.searchsorted(stop_nodes, departure_nodes[keep][order]),
+                   np.searchsorted(stop_nodes, arrival_nodes[keep][order]),
+                   departure_times[keep][order], arrival_times[keep][order],
+                   trips[keep][order], transfer_indptr, transfer_indices,
+                   transfer_times, metadata)
+
+
+    ARRAYS = ["stop_nodes", "departure_stops", "arrival_stops", "departure_times",
+              "arrival_times", "trips", "transfer_indptr", "transfer_indices",
+              "transfer_times"]
+
+
+    def save(self, filepath):
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        save_artifact(filepath, arrays, self.metadata)
+
+
+    @classmethod
+    def load(cls, filepath, mmap=True):
+        arrays, metadata = load_artifact(filepath, mmap=mmap)
+        return cls(metadata=metadata, **arrays)
+
+
+    @property
+    def num_trips(self):
+        return int(self.trips.max()) + 1 if self.trips.shape[0] else 0
+
+
+    def transfers(self):
+        """Transfers from each stop as Python lists, which the scan reads fastest"""
+        if self._transfers is None:
+            indices = self.transfer_indices.tolist()
+            times = self.transfer_times.tolist()
+            indptr = self.transfer_indptr.tolist()
+            self._transfers = [list(zip(indices[start:end], times[start:end]))
+                               for start, end in zip(indptr[:-1], indptr[1:])]
+        return self._transfers
+
+
+    def earliest_arrivals(self, start_times, departure_time, max_time):
+        """
+        The Connection Scan. `start_times` are the times, in seconds since
+        midnight, at which each stop can be reached without transit, infinite
+        where it can't. Returns the earliest arrival at every stop by
+        `departure_time + max_time`.
+        """
+        end_time = departure_time + max_time
+        first = np.searchsorted(self.departure_times, departure_time, side="left")
+        last = np.searchsorted(self.departure_times, end_time, side="right")
+
+        arrivals = np.asarray(start_times, dtype=np.float64).tolist()
+        transfers = self.transfers()
+        boarded = bytearray(self.num_trips)
+        connections = zip(
+            self.departure_stops[first:last].tolist(),
+            self.arrival_stops[first:last].tolist(),
+            self.departure_times[first:last].tolist(),
+            self.arrival_times[first:last].tolist(),
+            self.trips[first:last].tolist())
+
+        for departure_stop, arrival_stop, departs, arrives, trip in connections:
+            if boarded[trip] or arrivals[departure_stop] <= departs:
+                boarded[trip] = 1
+                if arrives < arrivals[arrival_stop] and arrives <= end_time:
+                    arrivals[arrival_stop] = arrives
+                    for stop, walk in transfers[arrival_stop]:
+                        if arrives + walk < arrivals[stop]:
+                            arrivals[stop] = arrives + walk
+        return np.array(arrivals)
+
+
+    def travel_times_from(self, csr_graph, source, departure_time, cutoff,
+                          walking_times=None):
+        """
+        Travel times in minutes from the node at position `source`, leaving
+        at `departure_time` seconds since midnight, to every node of
+        `csr_graph`, infinite past `cutoff`.
+        """
+        if walking_times is None:
+            walking_times = dijkstra(csr_graph.matrix(), directed=True,
+                                     indices=source, limit=cutoff)
+        start_times = departure_time + walking_times[self.stop_nodes] * 60
+        arrivals = self.earliest_arrivals(start_times, departure_time, cutoff * 60)
+        arrivals = (arrivals - departure_time) / 60
+        return csr_graph.walk_onward(walking_times, self.stop_nodes, arrivals, cutoff)
+
+
+    def profile(self, csr_graph, source, departure_times, cutoff):
+        """
+        Travel times for each of `departure_times`, one row per departure.
+        The walk from `source` is the same every time, so it is searched once.
+        """
+        walking_times = dijkstra(csr_graph.matrix(), directed=True,
+                                 indices=source, limit=cutoff)
+        return np.vstack([
+            self.travel_times_from(csr_graph, source, departure_time, cutoff,
+                                   walking_times=walking_times)
+            for departure_time in departure_times])
+
+
+def clock_seconds(clock_time):
+    """
+    Seconds since midnight for "HH:MM" or "HH:MM:SS", or seconds as is. Times
+    are on the service day's clock, as in GTFS, so departures after midnight
+    are given as "24:30" rather than "00:30".
+    """
+    if isinstance(clock_time, str):
+        parts = [int(part) for part in clock_time.split(":")]
+        parts += [0] * (3 - len(parts))
+        return parts[0] * 3600 + parts[1] * 60 + parts[2]
+    return int(clock_time)
+
+
+def departure_window(start, end, step_minutes=5):
+    """Departure times every `step_minutes` from `start` up to `end`"""
+    return np.arange(clock_seconds(start), clock_seconds(end) + 1, step_minutes * 60)
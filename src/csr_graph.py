@@ -0,0 +1,419 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from src.artifacts import save_artifact, load_artifact, arrays_checksum
+
+
+# Routing matrices with transit kept per graph, for the frequencies and hours
+# searched most recently. Each is about the size of the graph's edges.
+MAX_TRANSIT_MATRICES = 4
+
+
+class CSRGraph:
+    """
+    A compact, array-backed copy of the citywide walking graph and, optionally,
+    the transit graph laid over it. Nodes are stored as sorted OSM IDs and
+    referred to everywhere else by their int32 position in that array. Edges
+    are stored in compressed sparse row (CSR) form with float32 travel times,
+    which is what `scipy.sparse.csgraph` searches.
+
+    Transit edges are stored separately, as their wait times and riding times,
+    and are only folded into a routing matrix once a frequency multiplier is
+    known. The graph's arrays aren't modified after construction, so one
+    instance can be shared by every isochrone. Only routing matrices are
+    added as it's searched: the walking one, and one for each of the last
+    `MAX_TRANSIT_MATRICES` frequencies and hours searched.
+
+    Wait times default to the average over the whole day. The number of
+    arrivals at each stop in each hour is kept too, as a float32 array with
+    a row per stop, and `transit_stops` gives each transit edge's row, so
+    wait times for any hours of the day are a slice of that array.
+    """
+    def __init__(self, node_ids, node_x, node_y, indptr, indices, travel_times,
+                 transit_origins=None, transit_destinations=None,
+                 wait_times=None, transit_travel_times=None, transit_stops=None,
+                 hourly_stop_ids=None, hourly_arrivals=None):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.node_x = np.asarray(node_x, dtype=np.float64)
+        self.node_y = np.asarray(node_y, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.travel_times = np.asarray(travel_times, dtype=np.float32)
+
+        if transit_origins is None:
+            transit_origins = transit_destinations = np.array([], dtype=np.int32)
+            wait_times = transit_travel_times = np.array([], dtype=np.float32)
+        self.transit_origins = np.asarray(transit_origins, dtype=np.int32)
+        self.transit_destinations = np.asarray(transit_destinations, dtype=np.int32)
+        self.wait_times = np.asarray(wait_times, dtype=np.float32)
+        self.transit_travel_times = np.asarray(transit_travel_times, dtype=np.float32)
+
+        # Arrivals per stop and hour, and the stop each transit edge leaves from
+        if hourly_arrivals is None:
+            transit_stops = np.array([], dtype=np.int32)
+            hourly_stop_ids = np.array([], dtype=np.int64)
+            hourly_arrivals = np.zeros((0, 24), dtype=np.float32)
+        self.transit_stops = np.asarray(transit_stops, dtype=np.int32)
+        self.hourly_stop_ids = np.asarray(hourly_stop_ids)
+        self.hourly_arrivals = np.asarray(hourly_arrivals, dtype=np.float32)
+        self._transit_stop_ids = None
+
+        # GTFS stop IDs and the position of the graph node each one sits on
+        self.stop_ids = np.array([], dtype=np.int64)
+        self.stop_nodes = np.array([], dtype=np.int32)
+
+        self.metadata = {}
+        self._walking_matrix = None
+        self._matrices = OrderedDict()
+        self._matrices_lock = threading.Lock()
+
+
+    @classmethod
+    def from_networkx(cls, walking_graph, transit_graph=None):
+        """
+        Build from the walking graph made by `graphs.download_citywide_graph`
+        and, optionally, the transit graph made by
+        `gtfs.build_and_save_transit_graph`. Parallel walking edges keep the
+        quickest travel time, as networkx does when searching a multigraph.
+        """
+        node_ids = np.array(sorted(walking_graph.nodes), dtype=np.int64)
+        node_x = np.array([walking_graph.nodes[node]["x"] for node in node_ids.tolist()])
+        node_y = np.array([walking_graph.nodes[node]["y"] for node in node_ids.tolist()])
+
+        edges = list(walking_graph.edges(data="travel_time"))
+        origins = np.searchsorted(node_ids, [edge[0] for edge in edges])
+        destinations = np.searchsorted(node_ids, [edge[1] for edge in edges])
+        weights = np.array([edge[2] for edge in edges], dtype=np.float32)
+        indptr, indices, travel_times = csr_arrays(origins, destinations,
+                                                   weights, len(node_ids))
+
+        graph = cls(node_ids, node_x, node_y, indptr, indices, travel_times)
+        if transit_graph is not None:
+            graph.set_transit_edges(transit_graph)
+        return graph
+
+
+    def set_transit_edges(self, transit_graph):
+        """
+        Transit edges between stops that aren't on the walking graph can
+        never be reached, so they are dropped.
+        """
+        edges = [(orig, dest, data["wait_time"], data["transit_travel_time"],
+                  data.get("origin_stop_id"))
+                 for orig, dest, data in transit_graph.edges(data=True)]
+        origins = np.array([edge[0] for edge in edges], dtype=np.int64)
+        destinations = np.array([edge[1] for edge in edges], dtype=np.int64)
+        on_graph = self.contains(origins) & self.contains(destinations)
+
+        self.transit_origins = self.index_of(origins[on_graph])
+        self.transit_destinations = self.index_of(destinations[on_graph])
+        self.wait_times = np.array([edge[2] for edge in edges], dtype=np.float32)[on_graph]
+        self.transit_travel_times = np.array([edge[3] for edge in edges], dtype=np.float32)[on_graph]
+        self._transit_stop_ids = [edge[4] for edge, keep in zip(edges, on_graph) if keep]
+        self.clear_matrices()
+
+
+    def set_hourly_arrivals(self, stop_ids, hourly_arrivals):
+        """
+        Keep the arrivals per stop and hour made by 
+        `gtfs.average_arrival_rates_per_stop`, with `stop_ids` sorted. Each 
+        transit edge is matched to its stop by the `origin_stop_id` the 
+        transit graph labels it with.
+        """
+        if self._transit_stop_ids is None or None in self._transit_stop_ids:
+            raise ValueError("The transit graph doesn't say which stop each edge leaves from. Rebuild it with gtfs.build_and_save_transit_graph.")
+        stop_ids = np.asarray(stop_ids)
+        transit_stops = np.searchsorted(stop_ids, self._transit_stop_ids)
+        transit_stops = np.minimum(transit_stops, stop_ids.shape[0] - 1)
+        if not np.all(stop_ids[transit_stops] == self._transit_stop_ids):
+            raise KeyError("A transit edge leaves from a stop with no arrivals.")
+        self.transit_stops = transit_stops.astype(np.int32)
+        self.hourly_stop_ids = stop_ids
+        self.hourly_arrivals = np.asarray(hourly_arrivals, dtype=np.float32)
+        self.clear_matrices()
+
+
+    def set_stops(self, stop_id_to_graph_id):
+        """Keep the mapping from GTFS stop IDs to graph nodes alongside the graph"""
+        stop_ids = np.array(list(stop_id_to_graph_id.keys()))
+        graph_ids = np.array(list(stop_id_to_graph_id.values()), dtype=np.int64)
+        on_graph = self.contains(graph_ids)
+        self.stop_ids = stop_ids[on_graph]
+        self.stop_nodes = self.index_of(graph_ids[on_graph])
+
+
+    ARRAYS = ["node_ids", "node_x", "node_y", "indptr", "indices", 
+              "travel_times", "transit_origins", "transit_destinations", 
+              "wait_times", "transit_travel_times", "transit_stops", 
+              "hourly_stop_ids", "hourly_arrivals", "stop_ids", "stop_nodes"]
+
+
+    def to_arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+
+    @classmethod
+    def from_arrays(cls, arrays, metadata=None):
+        # Graphs saved before arrivals were kept per hour have no hourly arrays
+        stops = ["stop_ids", "stop_nodes"]
+        graph = cls(**{name: arrays[name] for name in cls.ARRAYS 
+                       if name not in stops and name in arrays})
+        graph.stop_ids = arrays["stop_ids"]
+        graph.stop_nodes = arrays["stop_nodes"]
+        graph.metadata = dict(metadata or {})
+        return graph
+
+
+    @property
+    def version(self):
+        """A fingerprint of the graph's contents, stored when it is saved"""
+        if "graph_version" not in self.metadata:
+            self.metadata["graph_version"] = arrays_checksum(self.to_arrays())
+        return self.metadata["graph_version"]
+
+
+    def save(self, filepath, **metadata):
+        arrays = self.to_arrays()
+        self.metadata.update(metadata)
+        self.metadata["graph_version"] = arrays_checksum(arrays)
+        save_artifact(filepath, arrays, self.metadata)
+
+
+    @classmethod
+    def load(cls, filepath, mmap=True):
+        """
+        Memory-mapped by default, so the arrays are read-only and only the 
+        pages a search touches are read from disk.
+        """
+        arrays, metadata = load_artifact(filepath, mmap=mmap)
+        return cls.from_arrays(arrays, metadata)
+
+
+    @property
+    def num_nodes(self):
+        return self.node_ids.shape[0]
+
+
+    def contains(self, node_ids):
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        positions = np.searchsorted(self.node_ids, node_ids)
+        positions = np.minimum(positions, self.num_nodes - 1)
+        return self.node_ids[positions] == node_ids
+
+
+    def index_of(self, node_ids):
+        """Map one or many OSM node IDs to their int32 positions"""
+        if not np.all(self.contains(node_ids)):
+            raise KeyError("Node ID is not in the graph.")
+        positions = np.searchsorted(self.node_ids, node_ids)
+        return positions.astype(np.int32)
+
+
+    def wait_times_for(self, hours=None):
+        """
+        The wait for each transit edge, in minutes. With `hours`, an hour of 
+        the day or a (start, end) pair of them with the end excluded, it is the 
+        average time between arrivals at the edge's stop over those hours 
+        instead of over the whole day. Stops with no arrivals in those hours 
+        have an infinite wait.
+        """
+        if hours is None:
+            return self.wait_times
+        if self.hourly_arrivals.shape[0] == 0:
+            raise ValueError("The graph has no arrivals per hour. Run create_transit_graph.py to rebuild it.")
+        start, end = hour_window(hours)
+        arrivals_per_hour = self.hourly_arrivals[:, start:end].sum(axis=1) / (end - start)
+        with np.errstate(divide="ignore"):
+            wait_times = (60 / arrivals_per_hour).astype(np.float32)
+        return wait_times[self.transit_stops]
+
+
+    def transit_weights(self, freq_multiplier, hours=None):
+        """What each transit edge costs at `freq_multiplier`: its wait, scaled, plus its ride"""
+        transit_weights = self.wait_times_for(hours) / np.float32(freq_multiplier)
+        transit_weights += self.transit_travel_times
+        return transit_weights
+
+
+    def matrix(self, freq_multiplier=None, hours=None):
+        """
+        The sparse routing matrix. With no frequency multiplier this is the
+        walking graph alone. Otherwise each transit edge costs
+        `wait_time / freq_multiplier + transit_travel_time` and, where it runs
+        parallel to a walking edge, the quicker of the two is kept. With 
+        `hours`, wait times are those for that window of the day, and edges 
+        from stops with no service in it are left out. The walking matrix is 
+        kept, and so are the `MAX_TRANSIT_MATRICES` others used most recently.
+        """
+        shape = (self.num_nodes, self.num_nodes)
+        if freq_multiplier is None or self.transit_origins.shape[0] == 0:
+            if self._walking_matrix is None:
+                self._walking_matrix = csr_matrix(
+                    (self.travel_times, self.indices, self.indptr), shape=shape)
+            return self._walking_matrix
+
+        key = (float(freq_multiplier), hours)
+        with self._matrices_lock:
+            matrix = self._matrices.get(key)
+            if matrix is not None:
+                self._matrices.move_to_end(key)
+                return matrix
+
+        walking_origins = np.repeat(
+            np.arange(self.num_nodes, dtype=np.int32),
+            np.diff(self.indptr))
+        transit_weights = self.transit_weights(freq_multiplier, hours)
+        running = np.isfinite(transit_weights)
+        indptr, indices, weights = csr_arrays(
+            np.concatenate([walking_origins, self.transit_origins[running]]),
+            np.concatenate([self.indices, self.transit_destinations[running]]),
+            np.concatenate([self.travel_times, transit_weights[running]]),
+            self.num_nodes)
+        matrix = csr_matrix((weights, indices, indptr), shape=shape)
+
+        with self._matrices_lock:
+            self._matrices[key] = matrix
+            while len(self._matrices) > MAX_TRANSIT_MATRICES:
+                self._matrices.popitem(last=False)
+        return matrix
+
+
+    def clear_matrices(self):
+        with self._matrices_lock:
+            self._matrices.clear()
+
+
+    def travel_times_from(self, source, cutoff=None, freq_multiplier=None,
+                          hours=None):
+        """
+        One search from the node at position `source`. Returns an array with
+        the travel time in minutes to every node, and infinity for nodes that
+        can't be reached within `cutoff`.
+        """
+        limit = np.inf if cutoff is None else cutoff
+        return dijkstra(self.matrix(freq_multiplier, hours),
+            directed=True, indices=source, limit=limit)
+
+
+    def walk_onward(self, walking_times, nodes, arrivals, cutoff):
+        """
+        Given the walking times from an origin and the times at which transit 
+        reaches `nodes`, the quickest time to every node walking on from 
+        wherever transit got to sooner than walking. An extra node with an 
+        edge to each of those nodes starts them all in one search, each at 
+        the time it is reached.
+        """
+        seeds = (arrivals <= cutoff) & (arrivals < walking_times[nodes])
+        if not seeds.any():
+            return walking_times
+        walking = self.matrix()
+        num_seeds = int(seeds.sum())
+        matrix = csr_matrix((
+                np.concatenate([walking.data, arrivals[seeds]]),
+                np.concatenate([walking.indices, nodes[seeds]]),
+                np.append(walking.indptr, walking.nnz + num_seeds)),
+            shape=(self.num_nodes + 1, self.num_nodes + 1))
+        transit_times = dijkstra(matrix, directed=True, indices=self.num_nodes,
+                                 limit=cutoff)[:self.num_nodes]
+        return np.minimum(walking_times, transit_times)
+
+
+    def search(self, source_node, cutoff=None, freq_multiplier=None, cache=None,
+               service_date=None, stop_table=None, timetable=None, 
+               departure_time=None, hours=None):
+        """
+        One search from the node with OSM ID `source_node`, returning the 
+        array of travel times to every node. With an `IsochroneCache`, a 
+        search that has been run before is read from the cache instead. With 
+        a `StopTable` that covers the trip time and frequency, transit is 
+        looked up in the table rather than searched. With a `departure_time`, 
+        in seconds since midnight, transit follows the `timetable` instead 
+        and the frequency multiplier doesn't apply. With `hours`, a departure 
+        hour or a (start, end) window of them, wait times are those for that 
+        time of day; the stop table only holds all-day waits, so it is skipped.
+        """
+        source = self.index_of(source_node)
+        version = self.version
+        hours = hour_window(hours)
+        if departure_time is not None:
+            if timetable is None:
+                raise ValueError("A departure time needs a timetable to search.")
+            freq_multiplier = hours = None
+            search = lambda: timetable.travel_times_from(self, source, 
+                                                         departure_time, cutoff)
+        elif (hours is None and stop_table is not None 
+              and stop_table.covers(cutoff, freq_multiplier)):
+            version = stop_table.version
+            search = lambda: stop_table.travel_times_from(self, source, cutoff,
+                                                          freq_multiplier)
+        else:
+            search = lambda: self.travel_times_from(source, cutoff, freq_multiplier,
+                                                    hours)
+
+        if cache is None:
+            return search()
+
+        key = cache.key(version, source_node, cutoff, freq_multiplier,
+                        service_date, departure_time, hours)
+        travel_times = cache.get(key)
+        if travel_times is None:
+            travel_times = search()
+            cache.put(key, travel_times)
+        return travel_times
+
+
+    def single_source_travel_times(self, source_node, cutoff=None,
+                                   freq_multiplier=None, cache=None,
+                                   service_date=None):
+        """
+        The same search as a dictionary of travel times for every node 
+        reachable within `cutoff`, keyed by OSM node ID. This matches the 
+        output of `nx.single_source_dijkstra_path_length`.
+        """
+        travel_times = self.search(source_node, cutoff, freq_multiplier, cache,
+                                   service_date)
+        return self.as_dict(travel_times)
+
+
+    def as_dict(self, travel_times):
+        """Travel times to reachable nodes, keyed by OSM node ID"""
+        reached = np.flatnonzero(np.isfinite(travel_times))
+        return dict(zip(self.node_ids[reached].tolist(),
+                        travel_times[reached].tolist()))
+
+
+def hour_window(hours):
+    """
+    A (start, end) pair of hours, with the end excluded, from a single hour 
+    of the day or a pair of them
+    """
+    if hours is None:
+        return None
+    if np.isscalar(hours):
+        return (int(hours), int(hours) + 1)
+    start, end = hours
+    if end <= start:
+        raise ValueError("A window of hours must end after it starts.")
+    return (int(start), int(end))
+
+
+def csr_arrays(origins, destinations, weights, num_nodes):
+    """
+    Sort an edge list into CSR arrays. `scipy.sparse` would sum duplicate
+    edges, so only the smallest weight between any two nodes is kept.
+    """
+    order = np.lexsort((weights, destinations, origins))
+    origins, destinations = origins[order], destinations[order]
+    weights = weights[order]
+
+    first = np.ones(origins.shape[0], dtype=bool)
+    first[1:] = (origins[1:] != origins[:-1]) | (destinations[1:] != destinations[:-1])
+    origins, destinations, weights = origins[first], destinations[first], weights[first]
+
+    indptr = np.zeros(num_nodes + 1, dtype=np.int32)
+    np.cumsum(np.bincount(origins, minlength=num_nodes), out=indptr[1:])
+    return indptr, destinations.astype(np.int32), weights.astype(np.float32)
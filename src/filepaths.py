@@ -3,6 +3,7 @@ from pathlib import Path
 REPO_ROOT_DIR = Path(__file__).parent.parent
 DATA_DIR = REPO_ROOT_DIR / "data"
 GTFS_PATH = DATA_DIR / "gtfs_raw/chicago"
+GTFS_ZIP_PATH = DATA_DIR / "gtfs_raw/chicago.zip"
 
 FREQUENCY_DIR = REPO_ROOT_DIR / "user_generated_frequency_maps"
 FREQUENCY_DIR.mkdir(parents=True, exist_ok=True)
\ No newline at end of file
@@ -0,0 +1,188 @@
+"""
+How far you can get as a function of how often the buses come.
+
+Each transit edge costs its wait divided by the frequency multiplier plus its
+ride, so running buses more often can only make trips quicker, and the set of
+nodes reached within a trip time only grows as the multiplier does. A
+`FrequencySweep` uses that to find, for one origin and trip time, the
+smallest multiplier on a grid at which each node is reached, without
+searching once per multiplier from scratch.
+
+The first search runs at the highest multiplier. Nothing it doesn't reach can
+be reached at any lower one, and neither can any shortest path run through
+it, so every search after that only covers the nodes it reached. Those
+searches bisect the grid: a search at the middle of a stretch of multipliers
+settles which half each node still in doubt belongs to, and stretches with
+no nodes left in doubt are never searched again.
+
+Any number of frequency maps, or the curve of reach against frequency, then
+come from one sweep.
+"""
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+
+# The range of multipliers swept by default, and the step between them, as
+# a fraction of the multiplier
+LOW_MULTIPLIER = 0.25
+HIGH_MULTIPLIER = 4.0
+RESOLUTION = 0.05
+
+
+def sweep_multipliers(low=LOW_MULTIPLIER, high=HIGH_MULTIPLIER, resolution=RESOLUTION):
+    """Multipliers from `low` to `high`, each at most `resolution` more than the last"""
+    if not 0 < low < high:
+        raise ValueError("Multipliers must be positive, with the low end below the high end.")
+    num_multipliers = int(np.ceil(np.log(high / low) / np.log1p(resolution))) + 1
+    return np.geomspace(low, high, num_multipliers)
+
+
+class FrequencySweep:
+    """
+    `thresholds` holds, for every node of the graph, the smallest of
+    `multipliers` at which it can be reached within `trip_time`, or infinity
+    if it can't be reached even at the highest. A node is in the isochrone
+    at a multiplier if its threshold is no more than that multiplier, which
+    is exactly what a search at any multiplier on the grid would find.
+    """
+    def __init__(self, multipliers, thresholds, trip_time, num_searches):
+        self.multipliers = multipliers
+        self.thresholds = thresholds
+        self.trip_time = trip_time
+        self.num_searches = num_searches
+
+
+    @classmethod
+    def run(cls, csr_graph, source_node, trip_time, freq_multipliers=None,
+            hours=None, cache=None, service_date=None, stop_table=None):
+        """
+        Sweeps `freq_multipliers`, by default those from `sweep_multipliers`,
+        from the node with OSM ID `source_node`. With `hours`, wait times are
+        those for that window of the day. The first search, at the highest
+        multiplier, goes through `CSRGraph.search` and so can be answered
+        from `cache` or `stop_table`.
+        """
+        if freq_multipliers is None:
+            freq_multipliers = sweep_multipliers()
+        multipliers = np.unique(np.asarray(freq_multipliers, dtype=np.float64))
+        if multipliers.shape[0] == 0 or multipliers[0] <= 0:
+            raise ValueError("A sweep needs at least one multiplier, all of them positive.")
+
+        travel_times = csr_graph.search(source_node, trip_time, multipliers[-1],
+            cache=cache, service_date=service_date, stop_table=stop_table,
+            hours=hours)
+        nodes = np.flatnonzero(travel_times <= trip_time)
+        graph = ParametricGraph(csr_graph, nodes, hours)
+        source = int(np.searchsorted(nodes, csr_graph.index_of(source_node)))
+        num_searches = 1
+
+        def reached(ii):
+            travel_times = graph.travel_times_from(source, trip_time, multipliers[ii])
+            return travel_times <= trip_time
+
+        # The position in `multipliers` of each node's threshold
+        first = np.full(nodes.shape[0], multipliers.shape[0] - 1)
+        if multipliers.shape[0] > 1:
+            at_lowest = reached(0)
+            num_searches += 1
+            first[at_lowest] = 0
+
+            # Stretches of the grid, each with the nodes reached at its top but
+            # not its bottom
+            stretches = [(0, multipliers.shape[0] - 1, np.flatnonzero(~at_lowest))]
+            while stretches:
+                low, high, in_doubt = stretches.pop()
+                if in_doubt.shape[0] == 0:
+                    continue
+                if high - low == 1:
+                    first[in_doubt] = high
+                    continue
+                middle = (low + high) // 2
+                at_middle = reached(middle)[in_doubt]
+                num_searches += 1
+                stretches.append((low, middle, in_doubt[at_middle]))
+                stretches.append((middle, high, in_doubt[~at_middle]))
+
+        thresholds = np.full(csr_graph.num_nodes, np.inf)
+        thresholds[nodes] = multipliers[first]
+        return cls(multipliers, thresholds, trip_time, num_searches)
+
+
+    def reached(self, freq_multiplier):
+        """
+        Whether each node is reached at `freq_multiplier`. Between two
+        multipliers of the grid, that's what was reached at the lower one.
+        """
+        return self.thresholds <= freq_multiplier
+
+
+    def reach_curve(self):
+        """The number of nodes reached at each of `multipliers`"""
+        thresholds = np.sort(self.thresholds[np.isfinite(self.thresholds)])
+        return self.multipliers, np.searchsorted(thresholds, self.multipliers, side="right")
+
+
+class ParametricGraph:
+    """
+    The walking and transit edges between `nodes`, positions in a
+    `CSRGraph`, sorted into rows once, so a routing matrix for any multiplier
+    needs no sorting, only the transit edges' weights from
+    `CSRGraph.transit_weights` and one minimum per pair of nodes. Weights are
+    the same float32 values the full graph's `matrix` uses.
+    """
+    def __init__(self, csr_graph, nodes, hours=None):
+        self.csr_graph = csr_graph
+        self.hours = hours
+        positions = np.full(csr_graph.num_nodes, -1, dtype=np.int32)
+        positions[nodes] = np.arange(nodes.shape[0], dtype=np.int32)
+        self.num_nodes = nodes.shape[0]
+
+        walking_origins = positions[np.repeat(
+            np.arange(csr_graph.num_nodes, dtype=np.int32), np.diff(csr_graph.indptr))]
+        walking_destinations = positions[csr_graph.indices]
+        walking = (walking_origins >= 0) & (walking_destinations >= 0)
+        self.walking_costs = csr_graph.travel_times[walking]
+
+        transit_origins = positions[csr_graph.transit_origins]
+        transit_destinations = positions[csr_graph.transit_destinations]
+        self.transit_edges = np.flatnonzero((transit_origins >= 0) & (transit_destinations >= 0))
+
+        origins = np.concatenate([walking_origins[walking],
+                                  transit_origins[self.transit_edges]])
+        destinations = np.concatenate([walking_destinations[walking],
+                                       transit_destinations[self.transit_edges]])
+        self.order = np.lexsort((destinations, origins))
+        origins, destinations = origins[self.order], destinations[self.order]
+
+        # Parallel edges are grouped, and only the quickest of each is kept
+        first = np.ones(origins.shape[0], dtype=bool)
+        first[1:] = (origins[1:] != origins[:-1]) | (destinations[1:] != destinations[:-1])
+        self.starts = np.flatnonzero(first)
+        self.origins = origins[self.starts]
+        self.destinations = destinations[self.starts]
+
+
+    def matrix(self, freq_multiplier):
+        transit_weights = self.csr_graph.transit_weights(freq_multiplier, self.hours)
+        weights = np.concatenate([self.walking_costs,
+                                  transit_weights[self.transit_edges]])[self.order]
+        origins, destinations = self.origins, self.destinations
+        if self.starts.shape[0] > 0:
+            weights = np.minimum.reduceat(weights, self.starts)
+
+        # Stops with no service in the hours swept
+        running = np.isfinite(weights)
+        if not running.all():
+            origins, destinations = origins[running], destinations[running]
+            weights = weights[running]
+
+        indptr = np.zeros(self.num_nodes + 1, dtype=np.int32)
+        np.cumsum(np.bincount(origins, minlength=self.num_nodes), out=indptr[1:])
+        return csr_matrix((weights, destinations, indptr),
+                          shape=(self.num_nodes, self.num_nodes))
+
+
+    def travel_times_from(self, source, cutoff, freq_multiplier):
+        return dijkstra(self.matrix(freq_multiplier), directed=True,
+                        indices=source, limit=cutoff)
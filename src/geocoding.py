@@ -0,0 +1,279 @@
+"""
+Addresses to coordinates, remembered so each one is only looked up once.
+
+Drawing a map from an address used to geocode it with Nominatim three
+times, once to check it could be found, once to check it's in Chicago and
+once more to draw the map, and every map drawn on a shared axis geocoded the
+city's boundary again. A `Geocoder` asks its backend once per address and
+keeps the answer in memory and in a small sqlite database, so it outlives the
+process. Addresses that couldn't be found are remembered too, for a day
+(`NOT_FOUND_SECONDS`), then asked about again. City
+boundaries are kept as files of well-known binary.
+
+Addresses are normalized before they're looked up, so "626 W. Jackson Blvd,
+Chicago IL" and "626 w jackson blvd chicago il" are one entry.
+
+The backend is anything with `geocode(address)`, which returns (lat, lng) or
+raises ValueError like osmnx does when there's no match, and
+`boundary(place)`, which returns a shapely polygon. `NominatimBackend` asks
+Nominatim through osmnx. `AddressTable` answers from a CSV of addresses and
+a folder of boundaries, for working offline and for the benchmarks. If the
+`GEOCODER_TABLE` environment variable names such a CSV, the default
+geocoder uses it instead of the network.
+"""
+import os
+import re
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+import pandas as pd
+import osmnx as ox
+from shapely import wkb
+from shapely.geometry import MultiPolygon
+
+from src.utils import atomic_write
+from src.tracing import span
+from src.filepaths import DATA_DIR
+
+
+GEOCODE_DIR = DATA_DIR / "geocoding"
+GEOCODE_DB_PATH = GEOCODE_DIR / "addresses.sqlite"
+BOUNDARY_DIR = GEOCODE_DIR / "boundaries"
+
+GEOCODER_TABLE = os.environ.get("GEOCODER_TABLE")
+
+# Seconds an address that couldn't be found is remembered for before asking
+# again, in case the answer was a hiccup or the map has been filled in since
+NOT_FOUND_SECONDS = 24 * 60 * 60
+
+
+def normalize_address(address):
+    """Lowercase, without periods, and with single spaces after commas"""
+    address = address.lower().replace(".", " ")
+    parts = [re.sub(r"\s+", " ", part).strip() for part in address.split(",")]
+    return ", ".join(part for part in parts if part)
+
+
+def place_filename(place):
+    return place.replace(",", "").replace(" ", "_").lower() + ".wkb"
+
+
+def outline(boundary):
+    """The exterior of a boundary, or of its largest piece, as (xs, ys)"""
+    if isinstance(boundary, MultiPolygon):
+        boundary = max(boundary.geoms, key=lambda polygon: polygon.area)
+    return boundary.exterior.xy
+
+
+############################### Backends ###############################
+
+class NominatimBackend:
+    """Looks everything up with Nominatim, over the network"""
+    name = "nominatim"
+
+    def geocode(self, address):
+        return tuple(ox.geocoder.geocode(address))
+
+
+    def boundary(self, place):
+        return ox.geocode_to_gdf(place)["geometry"].iloc[0]
+
+
+class AddressTable:
+    """
+    Looks addresses up in a table with columns address, lat and lng, and
+    boundaries up in `boundary_dir`, as saved by `Geocoder.boundary`.
+    Nothing touches the network.
+    """
+    name = "table"
+
+    def __init__(self, addresses=None, boundary_dir=BOUNDARY_DIR):
+        self.coordinates = {}
+        if addresses is not None:
+            for address, lat, lng in zip(addresses["address"], addresses["lat"],
+                                         addresses["lng"]):
+                self.coordinates[normalize_address(address)] = (float(lat), float(lng))
+        self.boundary_dir = Path(boundary_dir)
+        self.boundaries = {}
+
+
+    @classmethod
+    def from_csv(cls, filepath, boundary_dir=BOUNDARY_DIR):
+        return cls(pd.read_csv(filepath), boundary_dir)
+
+
+    def add(self, address, lat_lng):
+        self.coordinates[normalize_address(address)] = tuple(lat_lng)
+
+
+    def add_boundary(self, place, boundary):
+        self.boundaries[place] = boundary
+
+
+    def geocode(self, address):
+        lat_lng = self.coordinates.get(normalize_address(address))
+        if lat_lng is None:
+            raise ValueError(f"{address} is not in the address table")
+        return lat_lng
+
+
+    def boundary(self, place):
+        if place in self.boundaries:
+            return self.boundaries[place]
+        filepath = self.boundary_dir / place_filename(place)
+        if not filepath.exists():
+            raise FileNotFoundError(f"No boundary for {place} in {self.boundary_dir}")
+        return read_boundary(filepath)
+
+
+############################### Geocoder ###############################
+
+class Geocoder:
+    def __init__(self, backend=None, db_path=GEOCODE_DB_PATH,
+                 boundary_dir=BOUNDARY_DIR, not_found_seconds=NOT_FOUND_SECONDS):
+        """
+        Set `db_path` or `boundary_dir` to None to remember addresses or
+        boundaries in memory only.
+        """
+        self.not_found_seconds = not_found_seconds
+        self.backend = NominatimBackend() if backend is None else backend
+        self.db_path = None if db_path is None else Path(db_path)
+        self.boundary_dir = None if boundary_dir is None else Path(boundary_dir)
+        self.addresses = {}
+        self.boundaries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if self.db_path is not None:
+            os.makedirs(self.db_path.parent, exist_ok=True)
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS addresses (
+                    address TEXT NOT NULL,
+                    backend TEXT NOT NULL,
+                    lat REAL,
+                    lng REAL,
+                    saved_at REAL NOT NULL,
+                    PRIMARY KEY (address, backend)
+                )""")
+            self.db.commit()
+
+
+    def geocode(self, address):
+        """
+        The (lat, lng) of `address`. Raises ValueError if it can't be found,
+        and again, without asking the backend, until `not_found_seconds` 
+        have passed.
+        """
+        key = normalize_address(address)
+        lat_lng = self.lookup(key)
+        if lat_lng is None:
+            with span("geocode"):
+                try:
+                    lat_lng = tuple(float(value) for value in self.backend.geocode(address))
+                except ValueError:
+                    lat_lng = ()
+            self.remember(key, lat_lng)
+
+        if not lat_lng:
+            raise ValueError(f"Could not geocode {address}")
+        return lat_lng
+
+
+    def lookup(self, key):
+        """The remembered (lat, lng), () if it wasn't found lately, or None"""
+        with self.lock:
+            entry = self.addresses.get(key)
+            if entry is None and self.db is not None:
+                row = self.db.execute(
+                    "SELECT lat, lng, saved_at FROM addresses WHERE address = ? AND backend = ?",
+                    (key, self.backend.name)).fetchone()
+                if row is not None:
+                    entry = (() if row[0] is None else (row[0], row[1]), row[2])
+                    self.addresses[key] = entry
+
+            lat_lng = None
+            if entry is not None:
+                lat_lng, saved_at = entry
+                if not lat_lng and time.time() - saved_at > self.not_found_seconds:
+                    lat_lng = None
+            if lat_lng is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return lat_lng
+
+
+    def remember(self, key, lat_lng):
+        """Keeps (lat, lng), or () for an address that wasn't found"""
+        saved_at = time.time()
+        with self.lock:
+            self.addresses[key] = (lat_lng, saved_at)
+            if self.db is not None:
+                lat, lng = lat_lng if lat_lng else (None, None)
+                self.db.execute(
+                    "INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?, ?)",
+                    (key, self.backend.name, lat, lng, saved_at))
+                self.db.commit()
+
+
+    def can_be_found(self, address):
+        try:
+            self.geocode(address)
+            return True
+        except ValueError:
+            return False
+
+
+    def boundary(self, place):
+        """The boundary of `place` as a shapely polygon, looked up once and then saved"""
+        with self.lock:
+            boundary = self.boundaries.get(place)
+        if boundary is not None:
+            return boundary
+
+        filepath = None
+        if self.boundary_dir is not None:
+            filepath = self.boundary_dir / place_filename(place)
+        if filepath is not None and filepath.exists():
+            boundary = read_boundary(filepath)
+        else:
+            with span("geocode boundary"):
+                boundary = self.backend.boundary(place)
+            if filepath is not None:
+                save_boundary(boundary, filepath)
+
+        with self.lock:
+            self.boundaries[place] = boundary
+        return boundary
+
+
+def read_boundary(filepath):
+    with open(filepath, "rb") as boundary_file:
+        return wkb.loads(boundary_file.read())
+
+
+def save_boundary(boundary, filepath):
+    os.makedirs(Path(filepath).parent, exist_ok=True)
+    with atomic_write(filepath, "wb") as boundary_file:
+        boundary_file.write(wkb.dumps(boundary))
+
+
+# One geocoder per process, shared by every session of the app
+_default_geocoder = None
+_default_geocoder_lock = threading.Lock()
+
+
+def default_geocoder():
+    global _default_geocoder
+    with _default_geocoder_lock:
+        if _default_geocoder is None:
+            backend = None
+            if GEOCODER_TABLE:
+                backend = AddressTable.from_csv(GEOCODER_TABLE)
+            _default_geocoder = Geocoder(backend)
+    return _default_geocoder
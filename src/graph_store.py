@@ -0,0 +1,209 @@
+"""
+One copy of each city's graphs per process, shared by every isochrone.
+
+Each `TransitIsochrone` used to load its own copy of the citywide graph and
+the transit graph, and the walking maps loaded yet another, which is why the
+app couldn't host user-generated transit maps. A `GraphStore` loads each
+artifact the first time it is asked for and hands the same object to every
+caller after that, across Streamlit sessions and threads.
+
+What it hands out is read-only. Arrays are memory-mapped from the artifacts
+`create_transit_graph.py` saves, so their pages live in the operating
+system's file cache, are read from disk only when a search touches them, and
+are shared with every other process mapping the same file. The networkx
+graphs are frozen, and are only loaded for the networkx engine and the osmnx
+renderer.
+
+Each entry remembers the size and modification time of the file it came
+from, and is loaded again if the file is rebuilt. `footprint()` reports how
+much memory each entry holds.
+"""
+import os
+import mmap
+import threading
+from pathlib import Path
+from collections import defaultdict
+
+import numpy as np
+import networkx as nx
+from scipy.sparse import issparse
+from scipy.spatial import cKDTree
+from pympler import asizeof
+
+import src.graphs as graphs
+import src.utils as utils
+from src.tracing import current_rss, peak_rss
+from src.filepaths import DATA_DIR
+
+
+class GraphStore:
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        # One lock per entry, so a slow load doesn't hold up the others
+        self.entry_locks = defaultdict(threading.Lock)
+
+
+    def get(self, kind, filepath, load):
+        """
+        The result of `load()`, which reads `filepath`, called once and then
+        again only if the file changes.
+        """
+        key = (kind, str(filepath))
+        with self.lock:
+            entry_lock = self.entry_locks[key]
+
+        with entry_lock:
+            stamp = file_stamp(filepath)
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != stamp:
+                entry = (stamp, load())
+                self.entries[key] = entry
+        return entry[1]
+
+
+    def csr_graph(self, city, data_dir=DATA_DIR):
+        filepath = graphs.graph_artifact_path(city, data_dir)
+        return self.get("csr_graph", filepath,
+            lambda: graphs.load_graph_artifact(city, data_dir))
+
+
+    def node_index(self, city, data_dir=DATA_DIR):
+        """Checked against the nodes of the graph arrays in `data_dir`, if there are any"""
+        walking_dir = graphs.walking_artifacts_dir(city, data_dir)
+        filepath = graphs.node_index_path(city, walking_dir)
+        def load():
+            if graphs.graph_artifact_path(city, data_dir).exists():
+                return graphs.read_node_index(city, 
+                    csr_graph=self.csr_graph(city, data_dir), data_dir=walking_dir)
+            return graphs.read_node_index(city, self.citywide_graph(city), 
+                data_dir=walking_dir)
+        return self.get("node_index", filepath, load)
+
+
+    def edge_geometry(self, city, data_dir=DATA_DIR):
+        walking_dir = graphs.walking_artifacts_dir(city, data_dir)
+        filepath = graphs.edge_geometry_path(city, walking_dir)
+        return self.get("edge_geometry", filepath,
+            lambda: graphs.load_edge_geometry(city, walking_dir))
+
+
+    def stop_table(self, city, data_dir=DATA_DIR):
+        filepath = graphs.stop_table_path(city, data_dir)
+        return self.get("stop_table", filepath,
+            lambda: graphs.load_stop_table(city, data_dir))
+
+
+    def timetable(self, city, data_dir=DATA_DIR):
+        filepath = graphs.timetable_path(city, data_dir)
+        return self.get("timetable", filepath,
+            lambda: graphs.load_timetable(city, data_dir))
+
+
+    def citywide_graph(self, city):
+        """The networkx walking graph. This is by far the biggest entry."""
+        return self.get("citywide_graph", graphs.graph_path(city),
+            lambda: nx.freeze(graphs.load_citywide_graph(city)))
+
+
+    def transit_graph(self, data_dir=DATA_DIR):
+        filepath = Path(data_dir) / "transit_graph.pkl"
+        return self.get("transit_graph", filepath,
+            lambda: nx.freeze(utils.read_pickle(filepath)))
+
+
+    def footprint(self, deep=False):
+        """
+        One row per entry, with the bytes it holds in its own memory and the
+        bytes it maps from disk. Mapped bytes are only resident once searched
+        and are shared between processes. Networkx graphs are made of millions
+        of small Python objects, so they are only measured with `deep`, which
+        walks every one of them with pympler and can take a while.
+        """
+        rows = []
+        with self.lock:
+            entries = list(self.entries.items())
+        for (kind, filepath), (_, obj) in entries:
+            if isinstance(obj, nx.Graph):
+                private = asizeof.asizeof(obj) if deep else None
+                mapped = 0
+            else:
+                private, mapped = array_bytes(obj)
+            rows.append({"kind": kind, "filepath": filepath,
+                         "private_bytes": private, "mapped_bytes": mapped})
+        return rows
+
+
+    def print_footprint(self, deep=False):
+        megabytes = lambda num_bytes: "?" if num_bytes is None else f"{num_bytes / 1e6:.1f}"
+        for row in self.footprint(deep):
+            print(f"{row['kind']:<16}{megabytes(row['private_bytes']):>10} MB in memory"
+                  f"{megabytes(row['mapped_bytes']):>10} MB mapped\t{row['filepath']}")
+        print(f"The process is using {current_rss() / 1e9:.3f} GB, "
+              f"and has used at most {peak_rss() / 1e9:.3f} GB.")
+
+
+def file_stamp(filepath):
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def array_bytes(value, seen=None):
+    """
+    Bytes held by the arrays in `value` and its attributes, as (private,
+    mapped). Arrays that are views onto a memory-mapped file count as mapped.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0, 0
+    seen.add(id(value))
+
+    if isinstance(value, np.ndarray):
+        return (0, value.nbytes) if is_mapped(value) else (value.nbytes, 0)
+    if issparse(value):
+        parts = [value.data, value.indices, value.indptr]
+    elif isinstance(value, cKDTree):
+        parts = [value.data, value.indices]
+    elif isinstance(value, dict):
+        parts = list(value.values())
+    elif isinstance(value, (list, tuple)):
+        # Lists of plain Python objects, like the timetable's transfers, are skipped
+        parts = [item for item in value if isinstance(item, np.ndarray) or issparse(item)]
+    elif hasattr(value, "__dict__"):
+        parts = list(vars(value).values())
+    else:
+        return 0, 0
+
+    private, mapped = 0, 0
+    for part in parts:
+        part_private, part_mapped = array_bytes(part, seen)
+        private += part_private
+        mapped += part_mapped
+    return private, mapped
+
+
+def is_mapped(array):
+    base = array
+    while base is not None:
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return True
+        base = getattr(base, "base", None)
+    return False
+
+
+# One store per process, shared by every session of the app
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def default_store():
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = GraphStore()
+    return _default_store
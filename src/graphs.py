@@ -1,11 +1,18 @@
 import os
 
+import numpy as np
 import osmnx as ox
 import networkx as nx
 import streamlit as st
 
 from src.filepaths import DATA_DIR
+from src.csr_graph import CSRGraph
+from src.spatial import NodeIndex, index_for_graph, register_index, nodes_version
+from src.rendering import EdgeGeometry
+from src.stop_table import StopTable
+from src.connection_scan import Timetable
 import src.utils as utils
+from src.tracing import traced
 
 
 def graph_path(city):
@@ -16,13 +23,199 @@ def graph_path(city):
     return graph_path
 
 
+def graph_artifact_path(city, data_dir=DATA_DIR):
+    filename = city.replace(",", "").replace(" ","_").lower() + ".arrays"
+    return data_dir / filename
+
+
+def edge_geometry_path(city, data_dir=DATA_DIR):
+    filename = city.replace(",", "").replace(" ","_").lower() + "_edges.arrays"
+    return data_dir / filename
+
+
+def load_edge_geometry(city, data_dir=DATA_DIR, mmap=True):
+    return EdgeGeometry.load(edge_geometry_path(city, data_dir), mmap=mmap)
+
+
+def stop_table_path(city, data_dir=DATA_DIR):
+    filename = city.replace(",", "").replace(" ","_").lower() + "_stops.arrays"
+    return data_dir / filename
+
+
+def save_stop_table(city, csr_graph, data_dir=DATA_DIR):
+    """
+    Tables travel times between transit stops for the common frequency 
+    multipliers. This takes a while, and only needs doing when the transit 
+    graph changes.
+    """
+    stop_table = StopTable.build(csr_graph)
+    stop_table.save(stop_table_path(city, data_dir))
+    print(f"✓\tSaved stop to stop travel times to {stop_table_path(city, data_dir)}")
+
+    different = stop_table.spot_check(csr_graph)
+    if different:
+        print(f"The stop table differs from a full search for {different:.2%} of "
+              f"the nodes reached from a few stops, where a trip transfers with a "
+              f"walk longer than {stop_table.max_transfer_time} minutes.")
+    else:
+        print("✓\tThe stop table matches a full search from a few stops")
+    return stop_table
+
+
+def load_stop_table(city, data_dir=DATA_DIR, mmap=True):
+    return StopTable.load(stop_table_path(city, data_dir), mmap=mmap)
+
+
+def timetable_path(city, data_dir=DATA_DIR):
+    filename = city.replace(",", "").replace(" ","_").lower() + "_timetable.arrays"
+    return data_dir / filename
+
+
+def save_timetable(city, csr_graph, stop_times, stop_id_to_graph_id, 
+                   data_dir=DATA_DIR):
+    """The day's connections, for isochrones that leave at a set time"""
+    timetable = Timetable.from_stop_times(stop_times, stop_id_to_graph_id, csr_graph)
+    timetable.save(timetable_path(city, data_dir))
+    print(f"✓\tSaved timetable to {timetable_path(city, data_dir)}")
+    return timetable
+
+
+def load_timetable(city, data_dir=DATA_DIR, mmap=True):
+    return Timetable.load(timetable_path(city, data_dir), mmap=mmap)
+
+
+def node_index_path(city, data_dir=DATA_DIR):
+    filename = city.replace(",", "").replace(" ","_").lower() + "_nodes.arrays"
+    return data_dir / filename
+
+
+def walking_artifacts_dir(city, data_dir=DATA_DIR):
+    """
+    Where the spatial index and edge geometry for the transit graph in 
+    `data_dir` are. They only depend on the walking graph, so a build for 
+    every service pattern saves them once, next to the walking graph, rather 
+    than in each pattern's directory.
+    """
+    if node_index_path(city, data_dir).exists():
+        return data_dir
+    return graph_path(city).parent
+
+
+@traced("load citywide graph")
 def load_citywide_graph(city):
     # citywide_graph = nx.read_gpickle(graph_path(city))
     # citywide_graph = nx.read_gml(graph_path(city))
     citywide_graph = utils.decompress_pickle(graph_path(city))
+
+    # Without a saved index, `get_nearest_node` builds one the first time it's asked
+    walking_dir = graph_path(city).parent
+    if node_index_path(city, walking_dir).exists():
+        register_index(citywide_graph, 
+            load_node_index(city, citywide_graph, data_dir=walking_dir))
     return citywide_graph
 
 
+# Node indexes by file, so each is read from disk once per process
+_node_indexes = {}
+
+
+def load_node_index(city, citywide_graph=None, csr_graph=None, data_dir=DATA_DIR):
+    """
+    The spatial index over the citywide graph's nodes, read once per process.
+    See `read_node_index`.
+    """
+    filepath = node_index_path(city, data_dir)
+    if filepath not in _node_indexes:
+        _node_indexes[filepath] = read_node_index(city, citywide_graph, csr_graph, data_dir)
+    return _node_indexes[filepath]
+
+
+def read_node_index(city, citywide_graph=None, csr_graph=None, data_dir=DATA_DIR):
+    """
+    The spatial index saved by `save_walking_artifacts` when the transit graph 
+    is built. It is checked against the nodes of `csr_graph` or 
+    `citywide_graph`, whichever is given. If it's missing, out of date or 
+    unreadable, one is built from them in memory for this process, and the 
+    file is left for `create_transit_graph.py` to rebuild. With neither, the 
+    citywide graph is loaded to build it if need be.
+    """
+    if csr_graph is not None:
+        version = nodes_version(csr_graph.node_ids, csr_graph.node_y, csr_graph.node_x)
+    elif citywide_graph is not None:
+        version = nodes_version(*graph_nodes(citywide_graph))
+    else:
+        version = None
+
+    filepath = node_index_path(city, data_dir)
+    if not filepath.exists():
+        print(f"There is no spatial index at {filepath}. Run create_transit_graph.py to build it.")
+    else:
+        try:
+            return NodeIndex.load(filepath, version)
+        except ValueError:
+            print(f"The spatial index at {filepath} is out of date or unreadable. Run create_transit_graph.py to rebuild it.")
+
+    if csr_graph is not None:
+        return NodeIndex.from_csr_graph(csr_graph)
+    if citywide_graph is None:
+        citywide_graph = load_citywide_graph(city)
+    return index_for_graph(citywide_graph)
+
+
+def graph_nodes(graph):
+    """Node IDs, latitudes and longitudes of a networkx graph"""
+    nodes = list(graph.nodes(data=True))
+    return ([node for node, _ in nodes], [data["y"] for _, data in nodes], 
+            [data["x"] for _, data in nodes])
+
+
+def save_graph_artifact(city, citywide_graph, transit_graph, stop_id_to_graph_id,
+                        service_date=None, data_dir=DATA_DIR, hourly_arrivals=None):
+    """
+    Saves the walking graph, the transit graph and the mapping from transit 
+    stops to graph nodes together as typed arrays. This loads far faster than 
+    the compressed pickle and is all the CSR engine needs to search. With 
+    `hourly_arrivals`, the stop IDs and arrivals per hour saved by 
+    `gtfs.average_arrival_rates_per_stop`, wait times can be taken for any 
+    hours of the day.
+
+    The spatial index and edge geometry are saved separately, by 
+    `save_walking_artifacts`.
+    """
+    csr_graph = CSRGraph.from_networkx(citywide_graph, transit_graph)
+    csr_graph.set_stops(stop_id_to_graph_id)
+    if hourly_arrivals is not None:
+        csr_graph.set_hourly_arrivals(*hourly_arrivals)
+    csr_graph.save(graph_artifact_path(city, data_dir), city=city, 
+        service_date=service_date)
+    print(f"✓\tSaved graph arrays to {graph_artifact_path(city, data_dir)}")
+    return csr_graph
+
+
+def save_walking_artifacts(city, citywide_graph, data_dir=DATA_DIR):
+    """
+    Saves the spatial index and the edge geometry, the only things that 
+    write them. They only depend on the walking graph, so they can be shared 
+    by every transit graph built over it (see `walking_artifacts_dir`). Nodes 
+    are in the same sorted order as a `CSRGraph`'s.
+    """
+    node_ids, lats, lngs = graph_nodes(citywide_graph)
+    order = np.argsort(node_ids)
+    node_ids = np.asarray(node_ids, dtype=np.int64)[order]
+    node_index = NodeIndex(node_ids, np.asarray(lats)[order], np.asarray(lngs)[order])
+    node_index.save(node_index_path(city, data_dir))
+    _node_indexes[node_index_path(city, data_dir)] = node_index
+    print(f"✓\tSaved spatial index to {node_index_path(city, data_dir)}")
+
+    edge_geometry = EdgeGeometry.from_networkx(citywide_graph, node_ids)
+    edge_geometry.save(edge_geometry_path(city, data_dir))
+    print(f"✓\tSaved edge geometry to {edge_geometry_path(city, data_dir)}")
+
+
+def load_graph_artifact(city, data_dir=DATA_DIR, mmap=True):
+    return CSRGraph.load(graph_artifact_path(city, data_dir), mmap=mmap)
+
+
 def download_citywide_graph(city="Chicago, Illinois"):
     if os.path.exists(graph_path(city)):
         citywide_graph = load_citywide_graph(city)
@@ -78,27 +271,18 @@ def add_walking_times_to_graph(graph, mode="walk"):
     return graph
 
 
+@traced("snap node")
 def get_nearest_node(graph, location):
     """
-    Used to find the center node of the graph. If there is no one closest node, 
-    osmnx returns a list. Here we simply take the first node from that list. 
-    All the nodes will be right on top of each other and there's no point for 
-    our purposes in distinguishing between them.
+    Used to find the center node of the graph. The graph's spatial index is 
+    built once and shared by every caller, so this is a single tree lookup.
     ---
     Reminder: Longitude is along the X axis. Latitude is along the Y axis. When 
     we speak we tend to say "lat long", implying latitude comes first. But 
     since latitude goes north/south and longidtude goes east/west, in an X-Y 
     coordinate system, longitude comes first. 
     """
-    lat = location[0]
-    lng = location[1]
-    nearest_node = ox.distance.nearest_nodes(graph, lng, lat)
-    
-    # assert isinstance(nearest_node, int)
-    if not isinstance(nearest_node, int):
-        nearest_node = nearest_node[0]
-
-    return nearest_node
+    return index_for_graph(graph).nearest_node(location)
 
 
 # def load_graph_around_location(location, radius=1609, network_type="walk"):
@@ -1,17 +1,24 @@
 import os
 import sys
+import json
 import pickle
+import hashlib
 import warnings
+from zipfile import ZipFile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-import osmnx as ox
 import numpy as np
 import pandas as pd
 import networkx as nx
 from tqdm import tqdm
 
-from src.utils import timer_func
-from src.filepaths import DATA_DIR, GTFS_PATH
+import src.artifacts as artifacts
+from src.spatial import index_for_graph
+from src.utils import timer_func, atomic_write
+from src.tracing import span
+from src.filepaths import DATA_DIR, GTFS_PATH, GTFS_ZIP_PATH
 
 
 warnings.filterwarnings("ignore")
@@ -21,79 +28,222 @@ GTFS_DTYPES = {
     "trips":    {
         "service_id":   str,
         "trip_id":      str,
-        "shape_id":     str,
-        "schd_trip_id": str,
     },
     "stop_times":   {
         "trip_id":      str,
     },
     "calendar":     {
         "service_id":   str,
-    }
+    },
+    "calendar_dates":   {
+        "service_id":   str,
+    },
 }
 
 
+# Only these columns are read from the largest tables. Every other table is 
+# small enough to load in full.
+GTFS_COLUMNS = {
+    "trips":        ["route_id", "service_id", "trip_id"],
+    "stop_times":   ["trip_id", "arrival_time", "departure_time", "stop_id", 
+                     "stop_sequence"],
+}
+
+# Arrivals outside these hours are left out of the graph, as a (start, end)
+# pair of hours since midnight with the end excluded. Owl service after
+# midnight, which GTFS writes as 24:00 and later, needs an end past 24.
+SERVICE_HOURS = (5, 22)
+
+# Rows per chunk when streaming a table
+GTFS_CHUNKSIZE = 500_000
+
+# Per-route travel times are kept by a fingerprint of each route's schedule
+# (see `route_cache_dir`), so that rebuilding for another date only
+# recomputes the routes that changed
+ROUTE_CACHE_VERSION = 1
+
+# The only columns of stop times the per-route travel times read, and the
+# columns they return
+ROUTE_COLUMNS = ["trip_id", "stop_id", "arrival_seconds"]
+TRAVEL_TIME_COLUMNS = ["origin_stop_id", "destination_stop_id", "transit_travel_time"]
+
+# Columns of the arrivals per stop and hour. Trips that run past midnight 
+# can add more.
+HOURS_PER_DAY = 24
+
+DAYS_OF_WEEK = ["monday", "tuesday", "wednesday", "thursday", "friday", 
+                "saturday", "sunday"]
+
+
 ############################# Load & Clean Data #############################
 
-def load_clean_and_save_tables():
+def load_clean_and_save_tables(dt=None, data_dir=DATA_DIR, service_hours=SERVICE_HOURS):
+    """
+    Trips and stop times are filtered to the requested date of service as 
+    they are read, one chunk at a time, so the full multi-year schedule is 
+    never held in memory at once. Without a date `dt`, one is asked for.
+    """
     print("Loading and cleaning raw GTFS tables.")
-    # Load
-    trips = load_raw_gtfs_table("trips")
-    stop_times = load_raw_gtfs_table("stop_times")
-    stops = load_raw_gtfs_table("stops")
-    routes = load_raw_gtfs_table("routes")
-
-    # Filter & Clean
-    service_ids = get_service_ids_for_requested_date()
-    trips, stop_times = filter_by_service_ids(trips, stop_times, service_ids)
-    stop_times = clean_stop_times_table(stop_times)
-    
-    # Save
-    save_prepared_gtfs_table(trips, "trips")
-    save_prepared_gtfs_table(stop_times, "stop_times")
-    save_prepared_gtfs_table(stops, "stops")
-    save_prepared_gtfs_table(routes, "routes")
+    service_ids = get_service_ids_for_requested_date(dt)
+    routes, trips, stop_times, stops = load_and_clean_tables(service_ids, service_hours)
+    save_prepared_gtfs_tables(routes, trips, stop_times, stops, data_dir)
+    return routes, trips, stop_times, stops
+
+
+def load_and_clean_tables(service_ids, service_hours=SERVICE_HOURS):
+    # Load & Filter
+    with span("load raw tables"):
+        trips = load_raw_gtfs_table("trips", 
+            row_filter=lambda df: df[df["service_id"].isin(service_ids)])
+        trip_ids = pd.Index(trips["trip_id"].values)
+        stop_times = load_raw_gtfs_table("stop_times", 
+            row_filter=lambda df: df[df["trip_id"].isin(trip_ids)])
+        stops = load_raw_gtfs_table("stops")
+        routes = load_raw_gtfs_table("routes")
+
+    # Clean
+    with span("clean stop_times"):
+        stop_times = clean_stop_times_table(stop_times, service_hours)
     return routes, trips, stop_times, stops
 
 
-def load_raw_gtfs_table(table_name):
+def save_prepared_gtfs_tables(routes, trips, stop_times, stops, data_dir=DATA_DIR):
+    save_prepared_gtfs_table(trips, "trips", data_dir)
+    save_prepared_gtfs_table(stop_times, "stop_times", data_dir)
+    save_prepared_gtfs_table(stops, "stops", data_dir)
+    save_prepared_gtfs_table(routes, "routes", data_dir)
+
+
+def load_raw_gtfs_table(table_name, row_filter=None):
+    """
+    Reads a raw GTFS table, straight from the feed's .zip file if there is one 
+    at `GTFS_ZIP_PATH` and from the extracted tables in `GTFS_PATH` if not.
+
+    With a `row_filter`, the table is read in chunks and the filter, which 
+    takes and returns a DataFrame, is applied to each chunk before the next is 
+    read.
+    """
     # print(f"loading table {table_name}")
-    filepath = GTFS_PATH / f"{table_name}.txt"
     if table_name in GTFS_DTYPES:
         dtype = GTFS_DTYPES[table_name]
     else:
         dtype = None
-    df = pd.read_csv(filepath, dtype=dtype)
+
+    if table_name in GTFS_COLUMNS:
+        usecols = lambda col: col in GTFS_COLUMNS[table_name]
+    else:
+        usecols = None
+
+    with open_raw_gtfs_table(table_name) as table_file:
+        if row_filter is None:
+            df = pd.read_csv(table_file, dtype=dtype, usecols=usecols)
+        else:
+            chunks = pd.read_csv(table_file, dtype=dtype, usecols=usecols, 
+                chunksize=GTFS_CHUNKSIZE)
+            df = pd.concat([row_filter(chunk) for chunk in chunks], 
+                ignore_index=True)
     return df
 
 
-def save_prepared_gtfs_table(df, table_name):
-    filepath = DATA_DIR / "gtfs_cleaned" / f"{table_name}.pkl"
-    with open(filepath, "wb") as pkl_file:
-            pickle.dump(df, pkl_file)
+@contextmanager
+def open_raw_gtfs_table(table_name):
+    """
+    A file handle for a raw GTFS table. Tables inside the zip may sit in a 
+    subdirectory, so they are matched by filename alone.
+    """
+    filename = f"{table_name}.txt"
+    if not GTFS_ZIP_PATH.exists():
+        with open(GTFS_PATH / filename, "rb") as table_file:
+            yield table_file
+        return
+
+    with ZipFile(GTFS_ZIP_PATH) as zip_file:
+        members = [m for m in zip_file.namelist() if m.split("/")[-1] == filename]
+        if not members:
+            raise FileNotFoundError(f"There is no {filename} in {GTFS_ZIP_PATH}")
+        with zip_file.open(members[0]) as table_file:
+            yield table_file
+
+
+def save_prepared_gtfs_table(df, table_name, data_dir=DATA_DIR):
+    filepath = prepared_gtfs_table_path(table_name, data_dir)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    artifacts.save_table(df, filepath)
     print(f"✓\tSaved table to {filepath}")
 
 
-def load_prepared_gtfs_table(table_name):
-    filepath = DATA_DIR / "gtfs_cleaned" / f"{table_name}.pkl"
-    with open(filepath, "rb") as pkl_file:
-        df = pickle.load(pkl_file)
-    return df
+def prepared_gtfs_table_path(table_name, data_dir=DATA_DIR):
+    return data_dir / "gtfs_cleaned" / f"{table_name}.arrays"
 
 
-def clean_stop_times_table(df):
-    df["hour_of_arrival"] = df["arrival_time"].apply(lambda ts: int(ts.split(":")[0]))
+def load_prepared_gtfs_table(table_name, data_dir=DATA_DIR):
+    """
+    The table as it was saved, missing values, mixed IDs and index included
+    (see `artifacts.save_table`). Tables pickled by older versions of the 
+    pipeline are never read, so they have to be rebuilt.
+    """
+    filepath = prepared_gtfs_table_path(table_name, data_dir)
+    if not filepath.exists():
+        raise FileNotFoundError(f"{filepath} is missing. Run create_transit_graph.py to rebuild the cleaned GTFS tables.")
+    return artifacts.load_table(filepath)
 
-    # Filter to after 6 am and before 10 pm.
-    df = df[(df["hour_of_arrival"] >= 5) & (df["hour_of_arrival"] < 22)]
 
-    # Convert to datetime
-    _format = "%H:%M:%S"
-    df["arrival_time"] = pd.to_datetime(df["arrival_time"], format=_format)
-    df["departure_time"] = pd.to_datetime(df["departure_time"], format=_format)
+def clean_stop_times_table(df, service_hours=SERVICE_HOURS):
+    """
+    Arrival and departure times become int32 seconds since midnight at the 
+    start of the service day, so trips that run past midnight carry on past 
+    24 hours. Stops without a scheduled time are dropped, and so are arrivals 
+    outside `service_hours`, a (start, end) pair of hours with the end 
+    excluded. An end past 24 keeps overnight service.
+    """
+    df = df.assign(
+        arrival_time=parse_gtfs_times(df["arrival_time"]),
+        departure_time=parse_gtfs_times(df["departure_time"]))
+    df = df[(df["arrival_time"] >= 0) & (df["departure_time"] >= 0)]
+    df["hour_of_arrival"] = df["arrival_time"] // 3600
+
+    start, end = service_hours
+    df = df[(df["hour_of_arrival"] >= start) & (df["hour_of_arrival"] < end)]
     return df
 
 
+def parse_gtfs_times(times):
+    """
+    Seconds since midnight, as int32, for a column of GTFS times such as 
+    "7:05:00" or "25:10:00", and -1 where a time is missing. Times are read 
+    as fixed-width bytes, with hours of one or two digits, and the digits 
+    added up column by column. Anything that doesn't fit that layout, such 
+    as padding with spaces, is split on its colons instead.
+    """
+    times = pd.Series(times).reset_index(drop=True)
+    missing = times.isna().values
+    text = times.fillna("00:00:00").values.astype("S8")
+    chars = text.view(np.uint8).reshape(-1, 8).astype(np.int32)
+    digits = chars - ord("0")
+
+    # Single digit hours shift everything after them along by one character
+    short = chars[:, 1] == ord(":")
+    hours = np.where(short, digits[:, 0], digits[:, 0] * 10 + digits[:, 1])
+    rest = np.where(short[:, None], digits[:, 2:7], digits[:, 3:8])
+    seconds = hours * 3600 + (rest[:, 0] * 10 + rest[:, 1]) * 60 + rest[:, 3] * 10 + rest[:, 4]
+
+    is_digit = (digits >= 0) & (digits <= 9)
+    parsed = np.where(short,
+        is_digit[:, [0, 2, 3, 5, 6]].all(axis=1) & (chars[:, 4] == ord(":")) & (chars[:, 7] == 0),
+        is_digit[:, [0, 1, 3, 4, 6, 7]].all(axis=1) & (chars[:, 2] == ord(":")) & (chars[:, 5] == ord(":")))
+
+    odd = ~parsed & ~missing
+    if odd.any():
+        parts = times[odd].astype(str).str.strip().str.split(":", expand=True)
+        if parts.shape[1] != 3:
+            raise ValueError(f"Couldn't read the GTFS time {times[odd].iloc[0]!r}.")
+        parts = parts.astype(np.int32).values
+        seconds[odd] = parts[:, 0] * 3600 + parts[:, 1] * 60 + parts[:, 2]
+
+    seconds[missing] = -1
+    return seconds.astype(np.int32)
+
+
 def convert_calendar_to_datetime(calendar, calendar_dates):
     frmt = "%Y%m%d"
     for col in ["start_date", "end_date"]:
@@ -109,7 +259,8 @@ def choose_date(calendar):
     end_date = calendar.end_date.max()
     frmt = "%A, %B %d, %Y"
 
-    if len(sys.argv) == 1:
+    requested = [arg for arg in sys.argv[1:] if arg.isdigit() and len(arg) == 8]
+    if not requested:
         # User needs to select a date.
         prompt = f"""
     Schedule data runs from {start_date.strftime(frmt)} to {end_date.strftime(frmt)}. 
@@ -127,9 +278,9 @@ def choose_date(calendar):
 
         dt = datetime(year=year, month=month, day=day)
 
-    elif len(sys.argv) == 3:
+    else:
         # User specified a date
-        dt = datetime.strptime(sys.argv[2], "%Y%m%d")
+        dt = datetime.strptime(requested[0], "%Y%m%d")
         if dt < start_date or dt > end_date:
             msg = f"""
         The specified date – {dt.strftime(frmt)} – is not on the calendar.
@@ -153,39 +304,130 @@ def prompt_for_user_input(label):
 
 
 def service_ids_for_date(dt, calendar, calendar_dates):
-    # Calendar
-    # Date is on or between start and end dates
-    service = calendar[(calendar["start_date"] <= dt) & (calendar["end_date"] >= dt)]
+    _, service_ids, active = service_matrix(calendar, calendar_dates, dt, dt)
+    return list(service_ids[active[0]])
+
 
-    # Day of week lines up (some service only runs particular days)
-    service = service[service[dt.strftime("%A").lower()] == 1]
-    service_ids = list(service["service_id"].values)
+def service_matrix(calendar, calendar_dates, start_date=None, end_date=None):
+    """
+    Which service IDs run on which dates, as a boolean array with a row for 
+    every date from `start_date` to `end_date` and a column for every service 
+    ID. Returns the dates, the service IDs and the array.
+
+    A service runs on the dates between its start and end dates that fall on 
+    the days of the week it runs. Then the exceptions in `calendar_dates` are 
+    applied: exception_type 1 means service has been added for that date, 
+    and exception_type 2 means service has been removed for that date.
+    """
+    if start_date is None:
+        start_date = min(calendar["start_date"].min(), calendar_dates["date"].min())
+    if end_date is None:
+        end_date = max(calendar["end_date"].max(), calendar_dates["date"].max())
+    dates = pd.date_range(start_date, end_date, freq="D")
+    service_ids = np.union1d(calendar["service_id"].values.astype(str), 
+                             calendar_dates["service_id"].values.astype(str))
+    service_index = pd.Index(service_ids)
+
+    # Calendar
+    days = dates.values[:, None]
+    in_range = (days >= calendar["start_date"].values) & (days <= calendar["end_date"].values)
+    runs_on_day = calendar[DAYS_OF_WEEK].values.astype(bool)[:, dates.weekday].T
+    active = np.zeros((dates.shape[0], service_ids.shape[0]), dtype=bool)
+    columns = service_index.get_indexer(calendar["service_id"].values.astype(str))
+    active[:, columns] = in_range & runs_on_day
 
     # Exceptions
-    # exception_type 1 means service has been added for that date.
-    # exception_type 2 means service has been removed for that date.
-    exceptions = calendar_dates[calendar_dates["date"] == dt]
-    include = exceptions[exceptions["exception_type"] == 1]
-    include = list(include["service_id"].values)
-    exclude = exceptions[exceptions["exception_type"] == 2]
-    exclude = list(exclude["service_id"].values)
-
-    service_ids = service_ids + include
-    service_ids = [s_id for s_id in service_ids if s_id not in exclude]
-    return service_ids
+    exceptions = calendar_dates[(calendar_dates["date"] >= dates[0]) & 
+                                (calendar_dates["date"] <= dates[-1])]
+    rows = dates.get_indexer(exceptions["date"])
+    columns = service_index.get_indexer(exceptions["service_id"].values.astype(str))
+    added = exceptions["exception_type"].values == 1
+    removed = exceptions["exception_type"].values == 2
+    active[rows[added], columns[added]] = True
+    active[rows[removed], columns[removed]] = False
+    return dates, service_ids, active
+
+
+def service_patterns(dates, service_ids, active):
+    """
+    Dates grouped by the exact set of services that run on them, such as 
+    every regular weekday, every Saturday, and each holiday with its own 
+    schedule. Dates with no service at all are left out.
+    """
+    patterns, pattern_of_date = np.unique(active, axis=0, return_inverse=True)
+    pattern_of_date = pattern_of_date.reshape(-1)
+    grouped = []
+    for ii, pattern in enumerate(patterns):
+        if not pattern.any():
+            continue
+        pattern_dates = dates[pattern_of_date == ii]
+        grouped.append({
+            "name":         service_pattern_name(pattern_dates),
+            "dates":        [dt.strftime("%Y%m%d") for dt in pattern_dates],
+            "service_ids":  service_ids[pattern].tolist(),
+        })
+    return sorted(grouped, key=lambda pattern: pattern["dates"][0])
+
+
+def service_pattern_name(dates):
+    """Named for the first date it runs and the days of the week it covers"""
+    weekdays = set(dates.weekday)
+    if weekdays <= {0, 1, 2, 3, 4}:
+        days = "weekday"
+    elif weekdays == {5}:
+        days = "saturday"
+    elif weekdays == {6}:
+        days = "sunday"
+    else:
+        days = "mixed"
+    if len(dates) == 1:
+        days = dates[0].strftime("%A").lower()
+    return f"{dates[0].strftime('%Y%m%d')}_{days}"
 
 
-def get_service_ids_for_requested_date():
-    # Load calendar
+def get_service_patterns():
+    """Every distinct pattern of service on the feed's calendar"""
+    calendar, calendar_dates = load_calendar()
+    return service_patterns(*service_matrix(calendar, calendar_dates))
+
+
+def service_patterns_dir(data_dir=DATA_DIR):
+    """One directory of graphs and tables per distinct pattern of service"""
+    return data_dir / "service_patterns"
+
+
+def service_pattern_dir(pattern, data_dir=DATA_DIR):
+    return service_patterns_dir(data_dir) / pattern["name"]
+
+
+def save_service_patterns(patterns, data_dir=DATA_DIR):
+    """An index of which dates each directory of graphs covers"""
+    patterns_dir = service_patterns_dir(data_dir)
+    patterns_dir.mkdir(parents=True, exist_ok=True)
+    index = {pattern["name"]: pattern["dates"] for pattern in patterns}
+    with open(patterns_dir / "patterns.json", "w") as json_file:
+        json.dump(index, json_file, indent=2)
+
+
+def load_calendar():
     calendar = load_raw_gtfs_table("calendar")
     calendar_dates = load_raw_gtfs_table("calendar_dates")
-    calendar, calendar_dates = convert_calendar_to_datetime(calendar, 
-        calendar_dates)
+    return convert_calendar_to_datetime(calendar, calendar_dates)
+
+
+def get_service_ids_for_requested_date(dt=None):
+    # Load calendar
+    calendar, calendar_dates = load_calendar()
 
     # User specified dates
-    dt = choose_date(calendar)
-    service_ids = service_ids_for_date(dt, calendar, calendar_dates)
-    return service_ids
+    if dt is None:
+        dt = choose_date(calendar)
+    return service_ids_for_date(dt, calendar, calendar_dates)
+
+
+def raw_gtfs_path():
+    """The feed's .zip file if there is one, and the extracted tables if not"""
+    return GTFS_ZIP_PATH if GTFS_ZIP_PATH.exists() else GTFS_PATH
 
 
 def filter_by_service_ids(trips, stop_times, service_ids):
@@ -214,98 +456,301 @@ def service_ids_that_visit_at_stop(stop_id, stop_times, trips):
 ####################### Prepare Date for Isochrones #######################
 
 
-def save_isochrone_data(obj, table_name):
-    filepath = DATA_DIR / "isochrone" / f"{table_name}"
-    with open(filepath, "wb") as pkl_file:
+def isochrone_data_path(filename, data_dir=DATA_DIR):
+    return data_dir / "isochrone" / filename
+
+
+def save_isochrone_data(obj, table_name, data_dir=DATA_DIR):
+    filepath = isochrone_data_path(table_name, data_dir)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_write(filepath) as pkl_file:
             pickle.dump(obj, pkl_file)
     print("✓")
 
 
-def load_isochrone_data(filename):
-    filepath = DATA_DIR / "isochrone"
-    if filename in os.listdir(filepath):
-        with open(filepath / filename, "rb") as pkl_file:
-            obj = pickle.load(pkl_file)
-            return obj
-    else:
-        return None
+def load_isochrone_data(filename, data_dir=DATA_DIR):
+    """
+    One of the build's own intermediate files, written by 
+    `save_isochrone_data` earlier in the same build into `data_dir`. Nothing 
+    the app serves is read this way.
+    """
+    filepath = isochrone_data_path(filename, data_dir)
+    if not filepath.exists():
+        raise FileNotFoundError(f"{filepath} is missing. Run create_transit_graph.py to rebuild it.")
+    with open(filepath, "rb") as pkl_file:
+        return pickle.load(pkl_file)
 
 
-def average_travel_times_per_route(routes, trips, stop_times):
+def average_travel_times_per_route(routes, trips, stop_times, use_cache=True,
+                                   data_dir=DATA_DIR, processes=None):
     """
-    TKTKTK Explain. This is the big one.
+    The average time it takes to ride from each stop to every stop further 
+    down the line, per route. This is the big one.
+
+    Rather than looping trip by trip, `stop_times` is sorted once by route, 
+    trip and stop sequence. Every (origin, destination) pair along each trip 
+    is then laid out as flat arrays, so each route's pairwise travel times are 
+    a handful of NumPy operations and one groupby.
+
+    Each route's travel times are a DataFrame with the columns 
+    `origin_stop_id`, `destination_stop_id` and `transit_travel_time`, in 
+    minutes, averaged across every trip that rides between the two stops.
+
+    Most routes run the same schedule on every weekday. With `use_cache`, 
+    each route's result is saved under a fingerprint of its schedule in 
+    `route_cache_dir(data_dir)` and reused whenever a later build into 
+    `data_dir`, for any date, finds the same schedule. Routes the build 
+    didn't use are then pruned from the cache.
+
+    Routes that aren't cached are spread over a pool of `processes`, one per 
+    CPU by default. Each worker is sent only its own route's rows, and results 
+    are collected in route order, so the output is the same as with 
+    `processes=1`, which runs everything in this process.
     """
     print("Calculating travel times between stops per route.")
-
+    stop_times = sort_stop_times_by_trip(trips, stop_times)
+    route_ids = stop_times["route_id"].values
+    cache_dir = route_cache_dir(data_dir)
+    if use_cache:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    
     travel_times_per_route = {}
-    for route_id in routes["route_id"].values:
-        print(f"Determining travel times for route {route_id}")
-        trip_ids = trips[trips["route_id"] == route_id]["trip_id"]
-        trip_ids = trip_ids.value_counts().index
-
-        if trip_ids.shape[0] > 0:
-            pairwise_dfs = []
-            for trip_id in tqdm(trip_ids):
-                single_trip = stop_times[stop_times["trip_id"] == trip_id]
-
-                # Remove duplicated stop IDs
-                # Because why are there repeated stop IDs??
-                single_trip.drop_duplicates(subset=["stop_id"], keep="first", inplace=True)
-
-                if single_trip.shape[0]:
-                    df = single_trip_pairwise_travel_times(single_trip)
-                    pairwise_dfs.append(df)
-
-            if pairwise_dfs:
-                average_travel_times = pd.concat(pairwise_dfs).groupby(level=0).mean()
-                travel_times_per_route[route_id] = average_travel_times
-                save_isochrone_data(
-                    travel_times_per_route, 
-                    "travel_times_per_route.pkl")
-            else:
-                print(f"No Stop Times for Trip IDs for route {route_id} in cleaned data.")
-        else:
-            print(f"No trips for route {route_id} in cleaned data.")
+    fingerprints = set()
+    partitions = {}
+    num_reused = 0
+    with span("route cache"):
+        for route_id in routes["route_id"].values:
+            start = np.searchsorted(route_ids, route_id, side="left")
+            stop = np.searchsorted(route_ids, route_id, side="right")
+            if start == stop:
+                print(f"No trips for route {route_id} in cleaned data.")
+                continue
+
+            route_stop_times = stop_times.iloc[start:stop]
+            filepath = None
+            if use_cache:
+                fingerprint = route_fingerprint(route_stop_times)
+                fingerprints.add(fingerprint)
+                filepath = cache_dir / f"{fingerprint}.arrays"
+                if filepath.exists():
+                    travel_times_per_route[route_id] = artifacts.load_table(filepath)
+                    num_reused += 1
+                    continue
+
+            # Filled in below, so routes stay in the same order either way
+            travel_times_per_route[route_id] = None
+            partitions[route_id] = (route_stop_times[ROUTE_COLUMNS], filepath)
+
+    with span("route travel times"):
+        for route_id, travel_times in zip(partitions, 
+                route_travel_times_in_pool(partitions, processes)):
+            filepath = partitions[route_id][1]
+            if filepath is not None:
+                artifacts.save_table(travel_times, filepath)
+            travel_times_per_route[route_id] = travel_times
+
+    travel_times_per_route = {route_id: canonical_travel_times(travel_times)
+                              for route_id, travel_times in travel_times_per_route.items()}
+
+    if use_cache:
+        print(f"Reused cached travel times for {num_reused} of {len(travel_times_per_route)} routes.")
+        num_pruned = prune_route_cache(cache_dir, fingerprints)
+        if num_pruned:
+            print(f"Removed {num_pruned} cached routes this build didn't use.")
+    save_isochrone_data(travel_times_per_route, "travel_times_per_route.pkl", data_dir)
     print("✓")
 
 
-def single_trip_pairwise_travel_times(df):
-    """Compute pairwise travel times between stops for a single trip"""
-    df = df.sort_values(by="stop_sequence")
-    pairwise_td = df['arrival_time'].values[:, None] - df['arrival_time'].values
-    
-    to_minutes = lambda td: td / np.timedelta64(1, 'm')
-    pairwise_minutes = np.array(list(map(to_minutes, pairwise_td)))
-    
-    pairwise_df = pd.DataFrame(pairwise_minutes, index=df["stop_id"], columns=df["stop_id"])
-    pairwise_df.index.name = "Destination Stop"
-    pairwise_df = pairwise_df[pairwise_df > 0]
+def route_cache_dir(data_dir=DATA_DIR):
+    return data_dir / "route_cache"
+
+
+def prune_route_cache(cache_dir, fingerprints):
+    """
+    Deletes every cached route whose schedule isn't one of `fingerprints`, 
+    such as routes that have since changed or were cached by an older 
+    `ROUTE_CACHE_VERSION`. Returns how many were deleted.
+    """
+    num_pruned = 0
+    for filepath in cache_dir.glob("*.arrays"):
+        if filepath.stem in fingerprints:
+            continue
+        try:
+            filepath.unlink()
+            num_pruned += 1
+        except FileNotFoundError:
+            pass
+    return num_pruned
+
+
+def route_travel_times_in_pool(partitions, processes=None):
+    """
+    `route_pairwise_travel_times` for each of `partitions`, in order. With 
+    more than one process, routes are handed out a few at a time, the longest 
+    first so no worker is left with a big one at the end.
+    """
+    partitions = [route_stop_times for route_stop_times, _ in partitions.values()]
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(1, min(processes, len(partitions)))
+    if processes == 1:
+        return [route_pairwise_travel_times(partition) for partition in tqdm(partitions)]
+
+    order = sorted(range(len(partitions)), key=lambda ii: -partitions[ii].shape[0])
+    results = [None] * len(partitions)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        travel_times = executor.map(route_pairwise_travel_times, 
+            [partitions[ii] for ii in order], chunksize=4)
+        for ii, route_travel_times in zip(order, tqdm(travel_times, total=len(order))):
+            results[ii] = route_travel_times
+    return results
+
+
+def canonical_travel_times(travel_times):
+    """
+    One route's travel times rebuilt from fresh arrays. Tables that come back 
+    from a worker or the cache hold equal but separate copies of objects, 
+    such as dtypes, that tables made here share, and pickle writes shared 
+    objects once. Rebuilding every table the same way means the saved pickle 
+    is the same bytes however the routes were computed.
+    """
+    return pd.DataFrame({
+        column: travel_times[column].values.astype(np.dtype(travel_times[column].dtype.str))
+        for column in TRAVEL_TIME_COLUMNS})
+
+
+def route_fingerprint(route_stop_times):
+    """
+    A fingerprint of one route's schedule: which stops each trip visits, in 
+    what order and at what times. Trip IDs and service IDs change from one 
+    date to the next even when the buses don't, so they are left out. Each 
+    trip is hashed as the sum of its rows' hashes, and the trips' hashes are 
+    sorted, so neither the labels nor the order of the trips matter. Expects 
+    the stop times for one route, sorted by trip and then stop sequence.
+    """
+    trip_ids = route_stop_times["trip_id"].values
+    new_trip = np.ones(trip_ids.shape[0], dtype=bool)
+    new_trip[1:] = trip_ids[1:] != trip_ids[:-1]
+
+    columns = ["stop_id", "stop_sequence", "arrival_seconds"]
+    row_hashes = pd.util.hash_pandas_object(route_stop_times[columns], 
+        index=False).values
+    trip_hashes = np.add.reduceat(row_hashes, np.flatnonzero(new_trip))
+
+    digest = hashlib.sha256(f"route travel times v{ROUTE_CACHE_VERSION}".encode("utf-8"))
+    digest.update(np.sort(trip_hashes).tobytes())
+    return digest.hexdigest()
+
+
+def sort_stop_times_by_trip(trips, stop_times):
+    """
+    Label each stop time with its route, then sort by route, trip and stop 
+    sequence so that every route, and every trip within it, is one contiguous 
+    block of rows.
+    """
+    stop_times = stop_times.merge(trips[["trip_id", "route_id"]], on="trip_id")
+    stop_times = stop_times.sort_values(by=["route_id", "trip_id", "stop_sequence"])
+
+    # Remove duplicated stop IDs within a trip, keeping the first visit
+    # Because why are there repeated stop IDs??
+    stop_times = stop_times.drop_duplicates(subset=["trip_id", "stop_id"], keep="first")
+    stop_times["arrival_seconds"] = seconds_since_midnight(stop_times["arrival_time"])
+    return stop_times.reset_index(drop=True)
+
+
+def seconds_since_midnight(times):
+    """
+    Seconds since midnight, as int32, for a column of times from a cleaned 
+    stop times table. Tables cleaned by older versions hold datetimes.
+    """
+    times = times.values
+    if np.issubdtype(times.dtype, np.datetime64):
+        times = (times - times.astype("datetime64[D]")) // np.timedelta64(1, "s")
+    elif not np.issubdtype(times.dtype, np.integer):
+        return parse_gtfs_times(times)
+    return times.astype(np.int32)
+
+
+def route_pairwise_travel_times(route_stop_times):
+    """
+    Average pairwise travel times between stops for a single route. Expects 
+    the stop times for one route, sorted by trip and then stop sequence.
+    """
+    trip_ids = route_stop_times["trip_id"].values
+    stop_ids = route_stop_times["stop_id"].values
+    seconds = route_stop_times["arrival_seconds"].values
+    num_rows = trip_ids.shape[0]
+
+    # Where each row's trip ends, and so how many stops follow it
+    new_trip = np.ones(num_rows, dtype=bool)
+    new_trip[1:] = trip_ids[1:] != trip_ids[:-1]
+    trip_starts = np.flatnonzero(new_trip)
+    trip_lengths = np.diff(np.append(trip_starts, num_rows))
+    trip_ends = np.repeat(trip_starts + trip_lengths, trip_lengths)
+    num_downstream = trip_ends - np.arange(num_rows) - 1
+
+    # Every (origin, destination) pair where the destination comes later on 
+    # the same trip
+    origins = np.repeat(np.arange(num_rows), num_downstream)
+    first_pair = np.cumsum(num_downstream) - num_downstream
+    offsets = np.arange(origins.shape[0]) - np.repeat(first_pair, num_downstream)
+    destinations = origins + offsets + 1
+
+    minutes = (seconds[destinations] - seconds[origins]) / 60
+    keep = minutes > 0
+
+    pairwise_df = pd.DataFrame({
+        "origin_stop_id":       stop_ids[origins[keep]],
+        "destination_stop_id":  stop_ids[destinations[keep]],
+        "transit_travel_time":  minutes[keep],
+    })
+    pairwise_df = pairwise_df.groupby(["origin_stop_id", "destination_stop_id"], 
+        as_index=False)["transit_travel_time"].mean()
     return pairwise_df
 
 
-def average_arrival_rates_per_stop(stop_times):
+def average_arrival_rates_per_stop(stop_times, data_dir=DATA_DIR):
     """
     To calculate the average arrival rates of buses and trains, we simply count 
     the number of buses/trains per hour, take the average, then the inverse.
+
+    The counts per stop and hour are saved as well, so wait times can be 
+    taken for any hours of the day without going back to the schedule.
     """
     print("Calculating average arrival frequencies for buses and trains.")
     # Buses per Hour
-    df = stop_times.groupby(["stop_id","hour_of_arrival"])[["trip_id"]].count()
-    df = df.reset_index().groupby("stop_id")[["trip_id"]].mean()
+    stop_ids, hourly_arrivals = hourly_arrivals_per_stop(stop_times)
+    hours_with_service = np.count_nonzero(hourly_arrivals, axis=1)
+    average_buses_per_hour = hourly_arrivals.sum(axis=1) / hours_with_service
 
     # Minutes per Bus
-    df = df.rename(columns={"trip_id": "average_buses_per_hour"})
-    df["avg_minutes_btwn_buses"] = 60/df["average_buses_per_hour"]
+    avg_minutes_btwn_buses = 60 / average_buses_per_hour
 
     # Convert to dictionary
-    stops_ids = df.index.values
-    rates = df["avg_minutes_btwn_buses"].values
-    arrival_rates = {_id:rate for _id, rate in zip(stops_ids, rates)}
+    arrival_rates = {_id:rate for _id, rate in zip(stop_ids.tolist(), 
+                                                   avg_minutes_btwn_buses.tolist())}
 
-    save_isochrone_data(arrival_rates, "average_arrival_rates_per_stop.pkl")
+    save_isochrone_data(arrival_rates, "average_arrival_rates_per_stop.pkl", data_dir)
+    save_isochrone_data((stop_ids, hourly_arrivals), "hourly_arrivals_per_stop.pkl", data_dir)
 
 
-def find_graph_node_IDs_for_transit_stops(stops, citywide_graph):
+def hourly_arrivals_per_stop(stop_times):
+    """
+    How many buses and trains arrive at each stop in each hour of the day, as 
+    a float32 array with a row per stop and a column per hour. Rows follow 
+    the sorted array of stop IDs returned with it. Every stop time is counted 
+    in one pass, by numbering the stops and binning on stop and hour together.
+    """
+    stop_index, stop_ids = pd.factorize(stop_times["stop_id"], sort=True)
+    hours = stop_times["hour_of_arrival"].values.astype(np.int64)
+    num_stops = len(stop_ids)
+    num_hours = max(HOURS_PER_DAY, int(hours.max()) + 1)
+    counts = np.bincount(stop_index * num_hours + hours, 
+                         minlength=num_stops * num_hours)
+    return np.asarray(stop_ids), counts.reshape(num_stops, num_hours).astype(np.float32)
+
+
+def find_graph_node_IDs_for_transit_stops(stops, citywide_graph, data_dir=DATA_DIR):
     """
     We don't need to put the transit stops on the map, we simply need to find
     the graph node closest to each stop. For our purposes, they don't even need 
@@ -315,37 +760,37 @@ def find_graph_node_IDs_for_transit_stops(stops, citywide_graph):
     print("Maping transit stop IDs to graph node IDs.")
     lats = stops["stop_lat"].values
     lons = stops["stop_lon"].values
-    graph_nodes = ox.distance.nearest_nodes(citywide_graph, lons, lats)
-    graph_nodes = [node if isinstance(node, int) else node[0] for node in graph_nodes]
+    graph_nodes = index_for_graph(citywide_graph).nearest_nodes(lats, lons)
+    graph_nodes = graph_nodes.tolist()
 
     stop_ids = stops["stop_id"].values
     stop_id_to_graph_id = {s_id:g_id for s_id, g_id in zip(stop_ids, graph_nodes)}
     graph_id_to_stop_id = {g_id:s_id for s_id, g_id in zip(stop_ids, graph_nodes)}
 
-    save_isochrone_data(stop_id_to_graph_id, "stop_id_to_graph_id.pkl")
-    save_isochrone_data(graph_id_to_stop_id, "graph_id_to_stop_id.pkl")
+    save_isochrone_data(stop_id_to_graph_id, "stop_id_to_graph_id.pkl", data_dir)
+    save_isochrone_data(graph_id_to_stop_id, "graph_id_to_stop_id.pkl", data_dir)
 
 
 ############################### Transit Graph ###############################
 
 # @timer_func
-def build_and_save_transit_graph():
+def build_and_save_transit_graph(data_dir=DATA_DIR):
     print("Loading Data")
-    stop_id_to_graph_id = load_isochrone_data("stop_id_to_graph_id.pkl")
-    average_arrival_rates_per_stop = load_isochrone_data("average_arrival_rates_per_stop.pkl")
-    travel_times_per_route = load_isochrone_data("travel_times_per_route.pkl")
+    stop_id_to_graph_id = load_isochrone_data("stop_id_to_graph_id.pkl", data_dir)
+    average_arrival_rates_per_stop = load_isochrone_data("average_arrival_rates_per_stop.pkl", data_dir)
+    travel_times_per_route = load_isochrone_data("travel_times_per_route.pkl", data_dir)
 
-    # Concatenate Route Pairwise Travel Times
+    # Concatenate Route Pairwise Travel Times, keeping the quickest route
     print("Concatenating DataFrames")
     full_pairwise_df = pd.concat(list(travel_times_per_route.values()))
-    full_pairwise_df = full_pairwise_df.groupby(level=0).min()
+    stacked = full_pairwise_df.groupby(["origin_stop_id", "destination_stop_id"], 
+        as_index=False)["transit_travel_time"].min()
 
-    # Label properly and stack
-    print("Stacking")
-    full_pairwise_df.index.name = "Destination Node"
-    full_pairwise_df.columns.name = "Origin Node"
-    stacked = pd.DataFrame(full_pairwise_df.T.stack()).reset_index().dropna()
-    stacked.rename(columns={0: "transit_travel_time"}, inplace=True)
+    # Label properly
+    stacked.rename(columns={
+        "origin_stop_id": "Origin Node", 
+        "destination_stop_id": "Destination Node"}, 
+        inplace=True)
 
     # Build the graph
     print("Building the graph")
@@ -360,12 +805,14 @@ def build_and_save_transit_graph():
     for edge in graph.edges(data=True):
         origin_node = edge[0]
         edge[2]['wait_time'] = average_arrival_rates_per_stop[origin_node]
+        edge[2]['origin_stop_id'] = origin_node
 
     # Index by graph node not Stop ID
     graph = nx.relabel_nodes(graph, stop_id_to_graph_id)
 
     # save_isochrone_data(graph, "transit_graph.pkl")
-    filepath = DATA_DIR / "transit_graph.pkl"
-    with open(filepath, "wb") as pkl_file:
+    filepath = data_dir / "transit_graph.pkl"
+    with atomic_write(filepath) as pkl_file:
             pickle.dump(graph, pkl_file)
-    print("✓")
\ No newline at end of file
+    print("✓")
+    return graph
\ No newline at end of file
@@ -3,21 +3,85 @@ from collections import defaultdict
 
 import osmnx as ox
 import networkx as nx
+import pandas as pd
 
 import src.graphs as graphs
+from src.routing import multimodal_travel_times
+from src.csr_graph import CSRGraph
+from src.rendering import EdgeGeometry, render_edges
+from src.connection_scan import clock_seconds
+from src.frequency_sweep import FrequencySweep
+from src.metrics import isochrone_metrics
+from src.graph_store import default_store
+from src.geocoding import default_geocoder, outline
+from src.filepaths import DATA_DIR
 # import src.gtfs as gtfs
-from . import utils
 from src.utils import timer_func
+from src.tracing import span, traced
+
+
+# "networkx" searches the graphs as loaded. "csr" copies them into NumPy arrays
+# and searches with scipy, which is quicker and gives the same isochrones.
+ENGINES = ("networkx", "csr")
+
+
+def check_engine(engine):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine}. Choose one of {ENGINES}.")
+    return engine
+
+
+# "osmnx" draws maps with `ox.plot_graph`. "fast" colors every edge at once from
+# the search arrays and draws them as a single LineCollection. It needs the
+# "csr" engine.
+RENDERERS = ("osmnx", "fast")
+
+
+def check_renderer(renderer, engine):
+    if renderer not in RENDERERS:
+        raise ValueError(f"Unknown renderer {renderer}. Choose one of {RENDERERS}.")
+    if renderer == "fast" and engine != "csr":
+        raise ValueError("The fast renderer only works with the csr engine.")
+    return renderer
 
 
 class WalkingIsochrone:
-    def __init__(self, citywide_graph=None):
+    def __init__(self, citywide_graph=None, engine="networkx", cache=None,
+                 renderer="osmnx", csr_graph=None, edge_geometry=None, 
+                 node_index=None):
+        """
+        With the "csr" engine, searches are remembered in `cache`, an 
+        `IsochroneCache`, if one is given. The csr engine and fast renderer 
+        can work from a `csr_graph`, `edge_geometry` and `node_index` that 
+        are already loaded, without a `citywide_graph` (see `from_store`).
+        """
         self.citywide_graph = citywide_graph
+        self.engine = check_engine(engine)
+        self.renderer = check_renderer(renderer, self.engine)
+        self.csr_graph = csr_graph
+        self.edge_geometry = edge_geometry
+        self.node_index = node_index
+        self.cache = cache
         
         # TODO: calculate this by finding the center of the provided graph
         self.starting_lat_long = None
 
 
+    @classmethod
+    def from_store(cls, city, store=None, cache=None, data_dir=DATA_DIR):
+        """
+        A csr engine, fast renderer isochrone over the city's saved graph
+        arrays, shared through a `GraphStore`. The networkx graph is never 
+        loaded. The arrays include transit, but walking searches leave it out.
+        """
+        if store is None:
+            store = default_store()
+        return cls(engine="csr", cache=cache, renderer="fast",
+            csr_graph=store.csr_graph(city, data_dir), 
+            edge_geometry=store.edge_geometry(city, data_dir),
+            node_index=store.node_index(city, data_dir))
+
+
     def download_citywide_graph(self, address):
         network_type = "all"
         graph = ox.graph_from_place(address,
@@ -28,8 +92,11 @@ class WalkingIsochrone:
 
         graph = graphs.add_walking_times_to_graph(graph)
         self.citywide_graph = graph
+        self.csr_graph = None
+        self.edge_geometry = None
 
 
+    @traced("walking isochrone")
     def make_isochrone(self, starting_lat_lon, trip_times=None, filepath=None, 
                        bgcolor="#262730"):
         """A Walking Only Isochrone"""
@@ -44,26 +111,39 @@ class WalkingIsochrone:
             return_hex=True)
 
         # Node closest to starting address
-        starting_node = graphs.get_nearest_node(
-            self.citywide_graph, 
-            starting_lat_lon)
+        starting_node = self.get_nearest_node(starting_lat_lon)
+
+        if filepath is None:
+            filepath = "plots/user_isochrone.png"
 
-        # Make subgraphs and color each by trip time
+        if self.renderer == "fast":
+            trip_times = sorted(trip_times, reverse=True)
+            travel_times = self.csr_search(starting_node, max(trip_times))
+            edge_geometry = self.get_edge_geometry()
+            with span("color edges"):
+                color_index = edge_geometry.color_edges(
+                    [(travel_times, trip_time) for trip_time in trip_times])
+            with span("render"):
+                render_edges(edge_geometry, color_index, iso_colors, 
+                    filepath=filepath, bgcolor=bgcolor)
+            return
+
+        # Make subgraphs and color each by trip time. One search reaches out 
+        # to the longest trip time and the shorter ones are sliced from it.
         node_colors = {}
         edge_colors = {}
         trip_times = sorted(trip_times, reverse=True)
+        travel_times = self.travel_times_from_node(starting_node, max(trip_times))
         furthest_walking_graph = None
-        for trip_time, color in zip(trip_times, iso_colors):
-            subgraph = self.make_subgraph(starting_node, trip_time)
-            for node in subgraph.nodes():
-                node_colors[node] = color
-            for edge in subgraph.edges():
-                edge_colors[edge] = color
-            if furthest_walking_graph is None:
-                furthest_walking_graph = subgraph
-
-            # Since we go in reverse, we can reduce the city graph each time
-            self.citywide_graph = subgraph
+        with span("color edges"):
+            for trip_time, color in zip(trip_times, iso_colors):
+                subgraph = self.subgraph_within(travel_times, trip_time)
+                for node in subgraph.nodes():
+                    node_colors[node] = color
+                for edge in subgraph.edges():
+                    edge_colors[edge] = color
+                if furthest_walking_graph is None:
+                    furthest_walking_graph = subgraph
 
         # Plot Colors
         # graph = self.citywide_graph
@@ -75,89 +155,215 @@ class WalkingIsochrone:
         ns = [0 for _ in graph.nodes()]
 
         # Plot
-        if filepath is None:
-            filepath = "plots/user_isochrone.png"
-
         filepath = Path(filepath)
-        fig, ax = ox.plot_graph(graph, 
-            node_color=nc, edge_color=ec, node_size=ns,
-            node_alpha=0.8, node_zorder=2, bgcolor=bgcolor, edge_linewidth=0.2,
-            show=False, save=True, filepath=filepath, dpi=300)
+        with span("render"):
+            fig, ax = ox.plot_graph(graph, 
+                node_color=nc, edge_color=ec, node_size=ns,
+                node_alpha=0.8, node_zorder=2, bgcolor=bgcolor, edge_linewidth=0.2,
+                show=False, save=True, filepath=filepath, dpi=300)
         
 
-    def make_subgraph(self, starting_node, trip_time):
-        subgraph = nx.ego_graph(
-            self.citywide_graph, 
+    def travel_times_from_node(self, starting_node, max_trip_time):
+        """
+        Walking time, in minutes, to every node that can be reached within 
+        `max_trip_time`.
+        """
+        if self.engine == "csr":
+            return self.csr_graph_for_search().as_dict(
+                self.csr_search(starting_node, max_trip_time))
+
+        with span("search"):
+            travel_times = nx.single_source_dijkstra_path_length(
+                self.citywide_graph, 
+                starting_node, 
+                cutoff=max_trip_time, 
+                weight="travel_time")
+        return travel_times
+
+
+    def subgraph_within(self, travel_times, trip_time):
+        """
+        The subgraph of every node reachable within `trip_time`. This matches 
+        `nx.ego_graph`, as a read-only view of the citywide graph.
+        """
+        nodes = [node for node, time in travel_times.items() if time <= trip_time]
+        return self.citywide_graph.subgraph(nodes)
+
+
+    def csr_graph_for_search(self):
+        if self.csr_graph is None:
+            self.csr_graph = CSRGraph.from_networkx(self.citywide_graph)
+        return self.csr_graph
+
+
+    @traced("search")
+    def csr_search(self, starting_node, max_trip_time):
+        """Walking times to every node as an array, infinite past `max_trip_time`"""
+        return self.csr_graph_for_search().search(
             starting_node, 
-            radius=trip_time, 
-            distance='travel_time')
-        return subgraph
+            cutoff=max_trip_time,
+            cache=self.cache)
+
+
+    def get_edge_geometry(self):
+        if self.edge_geometry is None:
+            self.edge_geometry = EdgeGeometry.from_networkx(
+                self.citywide_graph, self.csr_graph_for_search().node_ids)
+        return self.edge_geometry
+
+
+    def get_nearest_node(self, starting_lat_lon):
+        if self.node_index is not None:
+            return self.node_index.nearest_node(starting_lat_lon)
+        return graphs.get_nearest_node(self.citywide_graph, starting_lat_lon)
+
+
+    @traced("walking metrics")
+    def metrics(self, starting_lat_lon, trip_times=None):
+        """
+        Street kilometers, area, stops and median time reached within each of 
+        `trip_times`, from one search and without drawing anything. See 
+        `src/metrics.py`.
+        """
+        if trip_times is None:
+            trip_times = [15, 30, 45, 60]
+        starting_node = self.get_nearest_node(starting_lat_lon)
+        travel_times = self.csr_search(starting_node, max(trip_times))
+        csr_graph = self.csr_graph_for_search()
+        return isochrone_metrics(travel_times, trip_times, csr_graph.node_x, 
+            csr_graph.node_y, self.get_edge_geometry(), csr_graph.stop_nodes)
 
 
 
 class TransitIsochrone:
-    def __init__ (self, app_data_directory, city):
+    def __init__ (self, app_data_directory, city, engine="networkx", cache=None,
+                  renderer="osmnx", use_stop_table=False, store=None):
         """
-        TKTK
+        With the "csr" engine, searches are remembered in `cache`, an 
+        `IsochroneCache`, if one is given. The "fast" renderer draws maps 
+        from the search arrays instead of with osmnx. With `use_stop_table`, 
+        transit is looked up in the city's precomputed `StopTable`, when 
+        there is one, instead of being searched.
+
+        Graphs come from `store`, a `GraphStore`, which is the one shared by 
+        the whole process unless another is given.
         """
         self.app_data_directory = app_data_directory
         self.city = city
+        self.engine = check_engine(engine)
+        self.renderer = check_renderer(renderer, self.engine)
+        self.cache = cache
+        self.use_stop_table = use_stop_table
+        self.store = default_store() if store is None else store
         self.load_data_files()
 
 
-    def load_data_files(self):
-        # TODO: make this selfsufficient
-        self.citywide_graph = graphs.load_citywide_graph(self.city)
-        nx.set_edge_attributes(self.citywide_graph, True, "display")
-        filepath = self.app_data_directory / "transit_graph.pkl"
-        self.transit_graph = utils.read_pickle(filepath)
+    @property
+    def citywide_graph(self):
+        """
+        The networkx walking graph, loaded the first time it's needed. The csr 
+        engine with the fast renderer never needs it.
+        """
+        return self.store.citywide_graph(self.city)
 
 
-    def set_graph_weights(self, freq_multiplier, reset_city_graph=False):
+    @property
+    def transit_graph(self):
+        return self.store.transit_graph(self.app_data_directory)
+
+
+    @traced("load graph")
+    def load_data_files(self):
         """
-        The transit graph weights are the total travel times from each stop, 
-        which is the sum of the time spent waiting for the bus and the time 
-        spent riding the bus. We set it here so we can adjust the weights based
-        on the adjusted frequency of service.
+        Both graphs are loaded once per process and never modified. The 
+        transit graph weights are the total travel times from each stop, which 
+        is the sum of the time spent waiting for the bus and the time spent 
+        riding the bus. Those are computed during the search, adjusted for the 
+        frequency of service, so one instance can draw isochrones at any 
+        frequency.
         """
-        if reset_city_graph:
-            self.load_data_files()
-        
-        for orig, dest, edge_data in self.transit_graph.edges(data=True):
-            travel_time = edge_data["wait_time"]/freq_multiplier
-            travel_time += edge_data["transit_travel_time"]
-            self.citywide_graph.add_edge(orig, dest, travel_time=travel_time, display=False)
+        if self.engine == "csr":
+            if graphs.graph_artifact_path(self.city, self.app_data_directory).exists():
+                self.csr_graph = self.store.csr_graph(self.city, self.app_data_directory)
+            else:
+                self.csr_graph = CSRGraph.from_networkx(self.citywide_graph, 
+                                                        self.transit_graph)
+        else:
+            self.csr_graph = None
+
+        self.stop_table = None
+        if self.engine == "csr" and self.use_stop_table:
+            if graphs.stop_table_path(self.city, self.app_data_directory).exists():
+                stop_table = self.store.stop_table(self.city, self.app_data_directory)
+                if stop_table.graph_version == self.csr_graph.version:
+                    self.stop_table = stop_table
+                else:
+                    print("The stop table is out of date. Run create_transit_graph.py to rebuild it.")
+
+        # Loaded the first time an isochrone is asked for at a departure time
+        self.timetable = None
+
+        self.edge_geometry = None
+        if self.renderer == "fast":
+            self.get_edge_geometry()
+
+
+    def get_edge_geometry(self):
+        if self.edge_geometry is None:
+            walking_dir = graphs.walking_artifacts_dir(self.city, self.app_data_directory)
+            if graphs.edge_geometry_path(self.city, walking_dir).exists():
+                self.edge_geometry = self.store.edge_geometry(self.city, 
+                                                              self.app_data_directory)
+            else:
+                self.edge_geometry = EdgeGeometry.from_networkx(
+                    self.citywide_graph, self.csr_graph.node_ids)
+        return self.edge_geometry
 
 
+    @traced("transit isochrone")
     def make_isochrone(self, starting_lat_lon, 
                        trip_times=None, freq_multipliers=None, 
                        filepath=None, cmap="plasma", color=None, bgcolor="#262730",
                        use_city_bounds=False, bbox=None, ax=None,
-                       color_start=0, color_stop=1):
-        """A Walking and Transit Isochrone!!"""
+                       color_start=0, color_stop=1, departure_time=None,
+                       departure_hours=None):
+        """
+        A Walking and Transit Isochrone!! With a `departure_time`, such as 
+        "08:00", transit follows the day's timetable from that time rather 
+        than average frequencies, and `freq_multipliers` don't apply. Times 
+        after midnight are written "24:30", as in GTFS. With 
+        `departure_hours`, an hour of the day such as 8 or a window such as 
+        (7, 10), wait times are averaged over those hours instead of the 
+        whole day.
+        """
         if trip_times is None:
             trip_times = [15, 30, 45, 60]
 
         if freq_multipliers is None:
             freq_multipliers = [1.0]
-            
-        if len(freq_multipliers) == 1:
-            reset_city_graph = False
-        else:
-            reset_city_graph = True
 
         trip_times = sorted(trip_times, reverse=True)
         freq_multipliers = sorted(freq_multipliers, reverse=True)
         edge_colors = {}
 
-        # Make isochrones
+        if self.renderer == "fast":
+            return self.make_isochrone_fast(starting_lat_lon, trip_times, 
+                freq_multipliers, filepath, cmap, color, bgcolor, 
+                use_city_bounds, bbox, ax, color_start, color_stop, 
+                departure_time, departure_hours)
+
+        # Make isochrones. One search per frequency reaches out to the longest
+        # trip time, and every shorter trip time is sliced from that result.
         isochrones = defaultdict(dict)
-        for trip_time in trip_times:
-            for freq in freq_multipliers:
-                # reset_city_graph = True
-                graph = self.transit_isochrone(starting_lat_lon, trip_time, 
-                                               freq_multiplier=freq,
-                                               reset_city_graph=reset_city_graph)
+        starting_node = self.get_nearest_node(starting_lat_lon)
+        for freq in freq_multipliers:
+            travel_times = self.travel_times_from_node(starting_node, 
+                                                       max(trip_times),
+                                                       freq_multiplier=freq,
+                                                       departure_time=departure_time,
+                                                       departure_hours=departure_hours)
+            for trip_time in trip_times:
+                graph = self.subgraph_within(travel_times, trip_time)
                 isochrones[trip_time][freq] = graph
 
         # Assign Edge Colors
@@ -223,20 +429,21 @@ class TransitIsochrone:
         # bgcolor = "#262730"
 
         if ax is None:
-            _, ax = ox.plot_graph(graph, 
-                node_color=nc, edge_color=ec, node_size=ns,
-                node_alpha=0.8, node_zorder=2, bgcolor=bgcolor, edge_linewidth=0.2,
-                show=False, save=True, filepath=filepath, dpi=300, bbox=bbox)
+            with span("render"):
+                _, ax = ox.plot_graph(graph, 
+                    node_color=nc, edge_color=ec, node_size=ns,
+                    node_alpha=0.8, node_zorder=2, bgcolor=bgcolor, edge_linewidth=0.2,
+                    show=False, save=True, filepath=filepath, dpi=300, bbox=bbox)
             bbox = self.get_bbox_from_plot(ax)
         else:
-            city = ox.geocode_to_gdf('Chicago, Illinois')
-            x,y = city["geometry"].iloc[0].exterior.xy
+            x,y = outline(default_geocoder().boundary(self.city))
             ax.plot(x,y, color=color, linewidth=0.5)
 
-            fig, ax = ox.plot_graph(graph, ax=ax,
-                node_color=nc, edge_color=ec, node_size=ns,
-                node_alpha=0.8, node_zorder=2, bgcolor=bgcolor, edge_linewidth=0.2,
-                show=False, save=False, filepath=filepath, dpi=300, bbox=bbox)
+            with span("render"):
+                fig, ax = ox.plot_graph(graph, ax=ax,
+                    node_color=nc, edge_color=ec, node_size=ns,
+                    node_alpha=0.8, node_zorder=2, bgcolor=bgcolor, edge_linewidth=0.2,
+                    show=False, save=False, filepath=filepath, dpi=300, bbox=bbox)
 
             ax.set_facecolor(bgcolor)
             ax.set_axis_on() 
@@ -244,11 +451,90 @@ class TransitIsochrone:
         return bbox
 
 
+    def make_isochrone_fast(self, starting_lat_lon, trip_times, freq_multipliers,
+                            filepath, cmap, color, bgcolor, use_city_bounds, 
+                            bbox, ax, color_start, color_stop, departure_time,
+                            departure_hours):
+        """
+        `make_isochrone` with the fast renderer. Edges are colored the same
+        way, straight from the arrays of travel times, and the map is framed 
+        the same way.
+        """
+        starting_node = self.get_nearest_node(starting_lat_lon)
+        if len(trip_times) == 1 and len(freq_multipliers) > 1 and departure_time is None:
+            # One sweep finds every frequency's isochrone. A node is in the
+            # isochrone at any multiplier at least its threshold.
+            sweep = self.sweep_from_node(starting_node, trip_times[0], 
+                                         freq_multipliers, departure_hours)
+            reach = lambda freq, trip_time: (sweep.thresholds, freq)
+        else:
+            travel_times = {freq: self.csr_search(starting_node, max(trip_times), 
+                                                  freq, departure_time, departure_hours)
+                            for freq in freq_multipliers}
+            reach = lambda freq, trip_time: (travel_times[freq], trip_time)
+
+        # Layers are painted in order, so later, smaller ones end up on top
+        layers, colors = [], []
+        if len(trip_times) == 1 and len(freq_multipliers) == 1:
+            layers = [reach(freq_multipliers[0], trip_times[0])]
+            colors = ["#999999" if color is None else color]
+
+        elif len(freq_multipliers) == 1:
+            # Color Subgraphs by Trip Time
+            freq = freq_multipliers[0]
+            colors = ox.plot.get_colors(len(trip_times),
+                cmap=cmap, 
+                return_hex=True)
+            layers = [reach(freq, trip_time) for trip_time in trip_times]
+
+        elif len(trip_times) == 1:
+            # Color Subgraph by Frequency
+            trip_time = trip_times[0]
+            colors = ox.plot.get_colors(len(freq_multipliers),
+                cmap=cmap,
+                start=color_start,
+                stop=color_stop,
+                return_hex=True)
+            layers = [reach(freq, trip_time) for freq in freq_multipliers]
+
+        with span("color edges"):
+            color_index = self.edge_geometry.color_edges(layers)
+            extent_edges = self.edge_geometry.edges_within(
+                *reach(max(freq_multipliers), max(trip_times)))
+
+        # Plot
+        if filepath is None:
+            filepath = "plots/user_transit_isochrone.png"
+
+        if use_city_bounds:
+            bbox = (self.csr_graph.node_y.max(), self.csr_graph.node_y.min(),
+                    self.csr_graph.node_x.max(), self.csr_graph.node_x.min())
+
+        if ax is None:
+            with span("render"):
+                ax, _ = render_edges(self.edge_geometry, color_index, colors, 
+                    filepath=filepath, bbox=bbox, extent_edges=extent_edges, 
+                    bgcolor=bgcolor)
+            bbox = self.get_bbox_from_plot(ax)
+        else:
+            x,y = outline(default_geocoder().boundary(self.city))
+            ax.plot(x,y, color=color, linewidth=0.5)
+
+            with span("render"):
+                render_edges(self.edge_geometry, color_index, colors, bbox=bbox, 
+                    extent_edges=extent_edges, ax=ax, bgcolor=bgcolor)
+            ax.set_facecolor(bgcolor)
+            ax.set_axis_on()
+
+        return bbox
+
+
+    @traced("color edges")
     def assign_edge_colors(self, subgraph, edge_colors, color):
         # print(f"Subgraph has {len(subgraph.nodes)} nodes and {len(subgraph.edges)} edges.")
         for edge_data in subgraph.edges(data=True):
             edge = (edge_data[0], edge_data[1])
-            if edge_data[2]["display"]:
+            if edge_data[2].get("display", True):
                 edge_colors[edge] = color
             else:
                 edge_colors[edge] = "none"
@@ -256,18 +542,140 @@ class TransitIsochrone:
 
 
     # @timer_func
-    def transit_isochrone(self, lat_lon, trip_time, freq_multiplier=1.0, reset_city_graph=False):
+    def transit_isochrone(self, lat_lon, trip_time, freq_multiplier=1.0, 
+                          departure_time=None, departure_hours=None):
         """
         Generate one isochrone for a single set of start parameters
         """
-        print(f"Tracing a transit isochrone for a {trip_time} minute trip at {freq_multiplier} times arrival rates.")
         starting_node = self.get_nearest_node(lat_lon)
-        self.set_graph_weights(freq_multiplier, reset_city_graph)
-        subgraph = nx.ego_graph(self.citywide_graph, starting_node, 
-            radius=trip_time, 
-            distance='travel_time')
-        subgraph.remove_edges_from([edge for edge in self.transit_graph.edges])
-        return subgraph
+        travel_times = self.travel_times_from_node(starting_node, trip_time, 
+                                                   freq_multiplier=freq_multiplier,
+                                                   departure_time=departure_time,
+                                                   departure_hours=departure_hours)
+        return self.subgraph_within(travel_times, trip_time)
+
+
+    def travel_times_from_node(self, starting_node, max_trip_time, 
+                               freq_multiplier=1.0, departure_time=None,
+                               departure_hours=None):
+        """
+        A single shortest path search from `starting_node`. Returns the travel 
+        time, in minutes, to every node that can be reached within 
+        `max_trip_time`. Isochrones for any shorter trip time can be sliced 
+        from this result without searching again.
+        """
+        if self.engine == "csr":
+            return self.csr_graph.as_dict(
+                self.csr_search(starting_node, max_trip_time, freq_multiplier,
+                                departure_time, departure_hours))
+
+        if departure_time is not None or departure_hours is not None:
+            raise ValueError("Departure times need the csr engine.")
+
+        with span("search"):
+            travel_times = multimodal_travel_times(
+                self.citywide_graph, 
+                self.transit_graph, 
+                starting_node, 
+                cutoff=max_trip_time, 
+                freq_multiplier=freq_multiplier)
+        return travel_times
+
+
+    @traced("search")
+    def csr_search(self, starting_node, max_trip_time, freq_multiplier=1.0,
+                   departure_time=None, departure_hours=None):
+        """Travel times to every node as an array, infinite past `max_trip_time`"""
+        if departure_time is not None:
+            departure_time = clock_seconds(departure_time)
+        return self.csr_graph.search(
+            starting_node, 
+            cutoff=max_trip_time, 
+            freq_multiplier=freq_multiplier,
+            cache=self.cache,
+            service_date=self.csr_graph.metadata.get("service_date"),
+            stop_table=self.stop_table,
+            timetable=self.get_timetable() if departure_time is not None else None,
+            departure_time=departure_time,
+            hours=departure_hours)
+
+
+    def frequency_sweep(self, starting_lat_lon, trip_time, freq_multipliers=None,
+                        departure_hours=None):
+        """
+        A `FrequencySweep` from `starting_lat_lon`: the smallest frequency 
+        multiplier at which each node can be reached within `trip_time`, over 
+        `freq_multipliers`, or by default a fine grid from a quarter of 
+        today's service to four times it. Its `reach_curve` is how many nodes 
+        are reached at each.
+        """
+        starting_node = self.get_nearest_node(starting_lat_lon)
+        return self.sweep_from_node(starting_node, trip_time, freq_multipliers,
+                                    departure_hours)
+
+
+    @traced("frequency sweep")
+    def sweep_from_node(self, starting_node, trip_time, freq_multipliers=None,
+                        departure_hours=None):
+        if self.engine != "csr":
+            raise ValueError("Frequency sweeps need the csr engine.")
+        return FrequencySweep.run(self.csr_graph, starting_node, trip_time, 
+            freq_multipliers,
+            hours=departure_hours,
+            cache=self.cache,
+            service_date=self.csr_graph.metadata.get("service_date"),
+            stop_table=self.stop_table)
+
+
+    @traced("transit metrics")
+    def metrics(self, starting_lat_lon, trip_times=None, freq_multipliers=None,
+                departure_time=None, departure_hours=None):
+        """
+        Street kilometers, area, stops and median time reached within each of 
+        `trip_times` at each of `freq_multipliers`, one search per multiplier 
+        and nothing drawn, as a DataFrame with a row for each pair. See 
+        `src/metrics.py`. This needs the csr engine.
+        """
+        if self.engine != "csr":
+            raise ValueError("Metrics need the csr engine.")
+        if trip_times is None:
+            trip_times = [15, 30, 45, 60]
+        if freq_multipliers is None or departure_time is not None:
+            freq_multipliers = [1.0]
+
+        starting_node = self.get_nearest_node(starting_lat_lon)
+        edge_geometry = self.get_edge_geometry()
+        tables = []
+        for freq in sorted(freq_multipliers):
+            travel_times = self.csr_search(starting_node, max(trip_times), freq,
+                                           departure_time, departure_hours)
+            table = isochrone_metrics(travel_times, trip_times, self.csr_graph.node_x,
+                self.csr_graph.node_y, edge_geometry, self.csr_graph.stop_nodes)
+            table.insert(0, "freq_multiplier", freq)
+            tables.append(table)
+        return pd.concat(tables, ignore_index=True)
+
+
+    @traced("load timetable")
+    def get_timetable(self):
+        if self.timetable is None:
+            if not graphs.timetable_path(self.city, self.app_data_directory).exists():
+                raise FileNotFoundError("There is no timetable. Run create_transit_graph.py to build one.")
+            timetable = self.store.timetable(self.city, self.app_data_directory)
+            if timetable.metadata.get("graph_version") != self.csr_graph.version:
+                raise ValueError("The timetable is out of date. Run create_transit_graph.py to rebuild it.")
+            self.timetable = timetable
+        return self.timetable
+
+
+    @traced("subgraph")
+    def subgraph_within(self, travel_times, trip_time):
+        """
+        The walking subgraph of every node reachable within `trip_time`. This 
+        is a read-only view of the citywide graph, so it holds no transit edges.
+        """
+        nodes = [node for node, time in travel_times.items() if time <= trip_time]
+        return self.citywide_graph.subgraph(nodes)
 
 
     def get_bbox_from_graph(self, graph):
@@ -374,10 +782,8 @@ class TransitIsochrone:
 
     def get_nearest_node(self, location, graph=None, trip_times=None):
         """
-        Used to find the center node of the graph. If there is no one closest node, 
-        osmnx returns a list. Here we simply take the first node from that list. 
-        All the nodes will be right on top of each other and there's no point for 
-        our purposes in distinguishing between them.
+        Used to find the center node of the graph, with the spatial index 
+        shared by everything that uses the citywide graph.
         ---
         Reminder: Longitude is along the X axis. Latitude is along the Y axis. When 
         we speak we tend to say "lat long", implying latitude comes first. But 
@@ -385,16 +791,12 @@ class TransitIsochrone:
         coordinate system, longitude comes first. 
         """
         if graph is None:
+            if self.engine == "csr":
+                return self.store.node_index(self.city, 
+                    self.app_data_directory).nearest_node(location)
             graph = self.citywide_graph
 
-        lat = location[0]
-        lng = location[1]
-        nearest_node = ox.distance.nearest_nodes(graph, lng, lat)
-    
-        if not isinstance(nearest_node, int):
-            nearest_node = nearest_node[0]
-
-        return nearest_node
+        return graphs.get_nearest_node(graph, location)
 
 
     def walking_time_to_stop(self, graph, origin_node, dest_node):
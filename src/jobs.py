@@ -0,0 +1,198 @@
+"""
+Maps drawn in the background, so the app never waits on them.
+
+Drawing a transit map takes seconds, and a set of frequency maps several
+times that. Rather than drawing inside the Streamlit script, which holds up
+the session until it's done, the app submits a job to a `JobQueue` and polls
+it, showing progress, until it finishes.
+
+The queue runs jobs on a fixed number of threads, which share the graphs in
+the process's `GraphStore`. A job is identified by a key, such as the kind of
+map and the address. Submitting a key that is already queued, running or
+done hands back the same job, so a burst of people asking for the same
+address only draws it once, and finished jobs double as a cache of recent
+maps. Each submission counts as one subscriber, and a job is only cancelled
+once everyone who asked for it has cancelled.
+
+A job's function is called with the `Job` as its first argument. It reports
+progress with `job.report`, which is also where it stops if the job has been
+cancelled, so long jobs should report between steps.
+"""
+import time
+import hashlib
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from src.tracing import span
+
+
+# Maps drawn at once. Drawing is mostly Python, so more threads than this
+# mostly take turns.
+MAX_WORKERS = 2
+
+# Finished jobs kept for their results, oldest first out. Each holds its maps
+# as PNG bytes, so this bounds the memory they take.
+MAX_FINISHED_JOBS = 16
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, key, func, args, kwargs):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = "Waiting for a free worker"
+        self.result = None
+        self.error = None
+        self.subscribers = 1
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.cancelled = threading.Event()
+        self.future = None
+
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+
+    def report(self, progress, message=None):
+        """Record how far along the job is, from 0 to 1, and stop here if it's been cancelled"""
+        if self.cancelled.is_set():
+            raise JobCancelled(self.key)
+        self.progress = min(max(float(progress), 0.0), 1.0)
+        if message is not None:
+            self.message = message
+
+
+    def wait(self, timeout=None):
+        """Blocks until the job finishes. Returns whether it did."""
+        if self.future is None:
+            return self.finished
+        try:
+            self.future.exception(timeout)
+        except Exception:
+            pass
+        return self.finished
+
+
+class JobQueue:
+    def __init__(self, max_workers=MAX_WORKERS, max_finished=MAX_FINISHED_JOBS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+            thread_name_prefix="map-job")
+        self.max_finished = max_finished
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        The job for `key`, which calls `func(job, *args, **kwargs)`. A job for
+        the same key that hasn't failed or been cancelled is reused.
+        """
+        with self.lock:
+            job = self.jobs.get(key)
+            reusable = (job is not None and job.status not in (FAILED, CANCELLED)
+                        and not job.cancelled.is_set())
+            if reusable:
+                if not job.finished:
+                    job.subscribers += 1
+                self.jobs.move_to_end(key)
+                return job
+
+            job = Job(key, func, args, kwargs)
+            self.jobs[key] = job
+            self.prune()
+        job.future = self.executor.submit(self.run, job)
+        return job
+
+
+    def get(self, key):
+        with self.lock:
+            return self.jobs.get(key)
+
+
+    def cancel(self, key):
+        """
+        Drops one subscriber from the job for `key`, and cancels it if that
+        was the last. A running job stops the next time it reports progress.
+        """
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None or job.finished:
+                return
+            job.subscribers -= 1
+            if job.subscribers > 0:
+                return
+            job.cancelled.set()
+            if job.future is not None and job.future.cancel():
+                self.finish(job, CANCELLED)
+
+
+    def run(self, job):
+        if job.cancelled.is_set():
+            self.finish(job, CANCELLED)
+            return
+        job.status = RUNNING
+        job.message = "Starting"
+        try:
+            with span(f"job {job.func.__name__}"):
+                job.result = job.func(job, *job.args, **job.kwargs)
+            job.progress = 1.0
+            self.finish(job, DONE)
+        except JobCancelled:
+            self.finish(job, CANCELLED)
+        except Exception as error:
+            job.error = error
+            job.message = "".join(traceback.format_exception_only(type(error), error)).strip()
+            self.finish(job, FAILED)
+
+
+    def finish(self, job, status):
+        job.status = status
+        job.finished_at = time.time()
+
+
+    def prune(self):
+        """Forgets the oldest finished jobs past `max_finished`. Call with the lock held."""
+        finished = [key for key, job in self.jobs.items() if job.finished]
+        for key in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[key]
+
+
+    def counts(self):
+        """How many jobs are in each state"""
+        with self.lock:
+            jobs = list(self.jobs.values())
+        counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED, CANCELLED)}
+        for job in jobs:
+            counts[job.status] += 1
+        return counts
+
+
+def job_key(*parts):
+    """A short key for a job, from whatever identifies its result"""
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()[:16]
+
+
+# One queue per process, shared by every session of the app
+_default_queue = None
+_default_queue_lock = threading.Lock()
+
+
+def default_queue():
+    global _default_queue
+    with _default_queue_lock:
+        if _default_queue is None:
+            _default_queue = JobQueue()
+    return _default_queue
@@ -1,6 +1,9 @@
+import time
+import tempfile
+from io import BytesIO
+from pathlib import Path
 from zipfile import ZipFile
 
-import osmnx as ox
 # import networkx as nx
 import numpy as np
 import pandas as pd
@@ -13,7 +16,13 @@ from .text import TEXT
 import src.gtfs as gtfs
 import src.graphs as graphs
 from src.isochrones import WalkingIsochrone, TransitIsochrone
-from src.filepaths import DATA_DIR, FREQUENCY_DIR
+from src.cache import default_cache
+from src.graph_store import default_store
+from src.geocoding import default_geocoder
+import src.jobs as jobs
+from src.jobs import default_queue, job_key
+from src.tracing import traced
+from src.filepaths import DATA_DIR
 
 
 ################################ App Logic ################################
@@ -43,6 +52,7 @@ def initialize_session_state():
 
 ############################# Bus Arrival Rates #############################
 
+@traced("load tables")
 @st.cache_data
 def load_needed_tables():
     trips = gtfs.load_prepared_gtfs_table("trips")
@@ -241,13 +251,11 @@ def average_wait_time(bus_times, people_times):
 ############################## Geocode Check ##############################
 
 def address_can_be_found(address):
-    """Ensure that if the address cannot be found the site fails gracefully"""
-    try:
-        _ = ox.geocoder.geocode(address)
-        return True
-    except ValueError:
-        # Nominatim could not geocode the query
-        return False
+    """
+    Ensure that if the address cannot be found the site fails gracefully. The
+    answer is remembered, so the map that follows doesn't geocode it again.
+    """
+    return default_geocoder().can_be_found(address)
 
 
 def display_dora():
@@ -297,6 +305,7 @@ def walking_address_input():
     return address
 
 
+@traced("walking map")
 @geocode_check
 @st.cache_data()
 def make_walking_isochrone(address):
@@ -306,28 +315,31 @@ def make_walking_isochrone(address):
     st.session_state["walking_map_ready"] = False
     
     city = "Chicago, Illinois"
-    chicago = graphs.load_citywide_graph(city)
-    in_chicago, lat_lng = address_is_in_chicago(address, chicago)
+    in_chicago, lat_lng = address_is_in_chicago(address, city)
 
+    # Chicago's graph arrays are shared by every session
     if in_chicago:
-        graph = chicago
+        walking_isochrone = WalkingIsochrone.from_store(city, cache=default_cache())
     else:
         graph, lat_lng = graphs.download_graph_from_address(address)
+        walking_isochrone = WalkingIsochrone(citywide_graph=graph, engine="csr", 
+                                             cache=default_cache())
 
     filepath = "plots/user_generated_walking_isochrone.png"
-    walking_isochrone = WalkingIsochrone(citywide_graph=graph)
     _ = walking_isochrone.make_isochrone(lat_lng, filepath=filepath)
     st.session_state["walking_map_ready"] = True
 
 
-def address_is_in_chicago(address, chicago):
-    lat_lon = ox.geocoder.geocode(address)
+@traced("check address")
+def address_is_in_chicago(address, city="Chicago, Illinois"):
+    lat_lon = default_geocoder().geocode(address)
     lat, lon = lat_lon[0], lat_lon[1]
-    nearest_node = ox.distance.nearest_nodes(chicago, lon, lat)
-    if not isinstance(nearest_node, int):
-        nearest_node = nearest_node[0]
-    node_lat = chicago.nodes[nearest_node]["y"]
-    node_lon = chicago.nodes[nearest_node]["x"]
+    store = default_store()
+    csr_graph = store.csr_graph(city)
+    nearest_node = store.node_index(city).nearest_node(lat_lon)
+    position = csr_graph.index_of(nearest_node)
+    node_lat = float(csr_graph.node_y[position])
+    node_lon = float(csr_graph.node_x[position])
 
     threshold = 0.0008
     if abs(node_lat-lat) < threshold and abs(node_lon-lon) < threshold:
@@ -345,6 +357,64 @@ def walking_isochrone_download_button(st_col, street_address):
             mime="image/png",
             disabled=not st.session_state["walking_map_ready"])
 
+############################# Background Jobs #############################
+
+# Seconds between checks on a map that's being drawn
+POLL_SECONDS = 0.25
+
+
+def follow_job(state_key, key, func, *args):
+    """
+    Submits the job for `key` to the shared queue, unless this session is 
+    already following it, and stops following the job it asked for before. 
+    Shows progress until the job finishes, then reruns the script so that 
+    everything above, like the download buttons, sees the result.
+    """
+    queue = default_queue()
+    previous_key = st.session_state.get(state_key)
+    job = queue.get(key) if previous_key == key else None
+    if job is None or job.status in (jobs.FAILED, jobs.CANCELLED):
+        if previous_key is not None and previous_key != key:
+            queue.cancel(previous_key)
+        job = queue.submit(key, func, *args)
+        st.session_state[state_key] = key
+
+    if job.finished:
+        return job
+
+    # Changing the address stops this loop, and the next run cancels the job
+    progress_bar = st.progress(0.0, text=job.message)
+    while not job.finished:
+        progress_bar.progress(job.progress, text=job.message)
+        time.sleep(POLL_SECONDS)
+    progress_bar.empty()
+    st.rerun()
+
+
+def stop_following_job(state_key):
+    previous_key = st.session_state.get(state_key)
+    if previous_key is not None:
+        default_queue().cancel(previous_key)
+        st.session_state[state_key] = None
+
+
+def finished_maps(state_key):
+    """The maps drawn by this session's job, as PNG bytes by name, once it's done"""
+    key = st.session_state.get(state_key)
+    job = None if key is None else default_queue().get(key)
+    if job is None or job.status != jobs.DONE:
+        return None
+    return job.result.get("maps")
+
+
+def draw_to_png(isochrone, lat_lng, **kwargs):
+    """Draws a map and returns it as PNG bytes, so no file is shared between sessions"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filepath = Path(temp_dir) / "isochrone.png"
+        bbox = isochrone.make_isochrone(lat_lng, filepath=filepath, **kwargs)
+        return filepath.read_bytes(), bbox
+
+
 ############################### Transit Map ###############################
 
 
@@ -353,6 +423,8 @@ def transit_address_input():
     label = "Enter a Chicago address below to generate a map of everywhere transit can take you from that spot. This may take a few minutes."
     address = col1.text_input(label, key="transit_address",
         placeholder="Enter your Address")
+    if not address:
+        stop_following_job("transit_job")
 
     col2.write("")
     col2.write("")
@@ -360,29 +432,45 @@ def transit_address_input():
     return address
 
 
-@geocode_check
-@st.cache_data
+@traced("transit map")
 def make_transit_isochrone(address):
+    """Draws the map in the background, and shows progress until it's done"""
     st.session_state["transit_map_ready"] = False
-    
-    chicago = graphs.load_citywide_graph("Chicago, Illinois")
-    in_chicago, lat_lng = address_is_in_chicago(address, chicago)
-    
+    job = follow_job("transit_job", job_key("transit", address), 
+                     draw_transit_isochrone, address)
+
+    if job.status == jobs.FAILED:
+        st.error(f"Something went wrong drawing the map. {job.message}")
+    elif job.status == jobs.DONE:
+        if not job.result["found"]:
+            display_dora()
+        elif not job.result["in_chicago"]:
+            st.warning("Our apologies. We can only draw a transit map within the city of Chicago.")
+        else:
+            st.session_state["transit_map_ready"] = True
+
+
+def draw_transit_isochrone(job, address):
+    job.report(0.05, "Finding the address")
+    try:
+        in_chicago, lat_lng = address_is_in_chicago(address)
+    except ValueError:
+        # Nominatim could not geocode the query
+        return {"found": False}
     if not in_chicago:
-        st.warning("Our apologies. We can only draw a transit map within the city of Chicago.")
+        return {"found": True, "in_chicago": False}
 
-    else:
-        transit_isochrone = TransitIsochrone(DATA_DIR, "Chicago, Illinois")
-        # trip_times = [15, 30, 45, 60]
-        trip_times = [15, 30, 45]
-        freq_multipliers = [1]
-        filepath = "plots/user_generated_transit_isochrone.png"
-        transit_isochrone.make_isochrone(lat_lng, 
-            trip_times=trip_times, 
-            freq_multipliers=freq_multipliers,
-            filepath=filepath,
-            cmap="plasma")
-        st.session_state["transit_map_ready"] = True
+    job.report(0.2, "Tracing trips by transit")
+    transit_isochrone = TransitIsochrone(DATA_DIR, "Chicago, Illinois", 
+        engine="csr", cache=default_cache(), renderer="fast")
+    # trip_times = [15, 30, 45, 60]
+    trip_times = [15, 30, 45]
+    freq_multipliers = [1]
+    png, _ = draw_to_png(transit_isochrone, lat_lng, 
+        trip_times=trip_times, 
+        freq_multipliers=freq_multipliers,
+        cmap="plasma")
+    return {"found": True, "in_chicago": True, "maps": {"transit": png}}
 
 
 def transit_isochrone_download_button(st_col, address):
@@ -391,14 +479,18 @@ def transit_isochrone_download_button(st_col, address):
     else:
         street_address = None
 
-    filepath = "plots/user_generated_transit_isochrone.png" 
-    with open(filepath, "rb") as image_file:
-        st_col.download_button("Download Map", 
-            data=image_file,
-            file_name=f"{street_address}.png",
-            mime="image/png",
-            disabled=not st.session_state["transit_map_ready"],
-            key="transit_download")
+    maps = finished_maps("transit_job")
+    if maps is None:
+        with open("plots/user_generated_transit_isochrone.png", "rb") as image_file:
+            data = image_file.read()
+    else:
+        data = maps["transit"]
+    st_col.download_button("Download Map", 
+        data=data,
+        file_name=f"{street_address}.png",
+        mime="image/png",
+        disabled=maps is None,
+        key="transit_download")
 
 
 ############################## Frequency Maps ##############################
@@ -449,6 +541,8 @@ def frequency_address_input():
     """
     address = col1.text_input(label, key="frequency_address",
         placeholder="Enter your Address")
+    if not address:
+        stop_following_job("frequency_job")
 
     col2.write("")
     col2.write("")
@@ -456,43 +550,52 @@ def frequency_address_input():
     return address
 
 
-@geocode_check
-@st.cache_data
+@traced("frequency maps")
 def make_frequency_isochrones(address):
+    """Draws the maps in the background, and shows progress until they're done"""
     st.session_state["frequency_maps_ready"] = False
+    job = follow_job("frequency_job", job_key("frequency", address), 
+                     draw_frequency_isochrones, address)
 
-    lat_lon = ox.geocoder.geocode(address)
-    trip_times = [30]
+    if job.status == jobs.FAILED:
+        st.error(f"Something went wrong drawing the maps. {job.message}")
+    elif job.status == jobs.DONE:
+        if not job.result["found"]:
+            display_dora()
+        else:
+            st.session_state["frequency_maps_ready"] = True
 
-    freq_multipliers = [2]
-    filepath = FREQUENCY_DIR / "enhanced_service.png"
-    transit_isochrone = TransitIsochrone(DATA_DIR, "Chicago, Illinois")
-    bbox = transit_isochrone.make_isochrone(lat_lon, 
-        trip_times=trip_times, 
-        freq_multipliers=freq_multipliers,
-        filepath=filepath,
-        color="#4767AF")
 
-    freq_multipliers = [1]
-    filepath = FREQUENCY_DIR / "scheduled_service.png"
-    transit_isochrone = TransitIsochrone(DATA_DIR, "Chicago, Illinois")
-    _ = transit_isochrone.make_isochrone(lat_lon, 
-        trip_times=trip_times, 
-        freq_multipliers=freq_multipliers,
-        filepath=filepath,
-        color="#9EACCB",
-        bbox=bbox)
-
-    freq_multipliers = [0.5]
-    filepath = FREQUENCY_DIR / "reduced_service.png"
-    transit_isochrone = TransitIsochrone(DATA_DIR, "Chicago, Illinois")
-    _ = transit_isochrone.make_isochrone(lat_lon, 
-        trip_times=trip_times, 
-        freq_multipliers=freq_multipliers,
-        filepath=filepath,
-        color="#7C94CB",
-        bbox=bbox)
-    st.session_state["frequency_maps_ready"] = True
+def draw_frequency_isochrones(job, address):
+    job.report(0.05, "Finding the address")
+    try:
+        lat_lon = default_geocoder().geocode(address)
+    except ValueError:
+        # Nominatim could not geocode the query
+        return {"found": False}
+
+    trip_times = [30]
+    transit_isochrone = TransitIsochrone(DATA_DIR, "Chicago, Illinois", 
+        engine="csr", cache=default_cache(), renderer="fast")
+
+    # The first map sets the bounds for the others
+    maps, bbox = {}, None
+    services = [
+        ("enhanced_service", 2, "#4767AF"),
+        ("scheduled_service", 1, "#9EACCB"),
+        ("reduced_service", 0.5, "#7C94CB"),
+    ]
+    for ii, (name, freq_multiplier, color) in enumerate(services):
+        job.report(0.1 + 0.9 * ii / len(services), 
+                   f"Drawing the map at {freq_multiplier} times scheduled service")
+        maps[name], map_bbox = draw_to_png(transit_isochrone, lat_lon, 
+            trip_times=trip_times, 
+            freq_multipliers=[freq_multiplier],
+            color=color,
+            bbox=bbox)
+        if bbox is None:
+            bbox = map_bbox
+    return {"found": True, "maps": maps}
 
 
 def frequency_isochrone_download_button(st_col, address):
@@ -501,40 +604,31 @@ def frequency_isochrone_download_button(st_col, address):
     else:
         street_address = None
 
-    # deliberately using strings and not the Path objects
-    filenames = [
-        "user_generated_frequency_maps/enhanced_service.png",
-        "user_generated_frequency_maps/scheduled_service.png",
-        "user_generated_frequency_maps/reduced_service.png"
-    ]
-
-    zip_filename = "frequency_maps.zip"
-    zipObj = ZipFile(zip_filename, "w")
-    if st.session_state["frequency_maps_ready"]:
-        for filepath in filenames:
-            zipObj.write(filepath)
-    zipObj.close()
+    # Zipped in memory, so sessions don't write over each other's downloads
+    maps = finished_maps("frequency_job")
+    zip_buffer = BytesIO()
+    with ZipFile(zip_buffer, "w") as zip_file:
+        for name, png in (maps or {}).items():
+            zip_file.writestr(f"user_generated_frequency_maps/{name}.png", png)
 
-    with open(zip_filename, "rb") as zip_file:
-        st_col.download_button("Download Maps", 
-            data=zip_file,
-            file_name=f"{street_address}.zip",
-            disabled=not st.session_state["frequency_maps_ready"],
-            key="frequency_maps_download")
+    st_col.download_button("Download Maps", 
+        data=zip_buffer.getvalue(),
+        file_name=f"{street_address}.zip",
+        disabled=maps is None,
+        key="frequency_maps_download")
 
 
 def user_generated_thirty_minute_maps():
+    maps = finished_maps("frequency_job")
+    if maps is None:
+        return
     col1, col2, col3 = st.columns(3)
 
-    filename = FREQUENCY_DIR / "enhanced_service.png"
     caption  = "Twice Scheduled Service"
-    col3.image(str(filename), caption=caption)
+    col3.image(maps["enhanced_service"], caption=caption)
 
-    filename = FREQUENCY_DIR / "scheduled_service.png"
     caption  = "Scheduled Service"
-    col2.image(str(filename), caption=caption)
+    col2.image(maps["scheduled_service"], caption=caption)
 
-    filename = FREQUENCY_DIR / "reduced_service.png"
     caption  = "Half Scheduled Service"
-    col1.image(str(filename), caption=caption)
-
+    col1.image(maps["reduced_service"], caption=caption)
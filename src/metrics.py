@@ -0,0 +1,86 @@
+"""
+Numbers that describe an isochrone, for comparing scenarios without maps.
+
+Everything here is computed from the array of travel times a search returns,
+with array operations over the nodes it reached, and nothing is drawn. That
+keeps an analysis of many origins, trip times or frequencies at the speed of
+the searches themselves.
+
+For each trip time we report:
+
+    nodes_reached       intersections reached
+    street_km           kilometers of street with both ends reached, each
+                        street counted once however many ways it can be walked
+    area_km2            area of the grid cells, `GRID_METERS` on a side, that
+                        hold at least one node reached
+    hull_area_km2       area of the convex hull around the nodes reached,
+                        which also counts the gaps between them
+    stops_reached       transit stops reached, or None if the graph doesn't
+                        know where its stops are
+    median_minutes      median travel time to the nodes reached
+"""
+import numpy as np
+import pandas as pd
+from scipy.spatial import ConvexHull, QhullError
+
+from src.spatial import METERS_PER_DEGREE
+
+
+# Side of the grid cells that reached area is counted in, in meters
+GRID_METERS = 100
+
+
+def isochrone_metrics(travel_times, trip_times, node_x, node_y, edge_geometry=None,
+                      stop_nodes=None, grid_meters=GRID_METERS):
+    """
+    A DataFrame with one row of metrics for each of `trip_times`, from one
+    array of `travel_times` over the nodes at `node_x` and `node_y`. Street
+    kilometers need the graph's `EdgeGeometry` and stops its `stop_nodes`.
+    """
+    # Flat meters, the same way `NodeIndex` measures
+    lng_scale = np.cos(np.radians(np.mean(node_y)))
+    node_x = np.asarray(node_x) * lng_scale * METERS_PER_DEGREE
+    node_y = np.asarray(node_y) * METERS_PER_DEGREE
+
+    if edge_geometry is not None:
+        streets = edge_geometry.street_edges()
+        street_lengths = edge_geometry.lengths()[streets]
+        street_origins = edge_geometry.edge_origins[streets]
+        street_destinations = edge_geometry.edge_destinations[streets]
+
+    rows = []
+    for trip_time in sorted(trip_times):
+        reached = travel_times <= trip_time
+        nodes = np.flatnonzero(reached)
+        row = {"trip_time": trip_time, "nodes_reached": nodes.shape[0]}
+
+        row["street_km"] = None
+        if edge_geometry is not None:
+            on_streets = reached[street_origins] & reached[street_destinations]
+            row["street_km"] = float(street_lengths[on_streets].sum() / 1000)
+
+        x, y = node_x[nodes], node_y[nodes]
+        cells = np.unique(np.column_stack([np.floor(x / grid_meters),
+                                           np.floor(y / grid_meters)]), axis=0)
+        row["area_km2"] = cells.shape[0] * grid_meters**2 / 1e6
+        row["hull_area_km2"] = hull_area(x, y) / 1e6
+
+        row["stops_reached"] = None
+        if stop_nodes is not None and stop_nodes.shape[0] > 0:
+            row["stops_reached"] = int(reached[stop_nodes].sum())
+
+        times = travel_times[nodes]
+        row["median_minutes"] = float(np.median(times)) if nodes.shape[0] else np.nan
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def hull_area(x, y):
+    """Area of the convex hull around the points, 0 if they don't span an area"""
+    if x.shape[0] < 3:
+        return 0.0
+    try:
+        # The volume of a hull in two dimensions is its area
+        return float(ConvexHull(np.column_stack([x, y])).volume)
+    except QhullError:
+        return 0.0
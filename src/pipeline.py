@@ -0,0 +1,198 @@
+"""
+A small build system for the transit graph.
+
+Building the graph is a chain of slow stages (cleaning the feed, averaging
+travel times per route, tabling stop to stop times) that each read a few
+files and write a few more. A `Pipeline` holds those stages as a DAG, wired
+together by the files they read and write, and runs them in order.
+
+Each stage gets a key, which is a hash of the stage's name, version and
+parameters plus the contents of every file it reads. After a stage runs, its
+key and the hash of every file it wrote are recorded in a JSON manifest. The
+next time, a stage is skipped if its key is the same and its outputs are
+still on disk unchanged. A stage downstream of one that re-ran, but wrote
+the same bytes, is skipped too.
+
+The manifest is rewritten after every stage, so a run that crashes picks up
+after the last stage that finished. Stages are expected to write each of
+their outputs once, atomically (see `utils.atomic_write`), so an output is
+either complete or missing.
+"""
+import json
+import time
+import hashlib
+from pathlib import Path
+
+from src.utils import atomic_write
+from src.tracing import span
+
+
+MANIFEST_VERSION = 1
+
+# Bytes read at a time when hashing a file
+HASH_BLOCK_SIZE = 2**20
+
+
+class Stage:
+    """
+    `func` is called with no arguments and must write every path in
+    `outputs`. It reads whatever it needs from `inputs`, which can be files
+    or directories, written by earlier stages or not. Bump `version` when
+    the code behind a stage changes what it writes.
+    """
+    def __init__(self, name, func, inputs=(), outputs=(), params=None, version=1):
+        self.name = name
+        self.func = func
+        self.inputs = [Path(path) for path in inputs]
+        self.outputs = [Path(path) for path in outputs]
+        self.params = params or {}
+        self.version = version
+
+
+class Pipeline:
+    def __init__(self, manifest_path):
+        self.manifest_path = Path(manifest_path)
+        self.stages = {}
+        self.manifest = self.load_manifest()
+
+        # Seconds each stage took, the last time it ran
+        self.timings = {}
+
+
+    def add(self, name, func, inputs=(), outputs=(), params=None, version=1):
+        if name in self.stages:
+            raise ValueError(f"There is already a stage named {name}.")
+        self.stages[name] = Stage(name, func, inputs, outputs, params, version)
+        return self.stages[name]
+
+
+    def order(self):
+        """
+        Stages sorted so that each comes after the stages that write its
+        inputs. Stages that don't depend on each other keep the order they
+        were added in.
+        """
+        writers = {}
+        for stage in self.stages.values():
+            for path in stage.outputs:
+                if path in writers:
+                    raise ValueError(f"{path} is written by both {writers[path]} and {stage.name}.")
+                writers[path] = stage.name
+
+        ordered, visiting = [], set()
+        def visit(name):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f"The pipeline has a cycle through {name}.")
+            visiting.add(name)
+            for path in self.stages[name].inputs:
+                if path in writers:
+                    visit(writers[path])
+            visiting.remove(name)
+            ordered.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return [self.stages[name] for name in ordered]
+
+
+    def run(self, force=False):
+        """
+        Runs every stage whose inputs have changed since it last ran, or
+        every stage with `force`. Returns the names of the stages that ran. 
+        Each stage that runs is a span under "pipeline" (see `src/tracing.py`).
+        """
+        with span("pipeline"):
+            return [stage.name for stage in self.order() if self.run_stage(stage, force)]
+
+
+    def run_stage(self, stage, force=False):
+        """Runs one stage, unless it is current. Returns whether it ran."""
+        key = self.stage_key(stage)
+        if not force and self.is_current(stage, key):
+            print(f"✓\tSkipped {stage.name}, nothing it reads has changed")
+            return False
+
+        print(f"Running {stage.name}")
+        start = time.perf_counter()
+        with span(stage.name):
+            stage.func()
+        self.timings[stage.name] = time.perf_counter() - start
+        missing = [str(path) for path in stage.outputs if not path.exists()]
+        if missing:
+            raise FileNotFoundError(f"{stage.name} didn't write {', '.join(missing)}")
+
+        self.manifest["stages"][stage.name] = {
+            "key":      key,
+            "outputs":  {str(path): self.hash_path(path) for path in stage.outputs},
+        }
+        self.save_manifest()
+        return True
+
+
+    def stage_key(self, stage):
+        digest = hashlib.sha256()
+        digest.update(repr((stage.name, stage.version,
+                            sorted(stage.params.items()))).encode("utf-8"))
+        for path in stage.inputs:
+            digest.update(str(path).encode("utf-8"))
+            digest.update(self.hash_path(path).encode("utf-8"))
+        return digest.hexdigest()
+
+
+    def is_current(self, stage, key):
+        record = self.manifest["stages"].get(stage.name)
+        if record is None or record["key"] != key:
+            return False
+        return all(path.exists() and record["outputs"].get(str(path)) == self.hash_path(path)
+                   for path in stage.outputs)
+
+
+    def hash_path(self, path):
+        """
+        The SHA-256 of a file's contents, or of every file in a directory.
+        Hashes are remembered by size and modification time, so a file that
+        hasn't been touched isn't read again.
+        """
+        path = Path(path)
+        if not path.exists():
+            return "missing"
+        if path.is_dir():
+            digest = hashlib.sha256()
+            for child in sorted(path.rglob("*")):
+                if child.is_file():
+                    digest.update(str(child.relative_to(path)).encode("utf-8"))
+                    digest.update(self.hash_path(child).encode("utf-8"))
+            return digest.hexdigest()
+
+        stat = path.stat()
+        remembered = self.manifest["files"].get(str(path))
+        if remembered is not None and remembered[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return remembered[2]
+        file_hash = hash_file(path)
+        self.manifest["files"][str(path)] = [stat.st_size, stat.st_mtime_ns, file_hash]
+        return file_hash
+
+
+    def load_manifest(self):
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r") as json_file:
+                manifest = json.load(json_file)
+            if manifest.get("version") == MANIFEST_VERSION:
+                return manifest
+        return {"version": MANIFEST_VERSION, "stages": {}, "files": {}}
+
+
+    def save_manifest(self):
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(self.manifest_path, "w") as json_file:
+            json.dump(self.manifest, json_file, indent=2)
+
+
+def hash_file(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as open_file:
+        for block in iter(lambda: open_file.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
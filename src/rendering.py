@@ -0,0 +1,229 @@
+"""
+A quicker way to draw isochrones than `ox.plot_graph`.
+
+`ox.plot_graph` turns the graph into GeoDataFrames and needs a color for every
+edge, built up one edge at a time in Python. Here every edge's geometry is
+flattened once, ahead of time, into an array of line segments. Drawing a map
+is then a matter of choosing a color for each edge with array operations and
+handing the segments to matplotlib as a single LineCollection.
+"""
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import to_rgba_array
+from matplotlib.collections import LineCollection
+
+from src.artifacts import save_artifact, load_artifact
+from src.spatial import METERS_PER_DEGREE
+
+
+class EdgeGeometry:
+    """
+    The shape of every edge in the walking graph, as straight line segments.
+    Edges are identified by the positions of their end nodes in a
+    `CSRGraph`'s sorted `node_ids`, and every segment knows which edge it
+    belongs to. Coordinates are float32, which is well under a meter of error
+    and far finer than a pixel.
+    """
+    def __init__(self, edge_origins, edge_destinations, segment_edges, segments):
+        self.edge_origins = np.asarray(edge_origins, dtype=np.int32)
+        self.edge_destinations = np.asarray(edge_destinations, dtype=np.int32)
+        self.segment_edges = np.asarray(segment_edges, dtype=np.int32)
+        self.segments = np.asarray(segments, dtype=np.float32)
+
+        # Measured the first time they're asked for
+        self._lengths = None
+        self._street_edges = None
+
+
+    @classmethod
+    def from_networkx(cls, graph, node_ids):
+        """
+        Edges simplified by osmnx carry their full geometry. Every other edge
+        is a straight line between its two nodes.
+        """
+        node_ids = np.asarray(node_ids)
+        origins, destinations, segments = [], [], []
+        for orig, dest, data in graph.edges(data=True):
+            if "geometry" in data:
+                coords = np.asarray(data["geometry"].coords)[:, :2]
+            else:
+                coords = np.array([
+                    [graph.nodes[orig]["x"], graph.nodes[orig]["y"]],
+                    [graph.nodes[dest]["x"], graph.nodes[dest]["y"]]])
+            origins.append(orig)
+            destinations.append(dest)
+            segments.append(np.stack([coords[:-1], coords[1:]], axis=1))
+
+        num_segments = [edge_segments.shape[0] for edge_segments in segments]
+        return cls(np.searchsorted(node_ids, origins),
+                   np.searchsorted(node_ids, destinations),
+                   np.repeat(np.arange(len(segments)), num_segments),
+                   np.concatenate(segments))
+
+
+    @property
+    def num_edges(self):
+        return self.edge_origins.shape[0]
+
+
+    def lengths(self):
+        """The length of each edge in meters, summed along its segments"""
+        if self._lengths is None:
+            starts = self.segments[:, 0].astype(np.float64)
+            ends = self.segments[:, 1].astype(np.float64)
+            lng_scale = np.cos(np.radians((starts[:, 1] + ends[:, 1]) / 2))
+            segment_lengths = METERS_PER_DEGREE * np.hypot(
+                (ends[:, 0] - starts[:, 0]) * lng_scale, ends[:, 1] - starts[:, 1])
+            self._lengths = np.bincount(self.segment_edges, weights=segment_lengths,
+                                        minlength=self.num_edges)
+        return self._lengths
+
+
+    def street_edges(self):
+        """
+        One edge for each pair of nodes an edge joins, so a street that can be
+        walked both ways is only counted once
+        """
+        if self._street_edges is None:
+            low = np.minimum(self.edge_origins, self.edge_destinations).astype(np.int64)
+            high = np.maximum(self.edge_origins, self.edge_destinations).astype(np.int64)
+            _, self._street_edges = np.unique(low * (high.max(initial=0) + 1) + high, 
+                                              return_index=True)
+        return self._street_edges
+
+
+    def save(self, filepath):
+        save_artifact(filepath, {
+            "edge_origins":         self.edge_origins,
+            "edge_destinations":    self.edge_destinations,
+            "segment_edges":        self.segment_edges,
+            "segments":             self.segments,
+        })
+
+
+    @classmethod
+    def load(cls, filepath, mmap=True):
+        arrays, _ = load_artifact(filepath, mmap=mmap)
+        return cls(**arrays)
+
+
+    def edges_within(self, travel_times, trip_time):
+        """Edges whose both ends can be reached within `trip_time`"""
+        reached = travel_times <= trip_time
+        return reached[self.edge_origins] & reached[self.edge_destinations]
+
+
+    def color_edges(self, layers):
+        """
+        `layers` is a list of (travel_times, trip_time) pairs, in the order
+        they are painted. Returns, for every edge, the index of the last layer
+        that contains it, or -1 for edges that aren't painted at all.
+        """
+        color_index = np.full(self.num_edges, -1, dtype=np.int32)
+        for ii, (travel_times, trip_time) in enumerate(layers):
+            color_index[self.edges_within(travel_times, trip_time)] = ii
+        return color_index
+
+
+    def bounds(self, edges):
+        """(north, south, east, west) of the chosen edges"""
+        points = self.segments[edges[self.segment_edges]].reshape(-1, 2)
+        west, south = points.min(axis=0)
+        east, north = points.max(axis=0)
+        return float(north), float(south), float(east), float(west)
+
+
+def render_edges(edge_geometry, color_index, colors, filepath=None, bbox=None,
+                 extent_edges=None, ax=None, bgcolor="#262730",
+                 edge_linewidth=0.2, figsize=(8, 8), dpi=300):
+    """
+    Draw every edge with a `color_index` of 0 or more in `colors[color_index]`.
+    Segments outside `bbox`, given as (north, south, east, west), are dropped
+    before drawing. Without a `bbox`, the map is fit to `extent_edges`, or to
+    the drawn edges if those aren't given, with 2% padding as osmnx does.
+
+    With no `ax` a new figure is drawn and returned as PNG bytes, which are
+    also written to `filepath` if one is given. Otherwise the edges are added
+    to `ax` and nothing is saved. Returns the axis and the PNG bytes. New
+    figures don't go through pyplot, so maps can be drawn on several threads 
+    at once.
+    """
+    colors = to_rgba_array(colors)
+    drawn = color_index >= 0
+    drawn[drawn] = colors[color_index[drawn], 3] > 0
+
+    padding = 0
+    if bbox is None:
+        if extent_edges is None:
+            extent_edges = drawn
+        bbox = edge_geometry.bounds(extent_edges)
+        padding = 0.02
+
+    # Clip to the bounding box
+    north, south, east, west = bbox
+    segments = edge_geometry.segments
+    keep = drawn[edge_geometry.segment_edges]
+    keep &= segments[:, :, 0].max(axis=1) >= west
+    keep &= segments[:, :, 0].min(axis=1) <= east
+    keep &= segments[:, :, 1].max(axis=1) >= south
+    keep &= segments[:, :, 1].min(axis=1) <= north
+
+    segment_colors = colors[color_index[edge_geometry.segment_edges[keep]]]
+    lines = LineCollection(segments[keep], colors=segment_colors,
+        linewidths=edge_linewidth, zorder=1)
+
+    new_figure = ax is None
+    if new_figure:
+        fig = Figure(figsize=figsize, facecolor=bgcolor, frameon=False)
+        FigureCanvasAgg(fig)
+        ax = fig.subplots()
+        ax.set_facecolor(bgcolor)
+    else:
+        fig = ax.figure
+    ax.add_collection(lines)
+    configure_ax(ax, bbox, padding)
+
+    png = None
+    if new_figure:
+        png = figure_to_png(fig, ax, dpi)
+        if filepath is not None:
+            filepath = Path(filepath)
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            filepath.write_bytes(png)
+    return ax, png
+
+
+def configure_ax(ax, bbox, padding):
+    """Set limits and styling the same way `ox.plot_graph` does"""
+    north, south, east, west = bbox
+    padding_ns = (north - south) * padding
+    padding_ew = (east - west) * padding
+    ax.set_ylim((south - padding_ns, north + padding_ns))
+    ax.set_xlim((west - padding_ew, east + padding_ew))
+
+    ax.margins(0)
+    ax.tick_params(which="both", direction="in")
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    ax.get_xaxis().set_visible(False)
+    ax.get_yaxis().set_visible(False)
+
+    # Latitude and longitude aren't projected, so keep the map from stretching
+    cos_lat = np.cos((south + north) / 2 / 180 * np.pi)
+    ax.set_aspect(1 / cos_lat)
+
+
+def figure_to_png(fig, ax, dpi):
+    """PNG bytes of just the inside of the axis"""
+    fig.canvas.draw()
+    extent = ax.bbox.transformed(fig.dpi_scale_trans.inverted())
+    buffer = BytesIO()
+    fig.set_frameon(True)
+    fig.savefig(buffer, dpi=dpi, bbox_inches=extent, format="png",
+        facecolor=fig.get_facecolor(), transparent=True)
+    fig.set_frameon(False)
+    return buffer.getvalue()
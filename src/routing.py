@@ -0,0 +1,59 @@
+from heapq import heappush, heappop
+from itertools import count
+
+
+def multimodal_travel_times(walking_graph, transit_graph, source, cutoff=None, 
+                            freq_multiplier=1.0):
+    """
+    Dijkstra's algorithm over the walking graph and the transit graph at once, 
+    without ever adding the transit edges to the walking graph. Transit edge 
+    costs are computed as they are explored:
+
+        wait_time / freq_multiplier + transit_travel_time
+
+    Neither graph is modified, so one copy of each can be shared by every 
+    isochrone, whatever its frequency multiplier.
+
+    Returns a dictionary of travel times in minutes, keyed by node, for every 
+    node that can be reached within `cutoff` minutes. This matches the output
+    of `nx.single_source_dijkstra_path_length`.
+    """
+    # The raw adjacency dictionaries, the same ones networkx's dijkstra walks
+    walking_adj = walking_graph._adj
+    transit_adj = transit_graph._adj
+    multigraph = walking_graph.is_multigraph()
+
+    travel_times = {}
+    seen = {source: 0}
+    tiebreak = count()
+    fringe = [(0, next(tiebreak), source)]
+    while fringe:
+        time, _, node = heappop(fringe)
+        if node in travel_times:
+            continue
+        travel_times[node] = time
+
+        # Walking edges. Parallel edges in a multigraph take the quickest.
+        neighbors = []
+        for neighbor, edge_data in walking_adj.get(node, {}).items():
+            if multigraph:
+                cost = min(data["travel_time"] for data in edge_data.values())
+            else:
+                cost = edge_data["travel_time"]
+            neighbors.append((neighbor, cost))
+
+        # Transit edges, weighted by the adjusted frequency of service
+        for neighbor, edge_data in transit_adj.get(node, {}).items():
+            cost = edge_data["wait_time"] / freq_multiplier
+            cost += edge_data["transit_travel_time"]
+            neighbors.append((neighbor, cost))
+
+        for neighbor, cost in neighbors:
+            neighbor_time = time + cost
+            if cutoff is not None and neighbor_time > cutoff:
+                continue
+            if neighbor not in seen or neighbor_time < seen[neighbor]:
+                seen[neighbor] = neighbor_time
+                heappush(fringe, (neighbor_time, next(tiebreak), neighbor))
+
+    return travel_times
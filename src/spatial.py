@@ -0,0 +1,137 @@
+import weakref
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from src.artifacts import save_artifact, load_artifact, arrays_checksum
+
+
+# Meters per degree of latitude, for reporting distances
+METERS_PER_DEGREE = 111_195
+
+
+class NodeIndex:
+    """
+    A KD-tree over graph node coordinates, for snapping points to their nearest
+    node. `ox.distance.nearest_nodes` builds a new tree over every node on every
+    call. This one is built once and kept, so a lookup is a tree query and
+    nothing more.
+
+    Coordinates are projected onto a flat plane around the graph's mean
+    latitude, with longitude scaled by the cosine of that latitude. At the
+    scale of a city that is as good as measuring along the globe.
+    ---
+    Reminder: Longitude is along the X axis. Latitude is along the Y axis.
+    Lookups take (lat, lng), the way we speak, and swap them here.
+    """
+    def __init__(self, node_ids, lats, lngs):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+        self.lng_scale = np.cos(np.radians(self.lats.mean()))
+        self.tree = cKDTree(self.project(self.lats, self.lngs))
+        self._version = None
+
+
+    @classmethod
+    def from_graph(cls, graph):
+        """From a networkx graph with osmnx's `x` and `y` node attributes"""
+        nodes = list(graph.nodes(data=True))
+        node_ids = [node for node, _ in nodes]
+        lats = [data["y"] for _, data in nodes]
+        lngs = [data["x"] for _, data in nodes]
+        return cls(node_ids, lats, lngs)
+
+
+    @classmethod
+    def from_csr_graph(cls, csr_graph):
+        return cls(csr_graph.node_ids, csr_graph.node_y, csr_graph.node_x)
+
+
+    def project(self, lats, lngs):
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        return np.column_stack([lngs * self.lng_scale, lats])
+
+
+    def nearest_nodes(self, lats, lngs, k=1, return_dist=False):
+        """
+        Batched lookups. Returns an array of node IDs, with a column for each
+        of the `k` nearest nodes when `k` > 1, and optionally the distances
+        to them in meters.
+        """
+        distances, positions = self.tree.query(self.project(lats, lngs), k=k)
+        node_ids = self.node_ids[positions]
+        if return_dist:
+            return node_ids, distances * METERS_PER_DEGREE
+        return node_ids
+
+
+    def nearest_node(self, location):
+        """The node nearest a single (lat, lng) location"""
+        lat, lng = location[0], location[1]
+        _, position = self.tree.query([lng * self.lng_scale, lat])
+        return int(self.node_ids[position])
+
+
+    @property
+    def version(self):
+        """A fingerprint of the nodes the index covers, see `nodes_version`"""
+        if self._version is None:
+            self._version = nodes_version(self.node_ids, self.lats, self.lngs)
+        return self._version
+
+
+    def save(self, filepath):
+        """
+        Only the nodes are saved, as an artifact. The tree is rebuilt when 
+        the index is loaded, which takes a fraction of a second.
+        """
+        save_artifact(filepath, 
+            {"node_ids": self.node_ids, "lats": self.lats, "lngs": self.lngs},
+            metadata={"nodes_version": self.version})
+
+
+    @classmethod
+    def load(cls, filepath, version=None):
+        """
+        Raises ValueError if the file isn't an index, or if it was built for 
+        nodes other than those with `version`, when it's given.
+        """
+        arrays, metadata = load_artifact(filepath)
+        if version is not None and metadata.get("nodes_version") != version:
+            raise ValueError(f"{filepath} was built for another graph.")
+        node_index = cls(arrays["node_ids"], arrays["lats"], arrays["lngs"])
+        node_index._version = metadata.get("nodes_version")
+        return node_index
+
+
+def nodes_version(node_ids, lats, lngs):
+    """
+    A fingerprint of a set of nodes and where they are, the same whatever
+    order they're listed in. The index only depends on the walking graph's 
+    nodes, so it is shared by every transit graph built over them.
+    """
+    node_ids = np.asarray(node_ids, dtype=np.int64)
+    order = np.argsort(node_ids, kind="stable")
+    return arrays_checksum({
+        "node_ids": node_ids[order],
+        "lats":     np.asarray(lats, dtype=np.float64)[order],
+        "lngs":     np.asarray(lngs, dtype=np.float64)[order],
+    })
+
+
+# Indexes already built for graphs that are in memory, so that every caller
+# holding the same graph shares one tree. Entries go when the graph does.
+_graph_indexes = weakref.WeakKeyDictionary()
+
+
+def index_for_graph(graph):
+    if graph not in _graph_indexes:
+        _graph_indexes[graph] = NodeIndex.from_graph(graph)
+    return _graph_indexes[graph]
+
+
+def register_index(graph, node_index):
+    """Share an index that was loaded from disk with everyone using `graph`"""
+    _graph_indexes[graph] = node_index
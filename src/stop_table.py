@@ -0,0 +1,266 @@
+"""
+Precomputed travel times between transit stops.
+
+A search over the walking graph plus the transit graph spends most of its
+time relaxing transit edges, because every route links each of its stops to
+every later stop. A `StopTable` does that work once, offline: for each
+frequency multiplier it holds the quickest time from every stop to every
+other stop reachable within `max_time`, riding any number of routes and
+walking between nearby stops to transfer.
+
+An isochrone then needs only two walking searches. The first finds the stops
+within reach of the starting point. Their rows of the table give the earliest
+time each stop can be reached by transit, and the second search walks onward
+from all of those stops at once.
+
+Table answers can differ from `CSRGraph.search` in a few places:
+
+- A walk between two rides is a transfer only up to `MAX_TRANSFER_TIME`. The
+  full search walks as far as it likes, so a trip that changes routes with a
+  longer walk is found by the search but not by the table.
+- Times are stored as float32, so they can differ from the search by
+  rounding, a thousandth of a minute or so.
+- Trips longer than `MAX_TABLE_TIME`, frequency multipliers the table wasn't
+  built for, and searches for a time of day aren't answered from the table
+  at all.
+
+`spot_check` compares the table with full searches from a few stops, which
+the build runs on the real network and reports.
+
+A table holds every pair of stops within `max_time` of each other, which in
+a big city is a large share of all pairs, once per frequency multiplier. The
+build stops once the table passes `MAX_TABLE_BYTES`.
+"""
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from src.artifacts import save_artifact, load_artifact
+from src.csr_graph import csr_arrays
+
+
+# The multipliers the app and the article's maps draw
+FREQ_MULTIPLIERS = (0.5, 1.0, 2.0, 3.0)
+
+# Longest trip the table covers, in minutes
+MAX_TABLE_TIME = 60
+
+# Longest walk between two stops that counts as a transfer, in minutes
+MAX_TRANSFER_TIME = 15
+
+# Largest table the build will write, across every frequency multiplier
+MAX_TABLE_BYTES = 4 * 2**30
+
+# An int32 stop and a float32 time
+BYTES_PER_ENTRY = 8
+
+# Travel times held at once while building, to bound memory
+CHUNK_ELEMENTS = 2**24
+
+# Minutes a table answer may differ from a full search by float32 rounding
+TOLERANCE = 1e-3
+
+
+class StopTable:
+    """
+    One sparse table per frequency multiplier, in CSR form over the stops'
+    positions in `stop_nodes`. Each row holds the stops reachable from that
+    stop within `max_time` and the float32 travel time to each of them,
+    quickest first, so a search reads only as much of a row as it has time
+    left for.
+
+    Transfers are limited to walks of `max_transfer_time`, so a trip that
+    walks further than that between two rides isn't found. Walks at either
+    end of a trip can be as long as the trip allows.
+    """
+    def __init__(self, stop_nodes, freq_multipliers, tables, max_time,
+                 max_transfer_time, graph_version=None):
+        self.stop_nodes = np.asarray(stop_nodes, dtype=np.int32)
+        self.freq_multipliers = [float(freq) for freq in freq_multipliers]
+        self.tables = tables
+        self.max_time = max_time
+        self.max_transfer_time = max_transfer_time
+        self.graph_version = graph_version
+
+
+    @classmethod
+    def build(cls, csr_graph, freq_multipliers=FREQ_MULTIPLIERS,
+              max_time=MAX_TABLE_TIME, max_transfer_time=MAX_TRANSFER_TIME,
+              max_bytes=MAX_TABLE_BYTES):
+        """
+        Raises a ValueError once the table passes `max_bytes`, rather than
+        running out of memory or disk partway through a long build.
+        """
+        stop_nodes = np.union1d(csr_graph.transit_origins,
+                                csr_graph.transit_destinations).astype(np.int32)
+        num_stops = stop_nodes.shape[0]
+        most_bytes = num_stops**2 * len(freq_multipliers) * BYTES_PER_ENTRY
+        if most_bytes > max_bytes:
+            print(f"A stop table for {num_stops} stops and {len(freq_multipliers)} "
+                  f"frequency multipliers could take up to {most_bytes / 1e9:.1f} GB. "
+                  f"The build stops if it passes {max_bytes / 1e9:.1f} GB.")
+
+        transfers = transfer_edges(csr_graph, stop_nodes, max_transfer_time)
+        ride_origins = np.searchsorted(stop_nodes, csr_graph.transit_origins)
+        ride_destinations = np.searchsorted(stop_nodes, csr_graph.transit_destinations)
+
+        tables = {}
+        max_entries = max_bytes // BYTES_PER_ENTRY
+        for freq in freq_multipliers:
+            ride_times = csr_graph.wait_times / np.float32(freq)
+            ride_times += csr_graph.transit_travel_times
+            indptr, indices, weights = csr_arrays(
+                np.concatenate([ride_origins, transfers[0]]),
+                np.concatenate([ride_destinations, transfers[1]]),
+                np.concatenate([ride_times, transfers[2]]),
+                stop_nodes.shape[0])
+            shape = (stop_nodes.shape[0], stop_nodes.shape[0])
+            matrix = csr_matrix((weights, indices, indptr), shape=shape)
+            tables[float(freq)] = bounded_all_pairs(matrix, max_time, max_entries)
+            max_entries -= tables[float(freq)][1].shape[0]
+            print(f"✓\tTabled stop to stop travel times at {freq} times arrival rates")
+
+        return cls(stop_nodes, freq_multipliers, tables, max_time,
+                   max_transfer_time, csr_graph.version)
+
+
+    def save(self, filepath):
+        arrays = {"stop_nodes": self.stop_nodes}
+        for ii, freq in enumerate(self.freq_multipliers):
+            indptr, indices, times = self.tables[freq]
+            arrays[f"indptr_{ii}"] = indptr
+            arrays[f"indices_{ii}"] = indices
+            arrays[f"times_{ii}"] = times
+        metadata = {
+            "freq_multipliers":     self.freq_multipliers,
+            "max_time":             self.max_time,
+            "max_transfer_time":    self.max_transfer_time,
+            "graph_version":        self.graph_version,
+        }
+        save_artifact(filepath, arrays, metadata)
+
+
+    @classmethod
+    def load(cls, filepath, mmap=True):
+        """
+        Memory-mapped by default. A search only reads the rows of the stops
+        it can walk to, so most of the table never leaves the disk.
+        """
+        arrays, metadata = load_artifact(filepath, mmap=mmap)
+        tables = {}
+        for ii, freq in enumerate(metadata["freq_multipliers"]):
+            tables[float(freq)] = (arrays[f"indptr_{ii}"], arrays[f"indices_{ii}"],
+                                   arrays[f"times_{ii}"])
+        return cls(arrays["stop_nodes"], metadata["freq_multipliers"], tables,
+                   metadata["max_time"], metadata["max_transfer_time"],
+                   metadata["graph_version"])
+
+
+    @property
+    def version(self):
+        return f"{self.graph_version}/stops-{self.max_time}-{self.max_transfer_time}"
+
+
+    def covers(self, cutoff, freq_multiplier):
+        """Whether a search can be answered from the table"""
+        if freq_multiplier is None or cutoff is None:
+            return False
+        return float(freq_multiplier) in self.tables and cutoff <= self.max_time
+
+
+    def travel_times_from(self, csr_graph, source, cutoff, freq_multiplier):
+        """
+        Travel times from the node at position `source` to every node of
+        `csr_graph`, infinite past `cutoff`, the same as
+        `csr_graph.travel_times_from` but using the table for transit.
+        """
+        walking = csr_graph.matrix()
+        walking_times = dijkstra(walking, directed=True, indices=source, limit=cutoff)
+
+        # Earliest arrival at every stop by transit
+        indptr, indices, times = self.tables[float(freq_multiplier)]
+        boarding_times = walking_times[self.stop_nodes]
+        arrivals = np.full(self.stop_nodes.shape[0], np.inf)
+        for stop in np.flatnonzero(boarding_times <= cutoff):
+            start, end = indptr[stop], indptr[stop + 1]
+            time_left = cutoff - boarding_times[stop]
+            end = start + np.searchsorted(times[start:end], time_left, side="right")
+            reached = indices[start:end]
+            arrivals[reached] = np.minimum(arrivals[reached],
+                boarding_times[stop] + times[start:end])
+
+        return csr_graph.walk_onward(walking_times, self.stop_nodes, arrivals, cutoff)
+
+
+    def spot_check(self, csr_graph, num_sources=5, freq_multiplier=1.0, seed=0):
+        """
+        The share of nodes reached within `max_time` from `num_sources`
+        random stops whose travel time from the table differs from a full
+        search's. It's the table's transfer limit that makes them differ.
+        """
+        rng = np.random.default_rng(seed)
+        num_sources = min(num_sources, self.stop_nodes.shape[0])
+        sources = rng.choice(self.stop_nodes, size=num_sources, replace=False)
+        num_reached = num_different = 0
+        for source in sources:
+            expected = csr_graph.travel_times_from(source, self.max_time, freq_multiplier)
+            actual = self.travel_times_from(csr_graph, source, self.max_time,
+                                            freq_multiplier)
+            reached = np.isfinite(expected) | np.isfinite(actual)
+            num_reached += int(reached.sum())
+            num_different += int((np.abs(expected[reached] - actual[reached]) 
+                                  > TOLERANCE).sum())
+        return num_different / max(num_reached, 1)
+
+
+def transfer_edges(csr_graph, stop_nodes, max_transfer_time):
+    """Walks of at most `max_transfer_time` between every pair of stops"""
+    walking = csr_graph.matrix()
+    chunk_size = max(1, CHUNK_ELEMENTS // csr_graph.num_nodes)
+    origins, destinations, times = [], [], []
+    for start in range(0, stop_nodes.shape[0], chunk_size):
+        sources = stop_nodes[start:start + chunk_size]
+        walking_times = dijkstra(walking, directed=True, indices=sources,
+                                 limit=max_transfer_time)[:, stop_nodes]
+        rows, columns = np.nonzero(np.isfinite(walking_times))
+        rows += start
+        keep = rows != columns
+        origins.append(rows[keep])
+        destinations.append(columns[keep])
+        times.append(walking_times[rows[keep] - start, columns[keep]])
+    return (np.concatenate(origins).astype(np.int32),
+            np.concatenate(destinations).astype(np.int32),
+            np.concatenate(times).astype(np.float32))
+
+
+def bounded_all_pairs(matrix, max_time, max_entries=None):
+    """
+    CSR arrays of the quickest time between every pair within `max_time`, 
+    with each row sorted by time. Raises a ValueError once there are more
+    than `max_entries` pairs.
+    """
+    num_stops = matrix.shape[0]
+    chunk_size = max(1, CHUNK_ELEMENTS // num_stops)
+    indptr = np.zeros(num_stops + 1, dtype=np.int64)
+    indices, times = [], []
+    num_entries = 0
+    for start in range(0, num_stops, chunk_size):
+        sources = np.arange(start, min(start + chunk_size, num_stops))
+        chunk = dijkstra(matrix, directed=True, indices=sources, limit=max_time)
+        chunk[np.arange(sources.shape[0]), sources] = np.inf
+        rows, columns = np.nonzero(np.isfinite(chunk))
+        num_entries += rows.shape[0]
+        if max_entries is not None and num_entries > max_entries:
+            msg = f"""
+            The stop table has passed {max_entries * BYTES_PER_ENTRY / 1e9:.1f} GB
+            after {start + sources.shape[0]} of {num_stops} stops. Build it for
+            fewer frequency multipliers or a shorter `max_time`, or raise
+            `max_bytes`.
+            """
+            raise ValueError(msg)
+        chunk_times = chunk[rows, columns]
+        order = np.lexsort((chunk_times, rows))
+        indptr[sources + 1] = np.bincount(rows, minlength=sources.shape[0])
+        indices.append(columns[order].astype(np.int32))
+        times.append(chunk_times[order].astype(np.float32))
+    return (np.cumsum(indptr), np.concatenate(indices), np.concatenate(times))
@@ -0,0 +1,166 @@
+"""
+Nested timings and memory use, for the build and for each request in the app.
+
+Wrap a piece of work in `with span("search"):`, or decorate a function with
+`@traced("search")`. A span opened while another is open is recorded as one
+of its children, so a request comes out as a tree: load graph, snap node,
+search, color edges, render. Spans with the same name under the same parent
+are merged and counted, so a loop over thousands of routes is one entry.
+
+For every span we keep the number of calls, the total and slowest seconds,
+the resident memory when it last ended, and how much it raised the process's
+peak resident memory. Memory is for this process only, so work handed to a
+process pool shows up as time but not as memory.
+
+When the outermost span on a thread ends, its tree is a finished trace. The
+last one is kept for `last_trace()`, and if the `TRACE_FILE` environment
+variable names a file, the trace is appended to it as one line of JSON.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import functools
+from datetime import datetime
+from contextlib import contextmanager
+
+import psutil
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows
+    resource = None
+
+
+TRACE_FILE = os.environ.get("TRACE_FILE")
+
+_process = psutil.Process()
+_local = threading.local()
+_write_lock = threading.Lock()
+_last_trace = None
+
+
+class Span:
+    __slots__ = ("name", "calls", "seconds", "max_seconds", "rss",
+                 "peak_rss", "peak_growth", "children")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rss = 0
+        self.peak_rss = 0
+        self.peak_growth = 0
+        self.children = {}
+
+
+    def child(self, name):
+        if name not in self.children:
+            self.children[name] = Span(name)
+        return self.children[name]
+
+
+    def to_dict(self):
+        return {
+            "name":         self.name,
+            "calls":        self.calls,
+            "seconds":      round(self.seconds, 6),
+            "max_seconds":  round(self.max_seconds, 6),
+            "rss":          self.rss,
+            "peak_rss":     self.peak_rss,
+            "peak_growth":  self.peak_growth,
+            "children":     [child.to_dict() for child in self.children.values()],
+        }
+
+
+@contextmanager
+def span(name):
+    """Times and measures everything inside the `with` block as `name`"""
+    stack = _stack()
+    node = stack[-1].child(name) if stack else Span(name)
+    stack.append(node)
+    started_at = time.time()
+    peak_before = peak_rss()
+    start = time.perf_counter()
+    try:
+        yield node
+    finally:
+        seconds = time.perf_counter() - start
+        node.calls += 1
+        node.seconds += seconds
+        node.max_seconds = max(node.max_seconds, seconds)
+        node.rss = current_rss()
+        node.peak_rss = peak_rss()
+        node.peak_growth = max(node.peak_growth, node.peak_rss - peak_before)
+        stack.pop()
+        if not stack:
+            finish_trace(node, started_at)
+
+
+def traced(name=None):
+    """Decorates a function so that every call is a span, named for the function by default"""
+    def decorator(func):
+        span_name = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def finish_trace(root, started_at):
+    global _last_trace
+    trace = {
+        "started_at":   datetime.fromtimestamp(started_at).isoformat(timespec="milliseconds"),
+        "pid":          os.getpid(),
+        "thread":       threading.current_thread().name,
+        "spans":        root.to_dict(),
+    }
+    _last_trace = trace
+    if TRACE_FILE:
+        with _write_lock, open(TRACE_FILE, "a") as trace_file:
+            trace_file.write(json.dumps(trace) + "\n")
+
+
+def last_trace():
+    """The most recently finished trace, on any thread"""
+    return _last_trace
+
+
+def current_rss():
+    """Resident memory, in bytes"""
+    return _process.memory_info().rss
+
+
+def peak_rss():
+    """The most resident memory this process has used so far, in bytes"""
+    if resource is None:
+        memory_info = _process.memory_info()
+        return getattr(memory_info, "peak_wset", memory_info.rss)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def format_trace(trace):
+    """One line per span, indented under its parent"""
+    lines = []
+    def add(node, depth):
+        calls = f" x{node['calls']}" if node["calls"] > 1 else ""
+        lines.append(f"{'  ' * depth}{node['name']}{calls}: {node['seconds']:.3f}s, "
+                     f"peak {node['peak_rss'] / 1e9:.3f} GB (+{node['peak_growth'] / 1e6:.0f} MB)")
+        for child in node["children"]:
+            add(child, depth + 1)
+    add(trace["spans"], 0)
+    return "\n".join(lines)
@@ -1,19 +1,25 @@
 from time import time
+from contextlib import contextmanager
 import os
+import tempfile
 
 import psutil
 import bz2
 import pickle
 import _pickle as cPickle
 
+from src.tracing import span, peak_rss
+
 
 def timer_func(func):
     """
-    This function shows the execution time of the function object passed
+    This function shows the execution time of the function object passed. 
+    Each call is also recorded as a span (see `src/tracing.py`).
     """
     def wrap_func(*args, **kwargs):
         t1 = time()
-        result = func(*args, **kwargs)
+        with span(func.__name__):
+            result = func(*args, **kwargs)
         t2 = time()
         
         delta = t2-t1   #duration in seconds
@@ -26,8 +32,32 @@ def timer_func(func):
     return wrap_func
 
 
+@contextmanager
+def atomic_write(filepath, mode="wb"):
+    """
+    Opens a temporary file next to `filepath` and moves it into place once 
+    it has been written, so a crash never leaves a half-written file behind.
+    Every writer gets its own temporary file, so two threads or processes 
+    writing the same file at once don't clobber each other; the last to 
+    finish wins.
+    """
+    directory, name = os.path.split(os.fspath(filepath))
+    descriptor, temp_filepath = tempfile.mkstemp(dir=directory or ".", 
+                                                 prefix=f"{name}.", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, mode) as temp_file:
+            yield temp_file
+        # mkstemp makes the file private to its owner
+        os.chmod(temp_filepath, 0o644)
+        os.replace(temp_filepath, filepath)
+    except BaseException:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
+
+
 def save_pickle(obj, filepath):
-    with open(filepath, "wb") as pkl_file:
+    with atomic_write(filepath) as pkl_file:
         pickle.dump(obj, pkl_file, pickle.HIGHEST_PROTOCOL)
 
 
@@ -42,8 +72,9 @@ def compressed_pickle(data, filepath_with_extension):
     """
     Loads a .pbz2 files. This will expect that file extension.
     """
-    with bz2.BZ2File(filepath_with_extension, "w") as write_file: 
-        cPickle.dump(data, write_file)
+    with atomic_write(filepath_with_extension) as raw_file:
+        with bz2.BZ2File(raw_file, "w") as write_file: 
+            cPickle.dump(data, write_file)
 
 
 # Load any compressed pickle file
@@ -61,4 +92,5 @@ def print_app_memory_usage():
     usage_in_bytes = process.memory_info().rss
     print(usage_in_bytes)
     usage_in_GB = round(usage_in_bytes / 1e9, 3)
-    print(f"App is using {usage_in_GB} GB of memory.")
\ No newline at end of file
+    print(f"App is using {usage_in_GB} GB of memory.")
+    print(f"App has used at most {round(peak_rss() / 1e9, 3)} GB of memory.")
\ No newline at end of file
@@ -0,0 +1,31 @@
+"""
+The `tiny` synthetic city from the benchmarks, built once per test session
+in a temporary directory.
+
+    python -m pytest tests
+"""
+import pytest
+
+from src.isochrones import TransitIsochrone
+from benchmarks.run import CITY, sandbox, benchmark_build, choose_origins, Benchmarks
+from benchmarks.synthetic import make_city
+
+
+@pytest.fixture(scope="session")
+def city(tmp_path_factory):
+    walking_graph, feed = make_city("tiny", seed=0)
+    with sandbox(tmp_path_factory.mktemp("synthetic_city")) as data_dir:
+        benchmark_build(Benchmarks(), walking_graph, feed, data_dir)
+        yield walking_graph, data_dir
+
+
+@pytest.fixture(scope="session")
+def origins(city):
+    walking_graph, _ = city
+    return choose_origins(walking_graph, num_origins=3)
+
+
+@pytest.fixture(scope="session")
+def csr_isochrone(city):
+    _, data_dir = city
+    return TransitIsochrone(data_dir, CITY, engine="csr")
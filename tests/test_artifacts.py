@@ -0,0 +1,39 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.gtfs as gtfs
+from src.artifacts import save_table, load_table, save_artifact, load_artifact
+
+
+def test_table_round_trip(tmp_path):
+    df = pd.DataFrame({
+        "stop_id":  [1, "A2", np.int64(3), None, 2.5, True],
+        "name":     ["a", np.nan, "c", "d", "", "f"],
+        "count":    np.arange(6, dtype=np.int32),
+        "share":    np.linspace(0, 1, 6),
+    }, index=pd.Index([10, 11, 12, 13, 14, 15], name="row"))
+    save_table(df, tmp_path / "table.arrays")
+    expected = df.assign(stop_id=[1, "A2", 3, np.nan, 2.5, True])
+    pd.testing.assert_frame_equal(load_table(tmp_path / "table.arrays"), expected)
+
+
+def test_artifact_rejects_other_files(tmp_path):
+    save_artifact(tmp_path / "arrays.arrays", {"x": np.arange(3)}, {"note": "hi"})
+    arrays, metadata = load_artifact(tmp_path / "arrays.arrays")
+    np.testing.assert_array_equal(arrays["x"], np.arange(3))
+    assert metadata == {"note": "hi"}
+
+    (tmp_path / "bad.arrays").write_bytes(b"not an artifact")
+    with pytest.raises(ValueError):
+        load_artifact(tmp_path / "bad.arrays")
+
+
+def test_pickled_tables_are_not_read(tmp_path):
+    (tmp_path / "gtfs_cleaned").mkdir()
+    with open(tmp_path / "gtfs_cleaned" / "stops.pkl", "wb") as pkl_file:
+        pickle.dump(pd.DataFrame({"stop_id": [1]}), pkl_file)
+    with pytest.raises(FileNotFoundError):
+        gtfs.load_prepared_gtfs_table("stops", tmp_path)
@@ -0,0 +1,32 @@
+from src.batch import batch_travel_times
+from benchmarks.run import CITY
+
+
+TRIP_TIME = 30
+FREQ_MULTIPLIERS = [None, 0.5, 1.0, 2.0]
+
+
+def batch_results(origins, data_dir, processes):
+    return {(origin, freq_multiplier): travel_times
+            for origin, freq_multiplier, travel_times in batch_travel_times(CITY,
+                origins, [TRIP_TIME], FREQ_MULTIPLIERS, processes=processes,
+                data_dir=data_dir)}
+
+
+def test_batch_matches_across_processes(city, origins):
+    _, data_dir = city
+    in_process = batch_results(origins, data_dir, processes=1)
+    in_pool = batch_results(origins, data_dir, processes=2)
+    assert in_process.keys() == in_pool.keys()
+    for key in in_process:
+        assert in_process[key].tobytes() == in_pool[key].tobytes()
+
+
+def test_batch_matches_search(city, origins, csr_isochrone):
+    _, data_dir = city
+    for (origin, freq_multiplier), travel_times in batch_results(origins, data_dir, 1).items():
+        if freq_multiplier is None:
+            continue
+        node = csr_isochrone.get_nearest_node(origin)
+        expected = csr_isochrone.csr_search(node, TRIP_TIME, freq_multiplier)
+        assert expected.tobytes() == travel_times.tobytes()
@@ -0,0 +1,29 @@
+import numpy as np
+
+from src.cache import IsochroneCache
+from src.artifacts import save_artifact
+
+
+def test_cached_travel_times_round_trip(tmp_path):
+    cache = IsochroneCache(tmp_path)
+    travel_times = np.array([0, 3.5, np.inf, 12])
+    cache.put("key", travel_times)
+    np.testing.assert_array_equal(cache.get("key"), travel_times)
+    np.testing.assert_array_equal(IsochroneCache(tmp_path).get("key"), travel_times)
+
+
+def test_malformed_entry_is_a_miss(tmp_path):
+    cache = IsochroneCache(tmp_path)
+    cache.put("key", np.array([0, 3.5, np.inf, 12]))
+    # Three times for a graph the header says has ten nodes, of which none
+    # were reached
+    save_artifact(cache.filepath("key"),
+        {"reached": np.packbits(np.zeros(10, dtype=bool)),
+         "travel_times": np.array([1.0, 2.0, 3.0])},
+        metadata={"num_nodes": 10})
+
+    fresh = IsochroneCache(tmp_path)
+    assert fresh.get("key") is None
+    assert (fresh.hits, fresh.misses) == (0, 1)
+    assert not fresh.filepath("key").exists()
+    assert fresh.num_bytes == 0
@@ -0,0 +1,17 @@
+import src.graphs as graphs
+from src.connection_scan import clock_seconds
+from src.stop_table import MAX_TRANSFER_TIME
+from benchmarks.run import CITY
+
+
+def test_clock_seconds_runs_past_midnight():
+    assert clock_seconds("08:00") == 8 * 3600
+    assert clock_seconds("24:30:15") == 24 * 3600 + 30 * 60 + 15
+    assert clock_seconds(600) == 600
+
+
+def test_timetable_transfers_match_stop_table(city):
+    _, data_dir = city
+    timetable = graphs.load_timetable(CITY, data_dir)
+    assert timetable.metadata["max_transfer_time"] == MAX_TRANSFER_TIME
+    assert timetable.transfer_times.max() <= MAX_TRANSFER_TIME * 60
@@ -0,0 +1,51 @@
+import numpy as np
+
+from src.csr_graph import MAX_TRANSIT_MATRICES
+from src.isochrones import WalkingIsochrone, TransitIsochrone
+from benchmarks.run import CITY
+
+
+TRIP_TIME = 30
+FREQ_MULTIPLIERS = [0.5, 1.0, 2.0]
+
+# Minutes that float32 and float64 sums of the same path may differ by
+TOLERANCE = 1e-3
+
+
+def assert_same_times(expected, actual):
+    """Both reach the same nodes, in the same times"""
+    assert expected.keys() == actual.keys()
+    nodes = list(expected)
+    np.testing.assert_allclose([actual[node] for node in nodes],
+                               [expected[node] for node in nodes], atol=TOLERANCE)
+
+
+def test_csr_walking_matches_networkx(city, origins, csr_isochrone):
+    walking_graph, _ = city
+    networkx_walking = WalkingIsochrone(walking_graph)
+    csr_walking = WalkingIsochrone(walking_graph, engine="csr")
+    for origin in origins:
+        node = csr_isochrone.get_nearest_node(origin)
+        assert_same_times(networkx_walking.travel_times_from_node(node, TRIP_TIME),
+                          csr_walking.travel_times_from_node(node, TRIP_TIME))
+
+
+def test_csr_transit_matches_networkx(city, origins, csr_isochrone):
+    _, data_dir = city
+    networkx_isochrone = TransitIsochrone(data_dir, CITY, engine="networkx")
+    for origin in origins:
+        node = csr_isochrone.get_nearest_node(origin)
+        for freq_multiplier in FREQ_MULTIPLIERS:
+            assert_same_times(
+                networkx_isochrone.travel_times_from_node(node, TRIP_TIME, freq_multiplier),
+                csr_isochrone.travel_times_from_node(node, TRIP_TIME, freq_multiplier))
+
+
+def test_routing_matrices_are_bounded(csr_isochrone):
+    csr_graph = csr_isochrone.csr_graph
+    first = csr_graph.matrix(1.0)
+    for freq_multiplier in np.linspace(0.5, 3, 2 * MAX_TRANSIT_MATRICES):
+        csr_graph.matrix(freq_multiplier, (7, 10))
+    assert len(csr_graph._matrices) == MAX_TRANSIT_MATRICES
+    assert csr_graph.matrix() is csr_graph.matrix()
+    assert (csr_graph.matrix(1.0) != first).nnz == 0
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from src.frequency_sweep import FrequencySweep
+
+
+TRIP_TIME = 30
+
+
+@pytest.mark.parametrize("hours", [None, (7, 10)])
+def test_sweep_matches_searches(origins, csr_isochrone, hours):
+    csr_graph = csr_isochrone.csr_graph
+    for origin in origins:
+        node = csr_isochrone.get_nearest_node(origin)
+        sweep = FrequencySweep.run(csr_graph, node, TRIP_TIME, hours=hours)
+        for freq_multiplier in sweep.multipliers:
+            travel_times = csr_graph.travel_times_from(csr_graph.index_of(node),
+                TRIP_TIME, freq_multiplier, hours)
+            np.testing.assert_array_equal(sweep.reached(freq_multiplier),
+                                          travel_times <= TRIP_TIME)
+
+
+def test_reach_curve_grows_with_frequency(origins, csr_isochrone):
+    node = csr_isochrone.get_nearest_node(origins[0])
+    sweep = FrequencySweep.run(csr_isochrone.csr_graph, node, TRIP_TIME)
+    multipliers, reached = sweep.reach_curve()
+    assert np.all(np.diff(reached) >= 0)
+    assert reached[-1] == np.isfinite(sweep.thresholds).sum()
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.gtfs as gtfs
+
+
+def test_gtfs_dtypes_are_for_columns_that_are_read():
+    for table_name, columns in gtfs.GTFS_COLUMNS.items():
+        assert set(gtfs.GTFS_DTYPES.get(table_name, {})) <= set(columns)
+
+
+def test_parse_gtfs_times():
+    times = pd.Series(["7:05:00", "07:05:00", "25:10:00", "00:00:00", None,
+                       " 7:05:00", "7:05:00 ", "23:59:59", np.nan])
+    expected = [25500, 25500, 90600, 0, -1, 25500, 25500, 86399, -1]
+    parsed = gtfs.parse_gtfs_times(times)
+    assert parsed.dtype == np.int32
+    np.testing.assert_array_equal(parsed, expected)
+
+
+def test_parse_gtfs_times_ignores_index():
+    times = pd.Series(["8:00:00", None], index=[5, 3])
+    np.testing.assert_array_equal(gtfs.parse_gtfs_times(times), [28800, -1])
+
+
+def test_parse_gtfs_times_rejects_garbage():
+    with pytest.raises(ValueError):
+        gtfs.parse_gtfs_times(pd.Series(["7:05"]))
+
+
+def test_clean_stop_times_keeps_service_hours():
+    stop_times = pd.DataFrame({
+        "trip_id":          ["a", "a", "a", "a"],
+        "stop_id":          ["1", "2", "3", "4"],
+        "stop_sequence":    [1, 2, 3, 4],
+        "arrival_time":     ["4:59:00", "5:00:00", "21:59:59", "24:30:00"],
+        "departure_time":   ["4:59:00", "5:00:00", "21:59:59", "24:30:00"],
+    })
+    assert list(gtfs.clean_stop_times_table(stop_times, (5, 22))["stop_id"]) == ["2", "3"]
+    assert list(gtfs.clean_stop_times_table(stop_times, (4, 28))["stop_id"]) == ["1", "2", "3", "4"]
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+import src.gtfs as gtfs
+
+
+def load_tables(data_dir):
+    return [gtfs.load_prepared_gtfs_table(name, data_dir)
+            for name in ("routes", "trips", "stop_times")]
+
+
+def baseline_travel_times(trips, stop_times, route_id):
+    """
+    One route's average travel times the way they were computed before they
+    were vectorized: a matrix of arrival time differences per trip, with the
+    positive ones averaged across trips. As {(origin, destination): minutes}.
+    """
+    pairwise_dfs = []
+    for trip_id in trips[trips["route_id"] == route_id]["trip_id"].value_counts().index:
+        single_trip = stop_times[stop_times["trip_id"] == trip_id]
+        single_trip = single_trip.drop_duplicates(subset=["stop_id"], keep="first")
+        single_trip = single_trip.sort_values(by="stop_sequence")
+        arrivals = single_trip["arrival_time"].values / 60
+        pairwise_df = pd.DataFrame(arrivals[:, None] - arrivals,
+            index=single_trip["stop_id"], columns=single_trip["stop_id"])
+        pairwise_dfs.append(pairwise_df[pairwise_df > 0])
+
+    # Rows are destinations and columns origins
+    averages = pd.concat(pairwise_dfs).groupby(level=0).mean()
+    return {(origin, destination): minutes
+            for destination, row in averages.iterrows()
+            for origin, minutes in row.items() if not np.isnan(minutes)}
+
+
+def test_route_travel_times_match_baseline(city, tmp_path):
+    _, data_dir = city
+    routes, trips, stop_times = load_tables(data_dir)
+    gtfs.average_travel_times_per_route(routes, trips, stop_times, use_cache=False,
+        data_dir=tmp_path, processes=1)
+    travel_times_per_route = gtfs.load_isochrone_data("travel_times_per_route.pkl", tmp_path)
+
+    assert set(travel_times_per_route) == set(trips["route_id"])
+    for route_id, travel_times in travel_times_per_route.items():
+        expected = baseline_travel_times(trips, stop_times, route_id)
+        actual = dict(zip(zip(travel_times["origin_stop_id"],
+                              travel_times["destination_stop_id"]),
+                          travel_times["transit_travel_time"]))
+        assert expected.keys() == actual.keys()
+        pairs = list(expected)
+        np.testing.assert_allclose([actual[pair] for pair in pairs],
+                                   [expected[pair] for pair in pairs])
+
+
+def saved_travel_times(data_dir, output_dir, **kwargs):
+    gtfs.average_travel_times_per_route(*load_tables(data_dir), data_dir=output_dir, **kwargs)
+    return gtfs.isochrone_data_path("travel_times_per_route.pkl", output_dir).read_bytes()
+
+
+def test_route_travel_times_match_across_processes(city, tmp_path):
+    _, data_dir = city
+    in_process = saved_travel_times(data_dir, tmp_path / "in_process",
+                                    use_cache=False, processes=1)
+    in_pool = saved_travel_times(data_dir, tmp_path / "in_pool",
+                                 use_cache=False, processes=2)
+    assert in_process == in_pool
+
+
+def test_cached_route_travel_times_match(city, tmp_path):
+    _, data_dir = city
+    uncached = saved_travel_times(data_dir, tmp_path / "uncached", use_cache=False)
+    computed = saved_travel_times(data_dir, tmp_path / "cached", use_cache=True)
+    reused = saved_travel_times(data_dir, tmp_path / "cached", use_cache=True)
+    assert any(gtfs.route_cache_dir(tmp_path / "cached").iterdir())
+    assert uncached == computed == reused
+
+
+def test_route_cache_is_pruned(city, tmp_path):
+    _, data_dir = city
+    cache_dir = gtfs.route_cache_dir(tmp_path)
+    saved_travel_times(data_dir, tmp_path, use_cache=True)
+    cached = sorted(cache_dir.iterdir())
+    stale = cache_dir / f"{'0' * 64}.arrays"
+    stale.write_bytes(cached[0].read_bytes())
+
+    saved_travel_times(data_dir, tmp_path, use_cache=True)
+    assert sorted(cache_dir.iterdir()) == cached
@@ -0,0 +1,35 @@
+import networkx as nx
+
+import src.graphs as graphs
+
+
+CITY = "Grid Town"
+
+
+def grid_graph():
+    graph = nx.MultiDiGraph()
+    for node in range(49):
+        graph.add_node(node, x=float(node % 7), y=float(node // 7))
+    for node in range(48):
+        graph.add_edge(node, node + 1, length=1.0, travel_time=1.0)
+    return graph
+
+
+def test_node_index_is_read_without_writing(tmp_path):
+    graph = grid_graph()
+    filepath = graphs.node_index_path(CITY, tmp_path)
+
+    # Missing, so built in memory and nothing is saved
+    missing = graphs.read_node_index(CITY, graph, data_dir=tmp_path)
+    assert missing.nearest_node((3.1, 2.0)) == 23
+    assert not filepath.exists()
+
+    graphs.save_walking_artifacts(CITY, graph, tmp_path)
+    saved = filepath.read_bytes()
+    assert graphs.read_node_index(CITY, graph, data_dir=tmp_path).version == missing.version
+
+    # Out of date, so built in memory from the graph given, and the file is left alone
+    moved = graph.copy()
+    moved.nodes[23]["y"] = 40.0
+    assert graphs.read_node_index(CITY, moved, data_dir=tmp_path).nearest_node((3.1, 2.0)) != 23
+    assert filepath.read_bytes() == saved
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from src.stop_table import StopTable
+from src.isochrones import TransitIsochrone
+from benchmarks.run import CITY
+
+
+TRIP_TIME = 30
+FREQ_MULTIPLIERS = [0.5, 1.0, 2.0]
+
+# Minutes that float32 sums of the same path, added up in a different order,
+# may differ by
+TOLERANCE = 1e-3
+
+
+def assert_same_arrays(expected, actual):
+    reached = np.isfinite(expected)
+    np.testing.assert_array_equal(reached, np.isfinite(actual))
+    np.testing.assert_allclose(actual[reached], expected[reached], atol=TOLERANCE)
+
+
+def test_stop_table_matches_search(city, origins, csr_isochrone):
+    _, data_dir = city
+    stop_table_isochrone = TransitIsochrone(data_dir, CITY, engine="csr", use_stop_table=True)
+    assert stop_table_isochrone.stop_table is not None
+    for origin in origins:
+        node = csr_isochrone.get_nearest_node(origin)
+        for freq_multiplier in FREQ_MULTIPLIERS:
+            assert_same_arrays(
+                csr_isochrone.csr_search(node, TRIP_TIME, freq_multiplier),
+                stop_table_isochrone.csr_search(node, TRIP_TIME, freq_multiplier))
+
+
+def test_stop_table_spot_check(csr_isochrone):
+    stop_table = StopTable.build(csr_isochrone.csr_graph, freq_multipliers=[1.0])
+    assert stop_table.spot_check(csr_isochrone.csr_graph) == 0
+
+
+def test_stop_table_stops_past_its_size_limit(csr_isochrone):
+    with pytest.raises(ValueError, match="stop table has passed"):
+        StopTable.build(csr_isochrone.csr_graph, max_bytes=1024)